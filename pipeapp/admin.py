@@ -1,6 +1,8 @@
+from django import forms
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from .models import CustomUser, Profile, Zone, State, Area, Unit, PipelineRoute, PipelineFault
+from .geometry import normalize_coordinates
 
 # CustomUserAdmin definition
 class CustomUserAdmin(BaseUserAdmin):
@@ -30,16 +32,44 @@ admin.site.register(State)
 admin.site.register(Area)
 admin.site.register(Unit)
 
+# Coordinates are stored packed, edit them as JSON
+class PipelineRouteAdminForm(forms.ModelForm):
+    coordinates = forms.JSONField(help_text='List of {"latitude": .., "longitude": ..} objects')
+
+    class Meta:
+        model = PipelineRoute
+        fields = ['name', 'state', 'coordinates']
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk:
+            self.initial['coordinates'] = self.instance.coordinates
+
+    def clean_coordinates(self):
+        try:
+            return normalize_coordinates(self.cleaned_data['coordinates'])
+        except ValueError as exc:
+            raise forms.ValidationError(str(exc))
+
+    def save(self, commit=True):
+        self.instance.coordinates = self.cleaned_data['coordinates']
+        return super().save(commit)
+
 # PipelineRouteAdmin
 @admin.register(PipelineRoute)
 class PipelineRouteAdmin(admin.ModelAdmin):
-    list_display = ('name', 'state', 'get_length')
+    form = PipelineRouteAdminForm
+    list_display = ('name', 'state', 'status', 'critical_fault_count', 'warning_fault_count', 'get_length', 'segment_count')
     search_fields = ('name',)
-    list_filter = ('state',)
+    list_filter = ('state', 'status')
+    readonly_fields = (
+        'status', 'normal_fault_count', 'warning_fault_count', 'critical_fault_count', 'get_length', 'segment_count'
+    )
 
     def get_length(self, obj):
-        return len(obj.coordinates)  # This could represent the number of coordinates or a custom calculation
+        return f'{obj.length_m / 1000:.3f} km'  # Geodesic length stored on save
     get_length.short_description = 'Route Length'
+    get_length.admin_order_field = 'length_m'
 
 # PipelineFaultAdmin
 @admin.register(PipelineFault)
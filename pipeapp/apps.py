@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class PipeappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'pipeapp'
+
+    def ready(self):
+        # Signal receivers that live outside models.py
+        from . import authentication, changes, scope, versions  # noqa: F401
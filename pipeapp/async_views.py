@@ -0,0 +1,102 @@
+"""
+Async read endpoints, served in place of the viewsets' reads under ASGI.
+
+Route listing and retrieval and fault listing answer exactly as the DRF
+viewsets do, reusing their querysets, serializers, renderers and error
+handling. What is I/O bound is awaited: authentication (the token cache,
+then ``Token.objects.aget``), the role scope, the listing's data version
+and the listing cache. A dashboard poll answered with 304 or from the
+listing cache therefore never occupies a thread, however many slow
+national listings the worker is building meanwhile.
+
+Pages that do have to be built are paginated, serialized and rendered by
+synchronous DRF code, so they run in one ``sync_to_async`` hop on the
+request's own thread, which is where Django's async ORM would run each of
+their queries anyway. Streamed listings take one such hop per chunk, so
+the first chunk is sent before the rest is read. A route is read with
+``aget`` and serialized inline.
+
+Other methods on the same URLs go to the viewsets unchanged.
+PIPEAPP_ASYNC_READS mounts these views; pipeline.asgi turns it on.
+"""
+from asgiref.sync import sync_to_async
+from django.http import Http404
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+from rest_framework.response import Response
+
+from .authentication import aauthenticate_request
+from .listing_cache import acached_listing
+from .scope import aresolve_scope
+from .streaming import as_async_stream
+from .versions import ascope_version, listing_key
+from .views import PipelineFaultViewSet, PipelineRouteAndFaultViewSet
+
+
+async def dispatch(viewset, initkwargs, action, handler, request, **kwargs):
+    """DRF's ``APIView.dispatch`` for one read ``action``, with its I/O awaited ahead of the sync code."""
+    view = viewset(**initkwargs, action_map={'get': action, 'head': action}, args=(), kwargs=kwargs)
+    request = view.initialize_request(request, **kwargs)
+    view.request = request
+    view.headers = view.default_response_headers
+    try:
+        await aauthenticate_request(request)
+        view.initial(request, **kwargs)
+        view.scope = await aresolve_scope(request.user)
+        response = await handler(view, request, **kwargs)
+    except Exception as exc:
+        response = view.handle_exception(exc)
+    return view.finalize_response(request, response, **kwargs)
+
+
+async def list_routes(view, request):
+    key = listing_key(view.scope, request, await ascope_version(view.scope))
+    if view.listing_not_modified(request, key):
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    elif view.listing_cacheable(request):
+        content, hit = await acached_listing(key, lambda: sync_to_async(view.render_listing)(request))
+        response = view.cached_listing_response(request, content, hit)
+    else:
+        response = as_async_stream(await sync_to_async(view.list_routes)(request))
+    return view.add_listing_headers(response, key)
+
+
+async def retrieve_route(view, request, pk):
+    queryset = view.filter_queryset(view.get_queryset())
+    try:
+        route = await queryset.aget(pk=pk)
+    except queryset.model.DoesNotExist:
+        raise Http404(f'No {queryset.model._meta.object_name} matches the given query.')
+    view.check_object_permissions(request, route)
+    return Response(view.get_serializer(route).data)
+
+
+async def list_faults(view, request):
+    return await sync_to_async(view.list)(request)
+
+
+def with_sync_writes(read, viewset, action, actions, **initkwargs):
+    """An async view answering GET and HEAD with ``read``, and other methods with ``viewset`` as routed."""
+    sync_view = viewset.as_view(actions, **initkwargs)
+
+    async def view(request, *args, **kwargs):
+        if request.method in ('GET', 'HEAD'):
+            return await dispatch(viewset, initkwargs, action, read, request, **kwargs)
+        return await sync_to_async(sync_view)(request, *args, **kwargs)
+
+    return csrf_exempt(view)
+
+
+# The actions and names the router gives these URLs
+LIST_ACTIONS = {'get': 'list', 'post': 'create'}
+DETAIL_ACTIONS = {'get': 'retrieve', 'put': 'update', 'patch': 'partial_update', 'delete': 'destroy'}
+
+routes = with_sync_writes(
+    list_routes, PipelineRouteAndFaultViewSet, 'list', LIST_ACTIONS, basename='pipeline-route-viewset', detail=False,
+)
+route_detail = with_sync_writes(
+    retrieve_route, PipelineRouteAndFaultViewSet, 'retrieve', DETAIL_ACTIONS, basename='pipeline-route-viewset', detail=True,
+)
+faults = with_sync_writes(
+    list_faults, PipelineFaultViewSet, 'list', LIST_ACTIONS, basename='pipeline-fault-viewset', detail=False,
+)
@@ -0,0 +1,263 @@
+"""
+Token and Basic authentication without a database round trip per request.
+
+Validated tokens are kept in a bounded in-process LRU for
+PIPEAPP_TOKEN_CACHE_LOCAL_TTL seconds. With PIPEAPP_TOKEN_CACHE_ALIAS
+naming a shared cache (e.g. Redis or Memcached) they are stored there too,
+for PIPEAPP_TOKEN_CACHE_TTL seconds, so every worker process benefits from
+one lookup. Deleting a token, saving or deleting its user, and logging out
+drop the entry from the shared cache and from this process; other processes
+may keep serving their local copy until it expires, which is why the local
+TTL defaults to a few seconds whether or not a shared cache is configured.
+
+Basic credentials are verified with the password hasher once, then
+remembered under an HMAC of the username and password keyed with
+SECRET_KEY, so repeat requests skip the key derivation. The password itself
+is never stored, and failed attempts are never cached and still pay the
+full hash. Saving the user (which changing the password does) or deleting
+it drops the entry; like tokens, other processes' copies expire after
+PIPEAPP_BASIC_AUTH_CACHE_LOCAL_TTL seconds, and shared ones after
+PIPEAPP_BASIC_AUTH_CACHE_TTL.
+
+Async views authenticate with ``aauthenticate_request``, which awaits each
+authenticator's ``aauthenticate`` (the token cache, then
+``Token.objects.aget``) and leaves DRF's own authentication nothing to look up.
+"""
+import hashlib
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.crypto import salted_hmac
+from django.utils.translation import gettext_lazy as _
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authentication import BaseAuthentication, BasicAuthentication, TokenAuthentication, get_authorization_header
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.authtoken.models import Token
+
+
+class CredentialCache:
+    """Verified credentials mapped to a pickled Token or user, indexed by user id."""
+
+    def __init__(self, prefix='token', size=None, ttl=None, alias=None, local_ttl=None):
+        self.prefix = prefix
+        self.size = size or getattr(settings, 'PIPEAPP_TOKEN_CACHE_SIZE', 10000)
+        self.ttl = ttl or getattr(settings, 'PIPEAPP_TOKEN_CACHE_TTL', 300)
+        self.alias = alias if alias is not None else getattr(settings, 'PIPEAPP_TOKEN_CACHE_ALIAS', None)
+        # Invalidations never reach other processes' copies, which therefore live only seconds
+        self.local_ttl = min(self.ttl, local_ttl or getattr(settings, 'PIPEAPP_TOKEN_CACHE_LOCAL_TTL', 5))
+        self.entries = OrderedDict()  # key -> (expires at, pickled token, user id)
+        self.user_keys = {}  # user id -> keys cached here, so a user is invalidated without a query
+        self.lock = threading.Lock()
+
+    def cache_key(self, key):
+        # Raw tokens never appear in cache keys
+        return f'pipeapp:{self.prefix}:{hashlib.sha256(key.encode()).hexdigest()}'
+
+    def user_cache_key(self, user_id):
+        return f'pipeapp:{self.prefix}-user:{user_id}'
+
+    def get(self, key):
+        """The cached object, or None."""
+        value = self.get_local(key)
+        if value is None and self.alias:
+            value = self.remember_shared(key, caches[self.alias].get(self.cache_key(key)))
+        return value
+
+    async def aget(self, key):
+        value = self.get_local(key)
+        if value is None and self.alias:
+            value = self.remember_shared(key, await caches[self.alias].aget(self.cache_key(key)))
+        return value
+
+    def get_local(self, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries.move_to_end(key)
+                    # A fresh copy per request, so nothing set on one request's user leaks into the next
+                    return pickle.loads(entry[1])[0]
+                self._forget(key)
+        return None
+
+    def remember_shared(self, key, blob):
+        # An entry read from the shared cache is kept locally too
+        if blob is None:
+            return None
+        value, user_id = pickle.loads(blob)
+        self._remember(key, blob, user_id, time.monotonic())
+        return value
+
+    def set(self, key, value, user_id):
+        blob = pickle.dumps((value, user_id))
+        self._remember(key, blob, user_id, time.monotonic())
+        if self.alias:
+            shared = caches[self.alias]
+            shared.set(self.cache_key(key), blob, self.ttl)
+            user_key = self.user_cache_key(user_id)
+            shared.set(user_key, sorted(set(shared.get(user_key, [])) | {key}), self.ttl)
+
+    async def aset(self, key, value, user_id):
+        blob = pickle.dumps((value, user_id))
+        self._remember(key, blob, user_id, time.monotonic())
+        if self.alias:
+            shared = caches[self.alias]
+            await shared.aset(self.cache_key(key), blob, self.ttl)
+            user_key = self.user_cache_key(user_id)
+            await shared.aset(user_key, sorted(set(await shared.aget(user_key, [])) | {key}), self.ttl)
+
+    def _remember(self, key, blob, user_id, now):
+        with self.lock:
+            self.entries[key] = (now + self.local_ttl, blob, user_id)
+            self.entries.move_to_end(key)
+            self.user_keys.setdefault(user_id, set()).add(key)
+            while len(self.entries) > self.size:
+                self._forget(next(iter(self.entries)))
+
+    def _forget(self, key):
+        # Callers hold the lock
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            keys = self.user_keys.get(entry[2], set())
+            keys.discard(key)
+            if not keys:
+                self.user_keys.pop(entry[2], None)
+
+    def invalidate(self, key):
+        with self.lock:
+            self._forget(key)
+        if self.alias:
+            caches[self.alias].delete(self.cache_key(key))
+
+    def invalidate_user(self, user_id):
+        with self.lock:
+            keys = set(self.user_keys.get(user_id, ()))
+            for key in keys:
+                self._forget(key)
+        if self.alias:
+            shared = caches[self.alias]
+            keys.update(shared.get(self.user_cache_key(user_id), []))
+            shared.delete_many([self.cache_key(key) for key in keys] + [self.user_cache_key(user_id)])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.user_keys.clear()
+
+
+token_cache = CredentialCache('token')
+basic_cache = CredentialCache(
+    'basic', ttl=getattr(settings, 'PIPEAPP_BASIC_AUTH_CACHE_TTL', 60),
+    size=getattr(settings, 'PIPEAPP_BASIC_AUTH_CACHE_SIZE', 1000),
+    local_ttl=getattr(settings, 'PIPEAPP_BASIC_AUTH_CACHE_LOCAL_TTL', 5),
+)
+
+
+class CachingTokenAuthentication(TokenAuthentication):
+    """DRF TokenAuthentication that serves repeat tokens from ``token_cache``."""
+
+    def authenticate_credentials(self, key):
+        token = token_cache.get(key)
+        if token is None:
+            # Unknown keys and inactive users are rejected here and never cached
+            user, token = super().authenticate_credentials(key)
+            token_cache.set(key, token, token.user_id)
+        return token.user, token
+
+    def authenticate(self, request):
+        key = self.get_key(request)
+        return None if key is None else self.authenticate_credentials(key)
+
+    async def aauthenticate(self, request):
+        key = self.get_key(request)
+        return None if key is None else await self.aauthenticate_credentials(key)
+
+    async def aauthenticate_credentials(self, key):
+        token = await token_cache.aget(key)
+        if token is None:
+            try:
+                token = await self.get_model().objects.select_related('user').aget(key=key)
+            except self.get_model().DoesNotExist:
+                raise AuthenticationFailed(_('Invalid token.'))
+            if not token.user.is_active:
+                raise AuthenticationFailed(_('User inactive or deleted.'))
+            await token_cache.aset(key, token, token.user_id)
+        return token.user, token
+
+    def get_key(self, request):
+        # The header parsing of TokenAuthentication.authenticate
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) == 1:
+            raise AuthenticationFailed(_('Invalid token header. No credentials provided.'))
+        elif len(auth) > 2:
+            raise AuthenticationFailed(_('Invalid token header. Token string should not contain spaces.'))
+        try:
+            return auth[1].decode()
+        except UnicodeError:
+            raise AuthenticationFailed(_('Invalid token header. Token string should not contain invalid characters.'))
+
+
+class CachingBasicAuthentication(BasicAuthentication):
+    """DRF BasicAuthentication that runs the password hasher once per ``basic_cache`` TTL."""
+
+    def authenticate_credentials(self, userid, password, request=None):
+        digest = salted_hmac('pipeapp.authentication.basic', f'{userid}\0{password}').hexdigest()
+        user = basic_cache.get(digest)
+        if user is None:
+            user, _ = super().authenticate_credentials(userid, password, request)
+            basic_cache.set(digest, user, user.pk)
+        return user, None
+
+    async def aauthenticate(self, request):
+        # A miss runs the password hasher, which belongs on a thread rather than the event loop
+        return await sync_to_async(self.authenticate)(request)
+
+
+class AwaitedAuthentication(BaseAuthentication):
+    """Hands DRF the credentials an authenticator's ``aauthenticate`` already returned."""
+
+    def __init__(self, authenticator, credentials):
+        self.authenticator = authenticator
+        self.credentials = credentials
+
+    def authenticate(self, request):
+        return self.credentials
+
+    def authenticate_header(self, request):
+        return self.authenticator.authenticate_header(request)
+
+
+async def aauthenticate_request(request):
+    """Authenticate a DRF request from async code, so reading ``request.user`` later does no I/O."""
+    awaited = []
+    for authenticator in request.authenticators:
+        credentials = await authenticator.aauthenticate(request)
+        awaited.append(AwaitedAuthentication(authenticator, credentials))
+        if credentials is not None:
+            break
+    request.authenticators = awaited
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    token_cache.invalidate(instance.key)
+
+
+# The user model tokens belong to; pipeapp.models.CustomUser is a separate model
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def user_changed(sender, instance, created=False, update_fields=None, **kwargs):
+    # New users have nothing cached yet, and logging in only touches last_login
+    if created or update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    token_cache.invalidate_user(instance.pk)
+    basic_cache.invalidate_user(instance.pk)
@@ -0,0 +1,378 @@
+import json
+import re
+import statistics
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from .changes import COUNTER_ID
+from .scope import invalidate_all_scopes
+from .models import ChangeCounter, Profile, Zone, State, Area, Unit, PipelineRoute, PipelineRouteSimplification, PipelineFault
+
+User = get_user_model()
+
+BENCHMARK_PASSWORD = 'Bench-Pa55word!'
+ROUTES_URL = '/pipeapp/pipeline-routes-viewset/'
+FAULTS_URL = '/pipeapp/pipeline-faults-viewset/'
+
+# Maximum number of queries each scenario may run. Budgets must not depend on the
+# dataset size, so a scenario that crosses its budget on a larger dataset is an N+1.
+QUERY_BUDGETS = {
+    'routes.list': 6,
+    'routes.list_not_modified': 4,
+    'routes.changes': 6,
+    'routes.retrieve': 5,
+    'routes.create': 15,
+    'routes.update': 20,
+    'faults.list': 4,
+    'faults.near': 5,
+    'auth.login': 8,
+    'auth.login_token': 5,
+    'auth.register': 7,
+}
+
+# Median wall time, in milliseconds, the login scenarios should stay under with the
+# benchmark's MD5 hasher. Reported rather than enforced, since it depends on the machine.
+LATENCY_BUDGETS_MS = {
+    'auth.login': 50,
+    'auth.login_token': 30,
+}
+
+# Role scopes exercised by the routes endpoints
+ROLES = [Profile.NATIONAL, Profile.ZONAL, Profile.STATE, Profile.AREA, Profile.UNIT]
+
+FAULTS_PER_WRITE = 2
+
+TRANSACTION_CONTROL = re.compile(r'^\s*(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE)\b', re.IGNORECASE)
+
+_unique = count()
+
+
+def route_coordinates(points, offset=0.0):
+    return [
+        {'latitude': 6.0 + offset + i * 0.001, 'longitude': 3.0 + offset + i * 0.001}
+        for i in range(points)
+    ]
+
+
+def bulk_create_nodes(model, nodes):
+    for node in nodes:
+        node.refresh_path()
+    return model.objects.bulk_create(nodes)
+
+
+def seed_dataset(routes, faults_per_route=3, points_per_route=50, zones=2, states_per_zone=3, prefix='Bench'):
+    """Create a hierarchy, one user per role and ``routes`` routes spread over the states."""
+    zone_objs = bulk_create_nodes(Zone, [Zone(name=f'{prefix} Zone {z}') for z in range(zones)])
+    state_objs = bulk_create_nodes(State, [
+        State(name=f'{prefix} State {z}-{s}', zone=zone)
+        for z, zone in enumerate(zone_objs)
+        for s in range(states_per_zone)
+    ])
+    area_objs = bulk_create_nodes(Area, [
+        Area(name=f'{prefix} Area {state.name}', state=state) for state in state_objs
+    ])
+    unit_objs = bulk_create_nodes(Unit, [
+        Unit(name=f'{prefix} Unit {area.name}', area=area) for area in area_objs
+    ])
+    # bulk_create skips the hierarchy signals that expire cached role scopes
+    invalidate_all_scopes()
+    # A flush removes the change counter the migrations created
+    ChangeCounter.objects.get_or_create(pk=COUNTER_ID)
+
+    route_objs = [
+        PipelineRoute(
+            name=f'{prefix} Route {i}',
+            state=state_objs[i % len(state_objs)],
+            coordinates=route_coordinates(points_per_route, offset=i * 0.01),
+        )
+        for i in range(routes)
+    ]
+    for route in route_objs:
+        route.refresh_geometry_fields()
+    PipelineRoute.objects.bulk_create(route_objs)
+    PipelineRouteSimplification.objects.bulk_create(
+        [level for route in route_objs for level in route.build_simplifications()]
+    )
+    statuses = ['normal', 'warning', 'critical']
+    faults = [
+        PipelineFault(
+            pipeline_route=route,
+            fault_coordinates=route.coordinates[f % len(route.coordinates)],
+            description=f'Bench fault {f}',
+            status=statuses[(route.pk + f) % len(statuses)],
+        )
+        for route in route_objs
+        for f in range(faults_per_route)
+    ]
+    for fault in faults:
+        fault.refresh_location()
+    PipelineFault.objects.bulk_create(faults)
+    # bulk_create skips the fault signals, so fill in the stored summaries directly
+    summaries = PipelineRoute.fault_summaries()
+    for route in route_objs:
+        for field, value in summaries.get(route.pk, PipelineRoute.empty_fault_summary()).items():
+            setattr(route, field, value)
+    PipelineRoute.objects.bulk_update(route_objs, PipelineRoute.SUMMARY_FIELDS, batch_size=500)
+
+    users = {}
+    for role in ROLES:
+        user = User.objects.create_user(
+            username=f'{prefix.lower()}-{role.lower()}', email=f'{role.lower()}@bench.local',
+            password=BENCHMARK_PASSWORD,
+        )
+        Profile.objects.create(
+            user=user, role=role, zone=zone_objs[0], state=state_objs[0],
+            area=area_objs[0], unit=unit_objs[0],
+        )
+        users[role] = user
+    return {
+        'zones': zone_objs, 'states': state_objs, 'areas': area_objs,
+        'units': unit_objs, 'routes': route_objs, 'users': users,
+    }
+
+
+def token_client(user):
+    client = APIClient()
+    token, _ = Token.objects.get_or_create(user=user)
+    client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+    return client
+
+
+def route_payload(state_name, name=None):
+    return {
+        'name': name or f'Bench Write {next(_unique)}',
+        'state': state_name,
+        'coordinates': route_coordinates(20),
+        'faults': [
+            {'fault_coordinates': {'latitude': 6.0, 'longitude': 3.0}, 'status': 'warning'}
+            for _ in range(FAULTS_PER_WRITE)
+        ],
+    }
+
+
+def measure(func):
+    """Run ``func`` once and record its queries, wall time and peak traced memory."""
+    tracemalloc.start()
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = func()
+            elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # Transaction control differs between a TestCase and a real request, keep it out of budgets
+    sql = [query['sql'] for query in queries.captured_queries]
+    statements = [text for text in sql if not TRANSACTION_CONTROL.match(text)]
+    return {
+        'status_code': getattr(response, 'status_code', None),
+        'queries': len(statements),
+        'transaction_statements': len(sql) - len(statements),
+        'wall_ms': round(elapsed * 1000, 3),
+        'peak_memory_kb': round(peak / 1024, 1),
+        'sql': [query['sql'] for query in queries.captured_queries],
+    }
+
+
+def scenarios(dataset):
+    """Yield ``(name, role, callable)`` for every endpoint, operation and role scope."""
+    users = dataset['users']
+    states = dataset['states']
+    scoped_route = next(route for route in dataset['routes'] if route.state_id == states[0].pk)
+
+    for role in ROLES:
+        client = token_client(users[role])
+        yield 'routes.list', role, lambda client=client: client.get(ROUTES_URL)
+        # A dashboard poll with the ETag of the previous response, nothing written in between
+        etag = client.get(ROUTES_URL)['ETag']
+        yield 'routes.list_not_modified', role, lambda client=client, etag=etag: client.get(
+            ROUTES_URL, HTTP_IF_NONE_MATCH=etag)
+        # A delta sync from the cursor of a full download
+        cursor = client.get(f'{ROUTES_URL}changes/').json()['cursor']
+        yield 'routes.changes', role, lambda client=client, cursor=cursor: client.get(
+            f'{ROUTES_URL}changes/', {'since': cursor})
+        yield 'routes.retrieve', role, lambda client=client: client.get(f'{ROUTES_URL}{scoped_route.pk}/')
+        yield 'routes.create', role, lambda client=client: client.post(
+            ROUTES_URL, route_payload(states[0].name), format='json')
+        yield 'routes.update', role, lambda client=client: client.put(
+            f'{ROUTES_URL}{scoped_route.pk}/', route_payload(states[0].name, name=scoped_route.name), format='json')
+        yield 'faults.list', role, lambda client=client: client.get(FAULTS_URL)
+        yield 'faults.near', role, lambda client=client: client.get(f'{FAULTS_URL}?near=6.0,3.0&radius=5000')
+
+    anonymous = APIClient()
+    yield 'auth.login', None, lambda: anonymous.post('/pipeapp/login/', {
+        'username': users[Profile.NATIONAL].username, 'password': BENCHMARK_PASSWORD}, format='json')
+    yield 'auth.login_token', None, lambda: APIClient().post('/pipeapp/login/', {
+        'username': users[Profile.UNIT].username, 'password': BENCHMARK_PASSWORD, 'session': False}, format='json')
+    yield 'auth.register', None, lambda: anonymous.post('/pipeapp/register/', {
+        'username': f'bench-new-{next(_unique)}', 'email': 'new@bench.local',
+        'password': BENCHMARK_PASSWORD, 'profile': {'role': Profile.UNIT}}, format='json')
+
+
+def hot_querysets(dataset):
+    """The queries every route listing depends on, keyed by a readable label."""
+    states = dataset['states']
+    zone = dataset['zones'][0]
+    routes = PipelineRoute.objects.select_related('state')
+    route_ids = list(routes.filter(state__zone=zone).values_list('id', flat=True)[:100])
+    return {
+        'routes.national': routes.all(),
+        'routes.zonal': routes.filter(state__zone=zone),
+        'routes.state': routes.filter(state=states[0]),
+        'faults.prefetch': PipelineFault.objects.filter(pipeline_route_id__in=route_ids),
+    }
+
+
+def explain_plans(dataset):
+    return {label: queryset.explain() for label, queryset in hot_querysets(dataset).items()}
+
+
+def run_benchmarks(dataset, repeat=1):
+    """Measure every scenario ``repeat`` times and compare against the query budgets."""
+    results = []
+    for name, role, func in scenarios(dataset):
+        runs = [measure(func) for _ in range(repeat)]
+        queries = max(run['queries'] for run in runs)
+        budget = QUERY_BUDGETS[name]
+        results.append({
+            'scenario': name,
+            'role': role,
+            'status_code': runs[-1]['status_code'],
+            'queries': queries,
+            'transaction_statements': runs[-1]['transaction_statements'],
+            'query_budget': budget,
+            'within_budget': queries <= budget,
+            'wall_ms': statistics.median(run['wall_ms'] for run in runs),
+            'latency_budget_ms': LATENCY_BUDGETS_MS.get(name),
+            'peak_memory_kb': max(run['peak_memory_kb'] for run in runs),
+            'sql': runs[-1]['sql'],
+        })
+    return results
+
+
+# Load benchmark against a running deployment: one scenario per simulated client.
+# A few clients pull whole national pages while the rest poll as dashboards do,
+# so a deployment whose slow listings hold up the polls shows it in their tail latency.
+LOAD_SCENARIOS = {
+    'routes.page_1000': f'{ROUTES_URL}?page_size=1000',
+    'routes.poll': ROUTES_URL,
+    'faults.list': FAULTS_URL,
+}
+
+
+def load_client(base_url, token, scenario, deadline, timeout=30):
+    """Request ``scenario`` back to back until ``deadline``; returns ``(latencies in ms, errors)``."""
+    url = base_url.rstrip('/') + LOAD_SCENARIOS[scenario]
+    etag = None
+    latencies, errors = [], 0
+    while time.perf_counter() < deadline:
+        headers = {'Authorization': f'Token {token}'}
+        if scenario == 'routes.poll' and etag:
+            headers['If-None-Match'] = etag
+        started = time.perf_counter()
+        try:
+            with urlopen(Request(url, headers=headers), timeout=timeout) as response:
+                response.read()
+                etag = response.headers.get('ETag')
+        except HTTPError as exc:
+            if exc.code != 304:  # urllib raises for Not Modified, which is what a poll hopes for
+                errors += 1
+                continue
+        except OSError:
+            errors += 1
+            continue
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies, errors
+
+
+# Writers, when asked for, each update the description of their own fault, so the only row
+# they all contend on is the change counter every write takes its number from (pipeapp.changes)
+WRITE_SCENARIO = 'faults.write'
+
+
+def scoped_fault_ids(base_url, token, limit, timeout=30):
+    """Ids of up to ``limit`` faults the token can see, for the writers to update."""
+    request = Request(
+        f"{base_url.rstrip('/')}{FAULTS_URL}?page_size={limit}", headers={'Authorization': f'Token {token}'},
+    )
+    with urlopen(request, timeout=timeout) as response:
+        return [fault['id'] for fault in json.load(response)['results']]
+
+
+def write_client(base_url, token, fault_id, deadline, timeout=30):
+    """Update fault ``fault_id`` back to back until ``deadline``; returns ``(latencies in ms, errors)``."""
+    url = f"{base_url.rstrip('/')}{FAULTS_URL}{fault_id}/"
+    headers = {'Authorization': f'Token {token}', 'Content-Type': 'application/json'}
+    latencies, errors = [], 0
+    for n in count(1):
+        if time.perf_counter() >= deadline:
+            break
+        body = json.dumps({'description': f'Load benchmark write {n}'}).encode()
+        started = time.perf_counter()
+        try:
+            with urlopen(Request(url, data=body, headers=headers, method='PATCH'), timeout=timeout) as response:
+                response.read()
+        except OSError:
+            errors += 1
+            continue
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies, errors
+
+
+def latency_summary(latencies, errors, duration):
+    ordered = sorted(latencies)
+
+    def percentile(share):
+        return round(ordered[min(len(ordered) - 1, int(share * len(ordered)))], 1) if ordered else None
+
+    return {
+        'requests': len(ordered),
+        'errors': errors,
+        'requests_per_second': round(len(ordered) / duration, 1),
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'max_ms': round(ordered[-1], 1) if ordered else None,
+    }
+
+
+def run_load(base_url, token, concurrency=50, duration=10.0, slow_clients=5, writers=0):
+    """
+    Run ``concurrency`` clients against ``base_url`` for ``duration`` seconds:
+    ``slow_clients`` pulling 1000-route pages, the others split between
+    polling the route listing with its ETag and listing faults. ``writers``
+    more clients update faults meanwhile, measuring how far the change
+    counter serializes writes and whether it holds up the reads.
+    """
+    assignments = ['routes.page_1000'] * min(slow_clients, concurrency)
+    assignments += [('routes.poll', 'faults.list')[i % 2] for i in range(concurrency - len(assignments))]
+    fault_ids = scoped_fault_ids(base_url, token, writers) if writers else []
+    if writers and not fault_ids:
+        raise ValueError('The token sees no faults for the writers to update.')
+    deadline = time.perf_counter() + duration
+    with ThreadPoolExecutor(max_workers=concurrency + writers) as executor:
+        futures = [(scenario, executor.submit(load_client, base_url, token, scenario, deadline)) for scenario in assignments]
+        futures += [
+            (WRITE_SCENARIO, executor.submit(write_client, base_url, token, fault_ids[i % len(fault_ids)], deadline))
+            for i in range(writers)
+        ]
+        runs = [(scenario, future.result()) for scenario, future in futures]
+    results = {}
+    for scenario in [*LOAD_SCENARIOS, *([WRITE_SCENARIO] if writers else [])]:
+        latencies = [ms for name, (run, _) in runs if name == scenario for ms in run]
+        errors = sum(errors for name, (_, errors) in runs if name == scenario)
+        results[scenario] = {
+            'clients': sum(name == scenario for name, _ in runs),
+            **latency_summary(latencies, errors, duration),
+        }
+    return results
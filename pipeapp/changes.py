@@ -0,0 +1,191 @@
+"""
+Change sequence and tombstones for delta sync.
+
+Every write to a route or fault takes the next number from a single counter
+row and stamps it on the written rows as ``change_seq``. Deleting a route or
+fault, or moving it out of a state, writes a Tombstone with that number and
+the state it left. Incrementing the counter locks its row until the writing
+transaction commits, so numbers become visible in order: a reader that sees
+number N also sees every change up to N, and a client asking for the changes
+after the last number it was given misses none, even when they commit late.
+Timestamps give no such guarantee, as transactions commit in a different
+order than they read the clock.
+
+The price is that writes serialize on the counter row: a transaction holds
+its lock from its first change until it commits, and a concurrent writer
+waits for it. A database sequence or identity column would not wait, but
+hands out numbers that commit out of order, which is what readers must not
+see. Keep writing transactions short after their first change. On SQLite
+writers are serialized by the database lock anyway, so the row costs
+nothing there; on PostgreSQL measure it with ``manage.py benchmark_load
+--writers N``, which updates faults concurrently and reports their latency
+next to the reads'.
+
+A route stands for its faults. A route tombstone removes them too, and a
+route moved into another state has its faults stamped again so they are
+sent with it.
+
+Cursors carry the number and a digest of the scope they were issued for. A
+cursor from another scope, one ahead of the counter (a restored database) or
+one older than the pruned tombstones asks the client to reload instead.
+"""
+import hashlib
+
+from django.db import connection, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import ChangeCounter, PipelineFault, PipelineRoute, State, Tombstone
+from .signals import faults_bulk_created, routes_bulk_created
+
+COUNTER_ID = 1
+
+
+def taken_change_seq():
+    """The number this transaction has already taken, if any."""
+    taken = getattr(connection, 'pipeapp_change_seq', None)
+    if taken is None or not connection.in_atomic_block:
+        return None
+    seq, marker = taken
+    # Commit runs the marker, rolling back the savepoint that took the number discards it
+    if any(callback is marker for _, callback, _ in connection.run_on_commit):
+        return seq
+    return None
+
+
+def next_change_seq():
+    """
+    A new change number, or within a transaction the one it already took, so
+    a request stamps everything it writes with one number at one counter bump.
+    """
+    seq = taken_change_seq()
+    if seq is not None:
+        return seq
+    counter = ChangeCounter.objects.filter(pk=COUNTER_ID)
+    if not counter.update(value=F('value') + 1):
+        # The first change since the table was flushed
+        ChangeCounter.objects.get_or_create(pk=COUNTER_ID)
+        counter.update(value=F('value') + 1)
+    seq = counter.values_list('value', flat=True).get()
+    if connection.in_atomic_block:
+        def marker():
+            connection.pipeapp_change_seq = None
+        connection.pipeapp_change_seq = (seq, marker)
+        transaction.on_commit(marker)
+    return seq
+
+
+def change_horizon():
+    """``(last number handed out, newest number whose tombstones may be gone)``."""
+    return ChangeCounter.objects.filter(pk=COUNTER_ID).values_list('value', 'pruned_through').first() or (0, 0)
+
+
+def record_changes(route_ids=(), fault_ids=(), removed=()):
+    """
+    Stamp routes and faults with the next change number, and write a tombstone
+    for each ``(kind, object id, state id)`` in ``removed``. Returns the number.
+    """
+    route_ids, fault_ids = set(route_ids) - {None}, set(fault_ids) - {None}
+    removed = [(kind, object_id, state_id) for kind, object_id, state_id in removed if state_id is not None]
+    if not (route_ids or fault_ids or removed):
+        return None
+    # Under autocommit the number must still commit together with what it stamps
+    with transaction.atomic(savepoint=False):
+        seq = next_change_seq()
+        if route_ids:
+            PipelineRoute.objects.filter(pk__in=route_ids).update(change_seq=seq)
+        if fault_ids:
+            PipelineFault.objects.filter(pk__in=fault_ids).update(change_seq=seq)
+        if removed:
+            Tombstone.objects.bulk_create([
+                Tombstone(kind=kind, object_id=object_id, state_id=state_id, change_seq=seq)
+                for kind, object_id, state_id in removed
+            ])
+    return seq
+
+
+def scope_digest(scope):
+    states = 'all' if scope.unrestricted else ','.join(map(str, sorted(scope.state_ids)))
+    return hashlib.sha256(states.encode()).hexdigest()[:12]
+
+
+def encode_cursor(seq, scope):
+    return f'{seq}-{scope_digest(scope)}'
+
+
+def decode_cursor(cursor, scope):
+    """The change number of ``cursor``, or None when it was issued for another scope."""
+    seq, _, digest = cursor.partition('-')
+    if not seq.isdigit() or not digest:
+        raise ValueError(cursor)
+    return int(seq) if digest == scope_digest(scope) else None
+
+
+@receiver(pre_save, sender=PipelineRoute)
+def route_saving(sender, instance, **kwargs):
+    # The summary and version receivers forget the loaded state once the save is done
+    instance._change_state_id = getattr(instance, '_loaded_state_id', None)
+
+
+@receiver(post_save, sender=PipelineRoute)
+def route_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    moved_from = instance._change_state_id
+    if moved_from == instance.state_id:
+        moved_from = None
+    instance.change_seq = record_changes(route_ids=[instance.pk], removed=[(Tombstone.ROUTE, instance.pk, moved_from)])
+    if moved_from is not None:
+        PipelineFault.objects.filter(pipeline_route=instance).update(change_seq=instance.change_seq)
+
+
+@receiver(post_delete, sender=PipelineRoute)
+def route_deleted(sender, instance, **kwargs):
+    record_changes(removed=[(Tombstone.ROUTE, instance.pk, instance.state_id)])
+
+
+@receiver(routes_bulk_created, sender=PipelineRoute)
+def routes_created(sender, instances, **kwargs):
+    record_changes(route_ids=[route.pk for route in instances])
+
+
+@receiver(pre_save, sender=PipelineFault)
+def fault_saving(sender, instance, **kwargs):
+    instance._change_route_id = getattr(instance, '_loaded_route_id', None)
+
+
+@receiver(post_save, sender=PipelineFault)
+def fault_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    # Routes carry the fault counts, so the fault's route changes with it
+    route_ids, removed = {instance.pipeline_route_id}, []
+    moved_from = instance._change_route_id
+    if moved_from is not None and moved_from != instance.pipeline_route_id:
+        route_ids.add(moved_from)
+        state_id = PipelineRoute.objects.filter(pk=moved_from).values_list('state_id', flat=True).first()
+        removed.append((Tombstone.FAULT, instance.pk, state_id))
+    instance.change_seq = record_changes(route_ids, [instance.pk], removed)
+
+
+@receiver(post_delete, sender=PipelineFault)
+def fault_deleted(sender, instance, origin=None, **kwargs):
+    # Faults removed with their route are covered by the route's tombstone
+    if isinstance(origin, PipelineRoute) or getattr(origin, 'model', None) is PipelineRoute:
+        return
+    state_id = PipelineRoute.objects.filter(pk=instance.pipeline_route_id).values_list('state_id', flat=True).first()
+    record_changes(route_ids=[instance.pipeline_route_id], removed=[(Tombstone.FAULT, instance.pk, state_id)])
+
+
+@receiver(faults_bulk_created, sender=PipelineFault)
+def faults_created(sender, instances, **kwargs):
+    record_changes(route_ids={fault.pipeline_route_id for fault in instances}, fault_ids=[fault.pk for fault in instances])
+
+
+@receiver(post_save, sender=State)
+def state_saved(sender, instance, created=False, raw=False, **kwargs):
+    # Routes are sent with their state's name
+    if not created and not raw:
+        with transaction.atomic(savepoint=False):
+            PipelineRoute.objects.filter(state=instance).update(change_seq=next_change_seq())
@@ -0,0 +1,356 @@
+"""
+Live fault and route events, pushed to clients as server-sent events.
+
+Events are read from the change sequence of pipeapp.changes, which every
+process writes to the database, so a stream carries the writes of every
+worker. While a process has subscribers, a background thread reads the
+counter every PIPEAPP_EVENTS_POLL_INTERVAL seconds; once it has moved, the
+routes and faults stamped and the tombstones written since the last look
+become events, which an in-process broker fans out to the subscribers whose
+role scope covers their state. Each subscriber is an ``asyncio.Queue``
+drained by a streaming response, so under ASGI an idle connection costs a
+coroutine and a small queue rather than a thread, and a worker can hold
+thousands of them. A process without subscribers makes no queries.
+
+The events are route.changed (carrying the route's status), route.deleted,
+fault.changed and fault.deleted; a route or fault moved out of a state is
+deleted for that state's subscribers. The events of one change are sent
+together, the last of them with the change's cursor as its id, the same
+cursor ``/routes/changes/?since=`` takes. A client reconnecting with
+Last-Event-ID is first sent what it missed. One whose cursor is unusable,
+who missed more than its queue holds, or who falls more than
+PIPEAPP_EVENTS_QUEUE_SIZE changes behind is sent a ``resync`` event and
+should reload the routes it shows. Each stream re-checks its token and
+role scope every PIPEAPP_EVENTS_KEEPALIVE seconds: a revoked one is sent
+``revoked`` and closed, one whose scope changed is sent ``resync`` and
+follows the new scope.
+
+Streams only accept a token in the Authorization header: one in the query
+string would be written to access logs. They are only served under ASGI;
+a WSGI worker would have to drain the endless stream before sending a
+byte, so there the endpoint answers 501.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import threading
+import time
+from operator import itemgetter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import DatabaseError, close_old_connections, connections
+from django.db.models import F
+from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework.exceptions import AuthenticationFailed
+
+from .authentication import CachingTokenAuthentication
+from .changes import change_horizon, decode_cursor, encode_cursor
+from .models import PipelineFault, PipelineRoute, Profile, Tombstone
+from .scope import aresolve_scope
+
+logger = logging.getLogger(__name__)
+
+EVENTS_QUEUE_SIZE = getattr(settings, 'PIPEAPP_EVENTS_QUEUE_SIZE', 100)
+EVENTS_KEEPALIVE = getattr(settings, 'PIPEAPP_EVENTS_KEEPALIVE', 15)
+EVENTS_POLL_INTERVAL = getattr(settings, 'PIPEAPP_EVENTS_POLL_INTERVAL', 1.0)
+EVENTS_MAX_CHANGES = getattr(settings, 'PIPEAPP_SYNC_MAX_CHANGES', 5000)
+
+# Batches without a change number: reload what is shown, and the stream's credentials were revoked
+RESYNC = (None, [{'type': 'resync'}])
+REVOKED = (None, [{'type': 'revoked'}])
+
+
+class Subscription:
+
+    def __init__(self, scope, loop, queue_size=None):
+        self.scope = scope
+        self.loop = loop
+        self.queue = asyncio.Queue(queue_size or EVENTS_QUEUE_SIZE)
+        self.lost = 0
+        self.skip_through = 0  # Changes the client already had when it reconnected
+
+    @property
+    def state_ids(self):
+        return self.scope.state_ids  # None when the scope is unrestricted
+
+    def offer(self, batch):
+        # The poller runs in its own thread, the queue belongs to the subscriber's event loop
+        self.loop.call_soon_threadsafe(self.put, batch)
+
+    def put(self, batch):
+        try:
+            self.queue.put_nowait(batch)
+        except asyncio.QueueFull:
+            self.lost += 1
+
+    async def get(self, timeout=None):
+        """The next ``(change number, events)`` batch, or None after ``timeout`` seconds without one."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+def fault_payload(fault):
+    return {
+        'id': fault.pk,
+        'route': fault.pipeline_route_id,
+        'status': fault.status,
+        'description': fault.description,
+        'latitude': fault.latitude,
+        'longitude': fault.longitude,
+        'reported_at': fault.reported_at.isoformat() if fault.reported_at else None,
+    }
+
+
+def load_events(since, until, scope=None, limit=None):
+    """
+    The events of the changes numbered after ``since`` up to ``until``, within
+    ``scope`` if given, as ``(change number, [(state id, event), ...])``
+    batches in order. None when there are more than ``limit`` of them.
+    """
+    limit = limit or EVENTS_MAX_CHANGES
+    window = {'change_seq__gt': since, 'change_seq__lte': until}
+    routes = PipelineRoute.objects.filter(**window)
+    faults = PipelineFault.objects.filter(**window).annotate(route_state_id=F('pipeline_route__state_id'))
+    removed = Tombstone.objects.filter(**window)
+    if scope is not None:
+        routes, removed = scope.filter(routes), scope.filter(removed)
+        faults = scope.filter(faults, state_lookup='pipeline_route__state')
+    removed = list(removed.values_list('change_seq', 'state_id', 'kind', 'object_id')[:limit + 1])
+    routes = list(routes.values_list('change_seq', 'state_id', 'id', 'status')[:limit + 1])
+    faults = list(faults[:limit + 1])
+    if len(removed) + len(routes) + len(faults) > limit:
+        return None
+
+    # Within a change, deletes go first, so an object moved between two states of a scope ends up present
+    changes = []
+    for seq, state_id, kind, object_id in removed:
+        if kind == Tombstone.ROUTE:
+            changes.append((seq, 0, state_id, {'type': 'route.deleted', 'route': object_id}))
+        else:
+            changes.append((seq, 0, state_id, {'type': 'fault.deleted', 'fault': {'id': object_id}}))
+    for seq, state_id, route_id, status in routes:
+        changes.append((seq, 1, state_id, {'type': 'route.changed', 'route': route_id, 'status': status}))
+    for fault in faults:
+        changes.append((fault.change_seq, 2, fault.route_state_id, {'type': 'fault.changed', 'fault': fault_payload(fault)}))
+    changes.sort(key=itemgetter(0, 1))
+    return [
+        (seq, [(state_id, {'id': seq, **event}) for _, _, state_id, event in group])
+        for seq, group in itertools.groupby(changes, key=itemgetter(0))
+    ]
+
+
+class EventBroker:
+
+    def __init__(self, poll_interval=None):
+        self.poll_interval = poll_interval or EVENTS_POLL_INTERVAL
+        self.background = True  # Tests turn this off and call poll() themselves
+        self.lock = threading.Lock()
+        self.poll_lock = threading.Lock()  # Taken before ``lock`` when both are needed
+        self.by_state = {}  # state id -> subscriptions
+        self.unrestricted = set()
+        self.version = None  # Last change number published, None while nobody listens
+        self.thread = None
+
+    def __bool__(self):
+        return bool(self.by_state or self.unrestricted)
+
+    def subscribe(self, scope, queue_size=None):
+        """Subscribe the running event loop to the events inside ``scope``."""
+        subscription = Subscription(scope, asyncio.get_running_loop(), queue_size)
+        with self.lock:
+            if scope.unrestricted:
+                self.unrestricted.add(subscription)
+            for state_id in subscription.state_ids or ():
+                self.by_state.setdefault(state_id, set()).add(subscription)
+            if self.background and self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='pipeapp-events', daemon=True)
+                self.thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.unrestricted.discard(subscription)
+            for state_id in subscription.state_ids or ():
+                subscriptions = self.by_state.get(state_id, set())
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    self.by_state.pop(state_id, None)
+
+    def ensure_version(self):
+        """The change number up to which subscribers have been sent everything."""
+        with self.poll_lock:
+            if self.version is None:
+                self.version = change_horizon()[0]
+            return self.version
+
+    def replay(self, subscription, last_event_id=None):
+        """
+        The batches a subscriber reconnecting after ``last_event_id`` missed,
+        up to those the poller will send it, or just RESYNC when they can't be sent.
+        """
+        version = self.ensure_version()
+        if not last_event_id:
+            return []
+        current, pruned_through = change_horizon()
+        try:
+            since = decode_cursor(last_event_id, subscription.scope)
+        except ValueError:
+            since = None
+        if since is None or not pruned_through <= since <= current:
+            return [RESYNC]
+        # This process may not have published as far as the one the client was connected to
+        subscription.skip_through = since
+        if since >= version:
+            return []
+        batches = load_events(since, version, subscription.scope, limit=subscription.queue.maxsize)
+        return [RESYNC] if batches is None else batches
+
+    def poll(self):
+        """Publish the changes committed since the last poll."""
+        with self.poll_lock:
+            if not self:
+                return
+            current, _ = change_horizon()
+            if self.version is None or current == self.version:
+                self.version = current
+                return
+            batches = load_events(self.version, current) if current > self.version else None
+            self.version = current
+            if batches is None:
+                # Too far behind, or the database was restored
+                self.resync()
+                return
+            for seq, events in batches:
+                self.publish(seq, events)
+
+    def publish(self, seq, events):
+        """Send each subscriber the ``(state id, event)`` pairs of change ``seq`` inside its scope."""
+        matching = {}
+        with self.lock:
+            for state_id, event in events:
+                for subscription in itertools.chain(self.unrestricted, self.by_state.get(state_id, ())):
+                    matching.setdefault(subscription, []).append(event)
+        for subscription, subscription_events in matching.items():
+            self.offer(subscription, (seq, subscription_events))
+
+    def resync(self):
+        with self.lock:
+            subscriptions = [*self.unrestricted, *itertools.chain.from_iterable(self.by_state.values())]
+        for subscription in set(subscriptions):
+            self.offer(subscription, RESYNC)
+
+    def offer(self, subscription, batch):
+        try:
+            subscription.offer(batch)
+        except RuntimeError:
+            # The subscriber's event loop has closed
+            self.unsubscribe(subscription)
+
+    def run(self):
+        try:
+            while True:
+                with self.poll_lock, self.lock:
+                    if not (self.by_state or self.unrestricted):
+                        # The next subscriber starts from the counter as it then is
+                        self.thread = self.version = None
+                        return
+                close_old_connections()
+                try:
+                    self.poll()
+                except DatabaseError:
+                    logger.warning('Reading the change sequence for events failed', exc_info=True)
+                time.sleep(self.poll_interval)
+        finally:
+            connections.close_all()
+
+
+broker = EventBroker()
+
+
+def format_batch(seq, events, scope):
+    frames = [f"event: {event['type']}\ndata: {json.dumps(event)}\n" for event in events]
+    if seq is not None:
+        # Only the last event moves the client's Last-Event-ID, so one cut off mid-change gets all of it again
+        frames[-1] += f'id: {encode_cursor(seq, scope)}\n'
+    return ''.join(frame + '\n' for frame in frames)
+
+
+async def event_stream(subscription, replay=(), keepalive=None, authorize=None):
+    """
+    The frames of ``subscription``. Every ``keepalive`` seconds ``authorize`` is
+    awaited for the caller's current scope: the stream ends once it returns None,
+    and follows a changed scope from then on, telling the client to resync.
+    """
+    keepalive = keepalive or EVENTS_KEEPALIVE
+    loop = asyncio.get_running_loop()
+    try:
+        # Clients wait five seconds before reconnecting
+        yield 'retry: 5000\n\n'
+        for seq, events in replay:
+            yield format_batch(seq, events, subscription.scope)
+        check_at = loop.time() + keepalive
+        while True:
+            batch = await subscription.get(keepalive)
+            if authorize is not None and loop.time() >= check_at:
+                check_at = loop.time() + keepalive
+                scope = await authorize()
+                if scope is None:
+                    yield format_batch(*REVOKED, subscription.scope)
+                    return
+                if scope != subscription.scope:
+                    broker.unsubscribe(subscription)
+                    subscription = broker.subscribe(scope)
+                    yield format_batch(*RESYNC, scope)
+                    continue
+            if subscription.lost:
+                subscription.lost = 0
+                yield format_batch(*RESYNC, subscription.scope)
+            if batch is None:
+                yield ': keepalive\n\n'  # Keeps proxies from closing an idle connection
+            elif batch[0] is None or batch[0] > subscription.skip_through:
+                yield format_batch(*batch, subscription.scope)
+    finally:
+        broker.unsubscribe(subscription)
+
+
+async def fault_events(request):
+    """
+    Server-sent events for the faults and routes inside the caller's role scope:
+    route.changed, route.deleted, fault.changed and fault.deleted. Reconnect with
+    Last-Event-ID to be sent what was missed.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({'detail': 'Live events are only served through pipeline.asgi.'}, status=501)
+    authentication = CachingTokenAuthentication()
+    try:
+        credentials = await authentication.aauthenticate(request)
+    except AuthenticationFailed as exc:
+        return JsonResponse({'detail': str(exc.detail)}, status=401)
+    if credentials is None:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+    scope = await aresolve_scope(credentials[0])
+    key = credentials[1].key
+
+    async def authorize():
+        # Logging out, deleting the token or deactivating the user revokes an open stream too
+        try:
+            user, _ = await authentication.aauthenticate_credentials(key)
+            return await aresolve_scope(user)
+        except (AuthenticationFailed, Profile.DoesNotExist):
+            return None
+
+    subscription = broker.subscribe(scope)
+    try:
+        replay = await sync_to_async(broker.replay)(subscription, request.headers.get('Last-Event-ID'))
+    except BaseException:
+        broker.unsubscribe(subscription)
+        raise
+    response = StreamingHttpResponse(event_stream(subscription, replay, authorize=authorize), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Stops nginx buffering the stream
+    return response
@@ -0,0 +1,118 @@
+import math
+
+from django.db.models import FloatField, Value
+from django.db.models.functions import ASin, Cos, Least, Power, Radians, Sin, Sqrt
+from rest_framework.exceptions import ValidationError
+
+from .geometry import EARTH_RADIUS_M, bounding_box_around
+
+# Largest ?radius= accepted, in metres
+MAX_RADIUS = 50_000
+
+
+def parse_bbox(value, param='bbox'):
+    """Parse ``min_lon,min_lat,max_lon,max_lat`` (GeoJSON order) into floats."""
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(part) for part in value.split(','))
+    except ValueError:
+        raise ValidationError({param: 'Expected min_lon,min_lat,max_lon,max_lat.'})
+    if not (-180 <= min_lon <= max_lon <= 180 and -90 <= min_lat <= max_lat <= 90):
+        raise ValidationError({param: 'Bounding box is out of range or inverted.'})
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def parse_point(value, param):
+    """Parse ``lat,lon`` into floats."""
+    try:
+        latitude, longitude = (float(part) for part in (value or '').split(','))
+    except ValueError:
+        raise ValidationError({param: 'Expected lat,lon.'})
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValidationError({param: 'Point is out of range.'})
+    return latitude, longitude
+
+
+def parse_distance(value, param, required=True):
+    """Parse a distance in metres up to MAX_RADIUS."""
+    if value is None and not required:
+        return None
+    try:
+        distance = float(value)
+    except (TypeError, ValueError):
+        raise ValidationError({param: 'Expected a distance in metres.'})
+    if not 0 < distance <= MAX_RADIUS:
+        raise ValidationError({param: f'Expected a distance between 0 and {MAX_RADIUS} metres.'})
+    return distance
+
+
+def parse_near(value, radius):
+    """Parse ``?near=lat,lon&radius=<metres>``."""
+    latitude, longitude = parse_point(value, 'near')
+    return latitude, longitude, parse_distance(radius, 'radius')
+
+
+def parse_length_range(params):
+    """``(min_length, max_length)`` in metres from ``?min_length=&max_length=``, either may be None."""
+    bounds = []
+    for param in ('min_length', 'max_length'):
+        value = params.get(param)
+        if value in (None, ''):
+            bounds.append(None)
+            continue
+        try:
+            value = float(value)
+        except ValueError:
+            raise ValidationError({param: 'Expected a length in metres.'})
+        if value < 0:
+            raise ValidationError({param: 'Length cannot be negative.'})
+        bounds.append(value)
+    if None not in bounds and bounds[0] > bounds[1]:
+        raise ValidationError({'min_length': 'min_length is greater than max_length.'})
+    return tuple(bounds)
+
+
+def filter_routes_by_length(queryset, min_length=None, max_length=None):
+    if min_length is not None:
+        queryset = queryset.filter(length_m__gte=min_length)
+    if max_length is not None:
+        queryset = queryset.filter(length_m__lte=max_length)
+    return queryset
+
+
+def filter_routes_in_bbox(queryset, bbox):
+    """Routes whose stored bounding box intersects ``bbox``."""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return queryset.filter(
+        min_latitude__lte=max_lat, max_latitude__gte=min_lat,
+        min_longitude__lte=max_lon, max_longitude__gte=min_lon,
+    )
+
+
+def filter_faults_in_bbox(queryset, bbox):
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return queryset.filter(
+        latitude__gte=min_lat, latitude__lte=max_lat,
+        longitude__gte=min_lon, longitude__lte=max_lon,
+    )
+
+
+def distance_from(latitude, longitude):
+    """Great circle distance in metres from a point to a fault's location, as a SQL expression."""
+    lat1 = math.radians(latitude)
+    lat2 = Radians('latitude', output_field=FloatField())
+    dlat = lat2 - Value(lat1)
+    dlon = Radians('longitude', output_field=FloatField()) - Value(math.radians(longitude))
+    a = Power(Sin(dlat / 2), 2) + Value(math.cos(lat1)) * Cos(lat2) * Power(Sin(dlon / 2), 2)
+    return Value(2 * EARTH_RADIUS_M) * ASin(Sqrt(Least(a, Value(1.0))))
+
+
+def filter_faults_near(queryset, latitude, longitude, radius):
+    """
+    Faults within ``radius`` metres of a point, annotated with their ``distance``.
+
+    The indexed latitude/longitude columns narrow the candidates to the
+    enclosing bounding box, and the database computes the exact distance of
+    those only, so filtering and pagination stay in the query.
+    """
+    candidates = filter_faults_in_bbox(queryset, bounding_box_around(latitude, longitude, radius))
+    return candidates.annotate(distance=distance_from(latitude, longitude)).filter(distance__lte=radius)
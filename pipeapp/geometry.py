@@ -0,0 +1,263 @@
+"""
+Packed storage for route geometry.
+
+Coordinates are stored as fixed point integers (1e-7 degree, about a
+centimetre) and delta encoded, latitude and longitude interleaved, then
+deflated. Consecutive vertices of a pipeline are close together so the
+deltas are small and compress well; a route costs a few bytes per vertex
+instead of the ~50 bytes of a ``{"latitude": .., "longitude": ..}`` dict.
+
+Layout: one version byte followed by the zlib stream of little-endian
+int64 deltas ``lat0, lon0, dlat1, dlon1, ...``.
+"""
+import base64
+import sys
+import zlib
+from array import array
+from itertools import accumulate
+
+import numpy as np
+
+GEOMETRY_VERSION = 1
+COORDINATE_SCALE = 10_000_000
+EARTH_RADIUS_M = 6_371_008.8
+
+EMPTY_GEOMETRY = bytes([GEOMETRY_VERSION])
+
+
+def normalize_coordinates(coordinates):
+    """
+    Validate a list of ``{latitude, longitude}`` dicts and return it as floats.
+    The original ``{start, end}`` object is accepted as a two point route.
+    """
+    if isinstance(coordinates, dict) and set(coordinates) == {'start', 'end'}:
+        coordinates = [coordinates['start'], coordinates['end']]
+    if not isinstance(coordinates, (list, tuple)):
+        raise ValueError('Coordinates must be a list of {latitude, longitude} objects.')
+    normalized = []
+    for index, point in enumerate(coordinates):
+        try:
+            latitude = float(point['latitude'])
+            longitude = float(point['longitude'])
+        except (TypeError, KeyError, ValueError):
+            raise ValueError(f'Coordinate {index} must have numeric latitude and longitude.')
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise ValueError(f'Coordinate {index} is out of range.')
+        normalized.append({'latitude': latitude, 'longitude': longitude})
+    return normalized
+
+
+def _pack(values):
+    packed = array('q', values)
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _unpack(data):
+    values = array('q')
+    values.frombytes(data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def encode_fixed(lats, lons):
+    """Pack fixed point latitude and longitude sequences."""
+    deltas = []
+    previous_lat = previous_lon = 0
+    for lat, lon in zip(lats, lons):
+        deltas.append(lat - previous_lat)
+        deltas.append(lon - previous_lon)
+        previous_lat, previous_lon = lat, lon
+    if not deltas:
+        return EMPTY_GEOMETRY
+    return bytes([GEOMETRY_VERSION]) + zlib.compress(_pack(deltas))
+
+
+def encode_coordinates(coordinates):
+    """Pack a list of ``{latitude, longitude}`` dicts into the stored representation."""
+    points = normalize_coordinates(coordinates)
+    return encode_fixed(
+        [round(point['latitude'] * COORDINATE_SCALE) for point in points],
+        [round(point['longitude'] * COORDINATE_SCALE) for point in points],
+    )
+
+
+def decode_fixed(data):
+    """Return the fixed point latitude and longitude sequences of a stored geometry."""
+    data = bytes(data or b'')
+    if len(data) <= 1:
+        return [], []
+    if data[0] != GEOMETRY_VERSION:
+        raise ValueError(f'Unsupported geometry version {data[0]}.')
+    deltas = _unpack(zlib.decompress(data[1:]))
+    return list(accumulate(deltas[0::2])), list(accumulate(deltas[1::2]))
+
+
+def geometry_bounds(data):
+    """``(min_lat, max_lat, min_lon, max_lon)`` of a stored geometry, all None when empty."""
+    lats, lons = decode_fixed(data)
+    if not lats:
+        return None, None, None, None
+    return (
+        min(lats) / COORDINATE_SCALE, max(lats) / COORDINATE_SCALE,
+        min(lons) / COORDINATE_SCALE, max(lons) / COORDINATE_SCALE,
+    )
+
+
+def decode_coordinates(data, precision=None):
+    """
+    Unpack a stored geometry into the API's list of ``{latitude, longitude}`` dicts,
+    optionally quantized to ``precision`` decimal places.
+    """
+    lats, lons = decode_fixed(data)
+    if precision is not None:
+        return [
+            {'latitude': round(lat / COORDINATE_SCALE, precision), 'longitude': round(lon / COORDINATE_SCALE, precision)}
+            for lat, lon in zip(lats, lons)
+        ]
+    return [
+        {'latitude': lat / COORDINATE_SCALE, 'longitude': lon / COORDINATE_SCALE}
+        for lat, lon in zip(lats, lons)
+    ]
+
+
+def simplify_fixed(lats, lons, tolerance):
+    """
+    Douglas-Peucker simplification of fixed point sequences.
+
+    ``tolerance`` is in degrees; vertices closer than that to the simplified
+    line are dropped. The first and last vertex are always kept.
+    """
+    count = len(lats)
+    if count < 3:
+        return list(lats), list(lons)
+    tolerance_sq = (tolerance * COORDINATE_SCALE) ** 2
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        start, end = stack.pop()
+        ax, ay = lons[start], lats[start]
+        dx, dy = lons[end] - ax, lats[end] - ay
+        segment_sq = dx * dx + dy * dy
+        farthest, farthest_sq = None, tolerance_sq
+        for i in range(start + 1, end):
+            px, py = lons[i] - ax, lats[i] - ay
+            if segment_sq:
+                t = max(0.0, min(1.0, (px * dx + py * dy) / segment_sq))
+                px -= t * dx
+                py -= t * dy
+            distance_sq = px * px + py * py
+            if distance_sq > farthest_sq:
+                farthest, farthest_sq = i, distance_sq
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((start, farthest))
+            stack.append((farthest, end))
+    return (
+        [lat for lat, kept in zip(lats, keep) if kept],
+        [lon for lon, kept in zip(lons, keep) if kept],
+    )
+
+
+def simplify_geometry(data, tolerance):
+    """Simplify a stored geometry, returning the packed result and its vertex count."""
+    lats, lons = simplify_fixed(*decode_fixed(data), tolerance)
+    return encode_fixed(lats, lons), len(lats)
+
+
+def zoom_tolerance(zoom, tile_size=256):
+    """Degrees covered by one pixel at a web map zoom level, at the equator."""
+    return 360.0 / (tile_size * 2 ** zoom)
+
+
+def _polyline_value(value):
+    value = ~(value << 1) if value < 0 else value << 1
+    chunks = []
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
+    return ''.join(chunks)
+
+
+def encode_polyline(data, precision=5):
+    """Encode a stored geometry in Google's encoded polyline format."""
+    lats, lons = decode_fixed(data)
+    divisor = COORDINATE_SCALE // 10 ** precision
+    output = []
+    previous_lat = previous_lon = 0
+    for lat, lon in zip(lats, lons):
+        lat = round(lat / divisor)
+        lon = round(lon / divisor)
+        output.append(_polyline_value(lat - previous_lat))
+        output.append(_polyline_value(lon - previous_lon))
+        previous_lat, previous_lon = lat, lon
+    return ''.join(output)
+
+
+def encode_base64(data):
+    return base64.b64encode(bytes(data or EMPTY_GEOMETRY)).decode('ascii')
+
+
+def point_location(point):
+    """``(latitude, longitude)`` of a ``{latitude, longitude}`` dict, or ``(None, None)``."""
+    try:
+        latitude = float(point['latitude'])
+        longitude = float(point['longitude'])
+    except (TypeError, KeyError, ValueError):
+        return None, None
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None, None
+    return latitude, longitude
+
+
+def haversine(latitude, longitude, latitudes, longitudes):
+    """Great circle distances in metres from one point to arrays of points."""
+    lat1 = np.radians(latitude)
+    lat2 = np.radians(np.asarray(latitudes, dtype=float))
+    dlat = lat2 - lat1
+    dlon = np.radians(np.asarray(longitudes, dtype=float) - longitude)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def encode_distances(values):
+    """Pack a sequence of distances in metres as little-endian float64."""
+    return np.asarray(values, dtype='<f8').tobytes()
+
+
+def decode_distances(data):
+    return np.frombuffer(bytes(data or b''), dtype='<f8')
+
+
+def route_metrics(data):
+    """
+    Geodesic metrics of a stored geometry: ``(length_m, segment_count, cumulative)``
+    where ``cumulative`` is the packed distance along the route at every vertex.
+    """
+    lats, lons = decode_fixed(data)
+    if not lats:
+        return 0.0, 0, b''
+    lats = np.radians(np.asarray(lats, dtype=float) / COORDINATE_SCALE)
+    lons = np.radians(np.asarray(lons, dtype=float) / COORDINATE_SCALE)
+    # All segments at once, vertex i to vertex i + 1
+    dlat = np.diff(lats)
+    dlon = np.diff(lons)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lats[:-1]) * np.cos(lats[1:]) * np.sin(dlon / 2) ** 2
+    lengths = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+    cumulative = np.concatenate(([0.0], np.cumsum(lengths)))
+    return float(cumulative[-1]), len(lengths), encode_distances(cumulative)
+
+
+def bounding_box_around(latitude, longitude, radius):
+    """``(min_lon, min_lat, max_lon, max_lat)`` enclosing a circle of ``radius`` metres."""
+    dlat = np.degrees(radius / EARTH_RADIUS_M)
+    cos_lat = np.cos(np.radians(latitude))
+    dlon = 180.0 if cos_lat < 1e-9 else min(180.0, float(np.degrees(radius / (EARTH_RADIUS_M * cos_lat))))
+    return (
+        max(-180.0, longitude - dlon), max(-90.0, latitude - dlat),
+        min(180.0, longitude + dlon), min(90.0, latitude + dlat),
+    )
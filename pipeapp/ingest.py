@@ -0,0 +1,334 @@
+"""
+Bulk route and fault ingestion.
+
+Rows are consumed from any iterable of ``(line number, data, error)`` in
+batches. Each row is validated and its derived geometry computed in memory
+(``prepare_row``, which is self contained so it can run in a worker process),
+then the batch is checked against the database with one query for its state
+names and one for its route names, and inserted with bulk_create inside its
+own transaction. A failing row is reported and skipped without affecting the
+rest of its batch; a batch the database rejects is rolled back and reported
+as a whole.
+"""
+import codecs
+import csv
+import json
+import re
+from collections import namedtuple
+from itertools import islice
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import FAULT_STATUS_CHOICES, PipelineFault, PipelineRoute, PipelineRouteSimplification, State
+from .serializers import RouteIngestSerializer
+from .signals import faults_bulk_created, routes_bulk_created
+from .versions import bump_versions
+
+INGEST_BATCH_SIZE = getattr(settings, 'PIPEAPP_INGEST_BATCH_SIZE', 500)
+MAX_INGEST_BATCH_SIZE = 5000
+
+# A validated route with its geometry derived fields and simplifications filled in
+PreparedRoute = namedtuple('PreparedRoute', 'line name state route simplifications errors')
+
+
+class IngestReport:
+
+    def __init__(self):
+        self.received = 0
+        self.created = 0
+        self.skipped = 0
+        self.errors = []
+
+    def fail(self, line, errors, name=None):
+        self.errors.append({'line': line, 'name': name, 'errors': errors})
+
+    def as_dict(self):
+        return {
+            'received': self.received,
+            'created': self.created,
+            'failed': len(self.errors),
+            'errors': self.errors,
+        }
+
+
+def batched(rows, size):
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+
+def ingest_routes(rows, batch_size=None, state_ids=None, report=None):
+    """
+    Insert routes from ``(line, data, error)`` rows and return an IngestReport.
+    ``state_ids`` restricts the states routes may be filed under, None allows any.
+    """
+    report = report or IngestReport()
+    for batch in batched(rows, batch_size or INGEST_BATCH_SIZE):
+        report.received += len(batch)
+        ingest_batch(batch, report, state_ids)
+    return report
+
+
+def ingest_batch(batch, report, state_ids=None, skip_existing=False):
+    insert_prepared([prepare_row(row) for row in batch], report, state_ids, skip_existing)
+
+
+def prepare_row(row):
+    line, data, error = row
+    if error:
+        return PreparedRoute(line, None, None, None, None, {'non_field_errors': [error]})
+    serializer = RouteIngestSerializer(data=data)
+    if not serializer.is_valid():
+        name = data.get('name') if isinstance(data, dict) else None
+        return PreparedRoute(line, name, None, None, None, serializer.errors)
+    row = serializer.validated_data
+    route = PipelineRoute(name=row['name'], coordinates=row['coordinates'])
+    route.refresh_geometry_fields()
+    return PreparedRoute(line, row['name'], row['state'], route, route.build_simplifications(), None)
+
+
+def insert_prepared(prepared, report, state_ids=None, skip_existing=False):
+    """
+    Insert a batch of PreparedRoutes. Names that already exist are reported as
+    errors, or only counted in ``report.skipped`` with ``skip_existing``.
+    """
+    valid = []
+    for item in prepared:
+        if item.errors:
+            report.fail(item.line, item.errors, name=item.name)
+        else:
+            valid.append(item)
+    if not valid:
+        return
+
+    names = {item.name for item in valid}
+    states = {state.name: state for state in State.objects.filter(name__in={item.state for item in valid})}
+    existing = set(PipelineRoute.objects.filter(name__in=names).values_list('name', flat=True))
+
+    accepted, seen = [], set()
+    for item in valid:
+        state = states.get(item.state)
+        if item.name in existing and skip_existing:
+            report.skipped += 1
+        elif item.name in existing or item.name in seen:
+            report.fail(item.line, {'name': ['A pipeline route with this name already exists.']}, name=item.name)
+        elif state is None:
+            report.fail(item.line, {'state': [f"State '{item.state}' does not exist."]}, name=item.name)
+        elif state_ids is not None and state.pk not in state_ids:
+            report.fail(item.line, {'state': [f"State '{state.name}' is outside your scope."]}, name=item.name)
+        else:
+            item.route.state = state
+            accepted.append(item)
+        seen.add(item.name)
+    if not accepted:
+        return
+
+    routes = [item.route for item in accepted]
+    try:
+        with transaction.atomic():
+            PipelineRoute.objects.bulk_create(routes)
+            PipelineRouteSimplification.objects.bulk_create(
+                [level for item in accepted for level in item.simplifications]
+            )
+            routes_bulk_created.send(sender=PipelineRoute, instances=routes)
+    except DatabaseError as exc:
+        # e.g. a route of the same name inserted concurrently
+        for item in accepted:
+            report.fail(item.line, {'non_field_errors': [f'Batch rejected by the database: {exc}']}, name=item.name)
+        return
+    report.created += len(routes)
+
+
+FEATURES_ARRAY = re.compile(r'"features"\s*:\s*\[')
+
+
+def iter_geojson_features(stream, read_size=1 << 16):
+    """
+    Yield ``(index, feature)`` from a GeoJSON FeatureCollection file object without
+    reading it whole: the text is scanned up to the ``features`` array, then one
+    feature at a time is decoded with ``raw_decode`` from a rolling buffer.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer, eof = '', False
+
+    def fill():
+        nonlocal buffer, eof
+        # Read at least as much as is buffered, so a feature larger than read_size
+        # is re-scanned a logarithmic rather than linear number of times
+        chunk = stream.read(max(read_size, len(buffer)))
+        eof = not chunk
+        if isinstance(chunk, bytes):
+            chunk = utf8.decode(chunk, final=eof)
+        buffer += chunk
+
+    while not (match := FEATURES_ARRAY.search(buffer)):
+        if eof:
+            raise ValueError('No "features" array found; expected a GeoJSON FeatureCollection.')
+        fill()
+    buffer = buffer[match.end():]
+
+    index = 0
+    while True:
+        stripped = buffer.lstrip().lstrip(',').lstrip()
+        if not stripped and not eof:
+            buffer = stripped
+            fill()
+            continue
+        if stripped.startswith(']'):
+            return
+        if not stripped:
+            raise ValueError('Unexpected end of file inside the "features" array.')
+        try:
+            feature, end = decoder.raw_decode(stripped)
+        except json.JSONDecodeError:
+            if eof:
+                raise ValueError(f'Invalid JSON in feature {index}.')
+            # The feature continues past the buffer
+            buffer = stripped
+            fill()
+            continue
+        buffer = stripped[end:]
+        yield index, feature
+        index += 1
+
+
+def feature_row(item):
+    """Turn an ``(index, feature)`` pair into an ingestion row; features are numbered from 1."""
+    index, feature = item
+    line = index + 1
+    try:
+        properties = feature.get('properties') or {}
+        geometry = feature['geometry']
+        if geometry['type'] == 'MultiLineString' and len(geometry['coordinates']) == 1:
+            positions = geometry['coordinates'][0]
+        elif geometry['type'] == 'LineString':
+            positions = geometry['coordinates']
+        else:
+            return line, None, f"Unsupported geometry type {geometry['type']}; expected a LineString."
+        # GeoJSON positions are [longitude, latitude]
+        coordinates = [{'latitude': position[1], 'longitude': position[0]} for position in positions]
+    except (AttributeError, KeyError, IndexError, TypeError):
+        return line, None, 'Expected a Feature with a LineString geometry.'
+    return line, {'name': properties.get('name'), 'state': properties.get('state'), 'coordinates': coordinates}, None
+
+
+FAULT_STATUSES = {value for value, _ in FAULT_STATUS_CHOICES}
+
+
+def iter_fault_rows(stream):
+    """
+    Yield ``(line, data, error)`` from a CSV fault log with a header row of
+    ``route, latitude, longitude`` and optionally ``status, description, reported_at``.
+    """
+    reader = csv.DictReader(stream)
+    missing = {'route', 'latitude', 'longitude'} - set(reader.fieldnames or ())
+    if missing:
+        raise ValueError(f"Missing CSV columns: {', '.join(sorted(missing))}.")
+    for record in reader:
+        line = reader.line_num
+        try:
+            latitude, longitude = float(record['latitude']), float(record['longitude'])
+        except (TypeError, ValueError):
+            yield line, None, 'latitude and longitude must be numbers.'
+            continue
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            yield line, None, 'Coordinates are out of range.'
+            continue
+        status = (record.get('status') or 'normal').strip().lower()
+        if status not in FAULT_STATUSES:
+            yield line, None, f"Unknown status '{status}'."
+            continue
+        reported_at = None
+        if record.get('reported_at'):
+            try:
+                reported_at = parse_datetime(record['reported_at'].strip())
+            except ValueError:
+                reported_at = None
+            if reported_at is None:
+                yield line, None, f"Invalid reported_at '{record['reported_at']}'."
+                continue
+            if timezone.is_naive(reported_at):
+                reported_at = timezone.make_aware(reported_at)
+        yield line, {
+            'route': record['route'],
+            'fault_coordinates': {'latitude': latitude, 'longitude': longitude},
+            'status': status,
+            'description': record.get('description') or None,
+            'reported_at': reported_at,
+        }, None
+
+
+def ingest_faults(rows, batch_size=None, report=None):
+    """Insert faults from ``(line, data, error)`` rows, batched like ingest_routes."""
+    report = report or IngestReport()
+    for batch in batched(rows, batch_size or INGEST_BATCH_SIZE):
+        report.received += len(batch)
+        ingest_fault_batch(batch, report)
+    return report
+
+
+def ingest_fault_batch(batch, report):
+    valid = []
+    for line, data, error in batch:
+        if error:
+            report.fail(line, {'non_field_errors': [error]})
+        else:
+            valid.append((line, data))
+    if not valid:
+        return
+
+    routes = dict(PipelineRoute.objects.filter(name__in={data['route'] for _, data in valid}).values_list('name', 'id'))
+    faults, historical = [], []
+    for line, data in valid:
+        route_id = routes.get(data['route'])
+        if route_id is None:
+            report.fail(line, {'route': [f"Route '{data['route']}' does not exist."]}, name=data['route'])
+            continue
+        fault = PipelineFault(
+            pipeline_route_id=route_id, fault_coordinates=data['fault_coordinates'],
+            status=data['status'], description=data['description'],
+        )
+        fault.refresh_location()
+        faults.append(fault)
+        if data['reported_at'] is not None:
+            historical.append((fault, data['reported_at']))
+    if not faults:
+        return
+
+    try:
+        create_faults(faults, historical)
+    except DatabaseError as exc:
+        for line, data in valid:
+            report.fail(line, {'non_field_errors': [f'Batch rejected by the database: {exc}']}, name=data['route'])
+        return
+    report.created += len(faults)
+
+
+def create_faults(faults, reported_at=()):
+    """
+    bulk_create ``faults`` in one transaction and refresh the fault summaries of
+    their routes. ``reported_at`` holds ``(fault, datetime)`` pairs for faults
+    whose report time is known, which auto_now_add would otherwise overwrite.
+    """
+    route_ids = {fault.pipeline_route_id for fault in faults}
+    with transaction.atomic():
+        state_ids = set(PipelineRoute.objects.filter(pk__in=route_ids).values_list('state_id', flat=True))
+        PipelineFault.objects.bulk_create(faults)
+        # reported_at is auto_now_add, so known times are written after the insert
+        historical = []
+        for fault, value in reported_at:
+            fault.reported_at = value
+            historical.append(fault)
+        PipelineFault.objects.bulk_update(historical, ['reported_at'])
+        # bulk_create skips the fault signals, so refresh the stored summaries directly
+        summaries = PipelineRoute.fault_summaries(route_ids)
+        PipelineRoute.objects.bulk_update([
+            PipelineRoute(pk=route_id, **summaries.get(route_id, PipelineRoute.empty_fault_summary()))
+            for route_id in route_ids
+        ], PipelineRoute.SUMMARY_FIELDS)
+        bump_versions(state_ids=state_ids)
+        faults_bulk_created.send(sender=PipelineFault, instances=faults)
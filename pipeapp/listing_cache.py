@@ -0,0 +1,83 @@
+"""
+Shared cache of rendered route listings.
+
+Listings are stored as the rendered bytes under their ``listing_key``, so
+every user whose scope covers the same states gets one serialization per
+data version, query and media type. Entries need no explicit invalidation:
+the route, fault and state signals bump the versions the key is derived
+from, and entries of older versions are never read again and expire after
+PIPEAPP_LISTING_CACHE_TIMEOUT seconds.
+
+A missing entry is built by one worker at a time. The first to miss takes a
+lock in the cache; the others poll for the entry it stores and only build
+it themselves if the lock holder hasn't finished within
+PIPEAPP_LISTING_CACHE_LOCK_TIMEOUT seconds. Entries and locks are shared
+between workers when PIPEAPP_LISTING_CACHE_ALIAS names a shared cache.
+``acached_listing`` does the same through the async cache API, for views
+running on the event loop; its waiters sleep without holding a thread.
+"""
+import asyncio
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+LISTING_CACHE_ALIAS = getattr(settings, 'PIPEAPP_LISTING_CACHE_ALIAS', 'default')
+LISTING_CACHE_TIMEOUT = getattr(settings, 'PIPEAPP_LISTING_CACHE_TIMEOUT', 300)
+LISTING_CACHE_LOCK_TIMEOUT = getattr(settings, 'PIPEAPP_LISTING_CACHE_LOCK_TIMEOUT', 10)
+POLL_INTERVAL = 0.05
+
+
+def cached_listing(key, build, lock_timeout=None):
+    """Return ``(content, hit)``, calling ``build()`` for the content when ``key`` isn't cached."""
+    cache = caches[LISTING_CACHE_ALIAS]
+    entry_key = f'pipeapp:listing:{key}'
+    content = cache.get(entry_key)
+    if content is not None:
+        return content, True
+
+    lock_timeout = lock_timeout or LISTING_CACHE_LOCK_TIMEOUT
+    lock_key = f'{entry_key}:lock'
+    deadline = time.monotonic() + lock_timeout
+    while not cache.add(lock_key, True, lock_timeout):
+        # Another worker is building this entry, wait for it rather than build it again
+        if time.monotonic() >= deadline:
+            return build(), False
+        time.sleep(POLL_INTERVAL)
+        content = cache.get(entry_key)
+        if content is not None:
+            return content, True
+
+    try:
+        content = build()
+        cache.set(entry_key, content, LISTING_CACHE_TIMEOUT)
+    finally:
+        cache.delete(lock_key)
+    return content, False
+
+
+async def acached_listing(key, build, lock_timeout=None):
+    """``cached_listing`` for async views; ``build`` is a coroutine function."""
+    cache = caches[LISTING_CACHE_ALIAS]
+    entry_key = f'pipeapp:listing:{key}'
+    content = await cache.aget(entry_key)
+    if content is not None:
+        return content, True
+
+    lock_timeout = lock_timeout or LISTING_CACHE_LOCK_TIMEOUT
+    lock_key = f'{entry_key}:lock'
+    deadline = time.monotonic() + lock_timeout
+    while not await cache.aadd(lock_key, True, lock_timeout):
+        if time.monotonic() >= deadline:
+            return await build(), False
+        await asyncio.sleep(POLL_INTERVAL)
+        content = await cache.aget(entry_key)
+        if content is not None:
+            return content, True
+
+    try:
+        content = await build()
+        await cache.aset(entry_key, content, LISTING_CACHE_TIMEOUT)
+    finally:
+        await cache.adelete(lock_key)
+    return content, False
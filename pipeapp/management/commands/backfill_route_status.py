@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from pipeapp.changes import record_changes
+from pipeapp.models import PipelineRoute
+from pipeapp.versions import bump_versions
+
+class Command(BaseCommand):
+    help = 'Recompute the stored status and fault counters of every pipeline route'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of routes updated per query')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        summaries = PipelineRoute.fault_summaries()
+        empty = PipelineRoute.empty_fault_summary()
+
+        updated = 0
+        batch = []
+        routes = PipelineRoute.objects.only('id', *PipelineRoute.SUMMARY_FIELDS).order_by('id')
+        with transaction.atomic():
+            for route in routes.iterator(chunk_size=batch_size):
+                summary = summaries.get(route.pk, empty)
+                if all(getattr(route, field) == value for field, value in summary.items()):
+                    continue
+                for field, value in summary.items():
+                    setattr(route, field, value)
+                batch.append(route)
+                if len(batch) >= batch_size:
+                    PipelineRoute.objects.bulk_update(batch, PipelineRoute.SUMMARY_FIELDS)
+                    record_changes(route_ids=[route.pk for route in batch])
+                    bump_versions(route_ids=[route.pk for route in batch])
+                    updated += len(batch)
+                    batch = []
+            if batch:
+                PipelineRoute.objects.bulk_update(batch, PipelineRoute.SUMMARY_FIELDS)
+                record_changes(route_ids=[route.pk for route in batch])
+                bump_versions(route_ids=[route.pk for route in batch])
+                updated += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(f'Updated the fault summary of {updated} pipeline routes'))
@@ -0,0 +1,94 @@
+import json
+import platform
+from datetime import datetime, timezone
+
+import django
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from pipeapp import benchmarks
+
+class Command(BaseCommand):
+    help = 'Benchmark every pipeapp endpoint against seeded datasets in a throwaway test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,100,1000', help='Comma separated route counts to seed')
+        parser.add_argument('--faults-per-route', type=int, default=3)
+        parser.add_argument('--points-per-route', type=int, default=50)
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per scenario; wall time is the median')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+        parser.add_argument('--no-explain', action='store_true', help='Skip capturing EXPLAIN plans')
+        parser.add_argument('--include-sql', action='store_true', help='Keep the SQL of every scenario in the report')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',') if size]
+
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            # Hashing cost is not what this suite measures, and the default hasher would dominate it
+            with override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher']):
+                datasets = [self.run_size(size, options) for size in sizes]
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        report = {
+            'generated_at': datetime.now(timezone.utc).isoformat(),
+            'django': django.get_version(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'query_budgets': benchmarks.QUERY_BUDGETS,
+            'latency_budgets_ms': benchmarks.LATENCY_BUDGETS_MS,
+            'datasets': datasets,
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                handle.write(output)
+            self.stdout.write(self.style.SUCCESS(f"Wrote benchmark report to {options['output']}"))
+        else:
+            self.stdout.write(output)
+
+        for dataset in datasets:
+            for result in dataset['results']:
+                if result['latency_budget_ms'] and result['wall_ms'] > result['latency_budget_ms']:
+                    self.stderr.write(self.style.WARNING(
+                        f"{result['scenario']} ({dataset['routes']} routes): {result['wall_ms']:.1f} ms "
+                        f"> latency budget {result['latency_budget_ms']} ms"
+                    ))
+
+        failures = [
+            f"{result['scenario']} ({result['role'] or 'anonymous'}, {dataset['routes']} routes): "
+            f"{result['queries']} queries > budget {result['query_budget']}"
+            for dataset in datasets
+            for result in dataset['results']
+            if not result['within_budget']
+        ]
+        if failures:
+            raise CommandError('Query budget exceeded:\n' + '\n'.join(failures))
+
+    def run_size(self, size, options):
+        from django.core.management import call_command
+
+        call_command('flush', interactive=False, verbosity=0)
+        # Data versions start over with the data, so do cached listings
+        cache.clear()
+        dataset = benchmarks.seed_dataset(
+            size,
+            faults_per_route=options['faults_per_route'],
+            points_per_route=options['points_per_route'],
+        )
+        results = benchmarks.run_benchmarks(dataset, repeat=options['repeat'])
+        if not options['include_sql']:
+            for result in results:
+                result.pop('sql')
+        self.stderr.write(f'Benchmarked {len(results)} scenarios against {size} routes')
+        return {
+            'routes': size,
+            'faults_per_route': options['faults_per_route'],
+            'points_per_route': options['points_per_route'],
+            'results': results,
+            'explain': {} if options['no_explain'] else benchmarks.explain_plans(dataset),
+        }
@@ -0,0 +1,74 @@
+import json
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand, CommandError
+from pipeapp import benchmarks
+
+
+class Command(BaseCommand):
+    help = (
+        'Load running deployments with concurrent clients, some pulling 1000-route pages while the rest '
+        'poll, and compare throughput and tail latency, e.g. gunicorn WSGI workers against '
+        'pipeline/gunicorn_asgi.py serving the same database. With --writers, further clients update '
+        'faults meanwhile, measuring the writes serialized on the change counter row.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--target', action='append', required=True, metavar='NAME=URL',
+            help='Deployment to load, e.g. wsgi=http://127.0.0.1:8000; repeat to compare several',
+        )
+        parser.add_argument('--token', required=True, help='API token of a user whose scope has routes, national for the full load')
+        parser.add_argument('--concurrency', type=int, default=50, help='Simultaneous clients')
+        parser.add_argument('--slow-clients', type=int, default=5, help='Clients pulling 1000-route pages')
+        parser.add_argument(
+            '--writers', type=int, default=0,
+            help='Clients updating faults in the token\'s scope, each its own, on top of --concurrency',
+        )
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds each target is loaded')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        targets = []
+        for target in options['target']:
+            name, _, url = target.partition('=')
+            if not name or not url.startswith(('http://', 'https://')):
+                raise CommandError(f'Expected --target NAME=URL, got {target!r}.')
+            targets.append((name, url))
+        if options['concurrency'] < 1 or options['duration'] <= 0:
+            raise CommandError('--concurrency and --duration must be positive.')
+        if options['writers'] < 0:
+            raise CommandError('--writers cannot be negative.')
+
+        results = {}
+        for name, url in targets:
+            self.stderr.write(f"Loading {name} ({url}) with {options['concurrency']} clients for {options['duration']:g}s")
+            try:
+                results[name] = benchmarks.run_load(
+                    url, options['token'], options['concurrency'], options['duration'], options['slow_clients'],
+                    options['writers'],
+                )
+            except ValueError as exc:
+                raise CommandError(str(exc))
+            for scenario, result in results[name].items():
+                self.stderr.write(
+                    f"  {scenario:<18} {result['requests_per_second']:>8.1f} req/s  p50 {result['p50_ms']} ms  "
+                    f"p95 {result['p95_ms']} ms  p99 {result['p99_ms']} ms  errors {result['errors']}"
+                )
+
+        report = {
+            'generated_at': datetime.now(timezone.utc).isoformat(),
+            'concurrency': options['concurrency'],
+            'slow_clients': options['slow_clients'],
+            'writers': options['writers'],
+            'duration_s': options['duration'],
+            'targets': dict(targets),
+            'results': results,
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                handle.write(output)
+            self.stdout.write(self.style.SUCCESS(f"Wrote load report to {options['output']}"))
+        else:
+            self.stdout.write(output)
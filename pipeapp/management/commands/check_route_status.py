@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from pipeapp.models import PipelineRoute
+
+class Command(BaseCommand):
+    help = 'Report pipeline routes whose stored status or fault counters disagree with their faults'
+
+    def handle(self, *args, **options):
+        summaries = PipelineRoute.fault_summaries()
+        empty = PipelineRoute.empty_fault_summary()
+
+        mismatches = 0
+        routes = PipelineRoute.objects.only('id', 'name', *PipelineRoute.SUMMARY_FIELDS).order_by('id')
+        for route in routes.iterator(chunk_size=500):
+            summary = summaries.get(route.pk, empty)
+            stale = {
+                field: (getattr(route, field), value)
+                for field, value in summary.items()
+                if getattr(route, field) != value
+            }
+            if stale:
+                mismatches += 1
+                details = ', '.join(f'{field}: stored {stored!r}, actual {actual!r}' for field, (stored, actual) in stale.items())
+                self.stdout.write(f'{route.name} (id={route.pk}): {details}')
+
+        if mismatches:
+            raise CommandError(f'{mismatches} pipeline routes have a stale fault summary; run backfill_route_status to repair them')
+        self.stdout.write(self.style.SUCCESS('All pipeline route fault summaries are consistent'))
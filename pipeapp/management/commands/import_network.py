@@ -0,0 +1,173 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from pipeapp.ingest import (
+    INGEST_BATCH_SIZE, IngestReport, batched, feature_row, ingest_fault_batch, insert_prepared,
+    iter_fault_rows, iter_geojson_features, prepare_row,
+)
+
+# Seconds between progress lines at the default verbosity
+PROGRESS_INTERVAL = 5
+
+
+def prepare_rows(rows):
+    return [prepare_row(row) for row in rows]
+
+
+class Command(BaseCommand):
+    help = (
+        'Import pipeline routes from a GeoJSON FeatureCollection and faults from a CSV log, '
+        'streaming both files and committing in batches. Progress is checkpointed next to each '
+        'input, so an interrupted import resumes where it stopped when run again.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--routes', help='GeoJSON FeatureCollection of LineString features with name and state properties')
+        parser.add_argument('--faults', help='CSV with route, latitude and longitude columns, optionally status, description and reported_at')
+        parser.add_argument('--batch-size', type=int, default=INGEST_BATCH_SIZE, help='Rows committed per transaction')
+        parser.add_argument('--workers', type=int, default=0, help='Processes preparing route geometry in parallel, 0 to do it in this process')
+        parser.add_argument('--checkpoint-dir', help='Directory for checkpoint files, defaults to the directory of each input')
+        parser.add_argument('--restart', action='store_true', help='Ignore existing checkpoints and import from the first row')
+        parser.add_argument('--errors', help='Append rejected rows to this file as NDJSON')
+
+    def handle(self, *args, **options):
+        if not options['routes'] and not options['faults']:
+            raise CommandError('Nothing to import, pass --routes and/or --faults.')
+        if options['batch_size'] < 1 or options['workers'] < 0:
+            raise CommandError('--batch-size must be positive and --workers cannot be negative.')
+        self.options = options
+        self.errors_file = open(options['errors'], 'a', encoding='utf-8') if options['errors'] else None
+        try:
+            # Routes first, the fault log refers to routes by name
+            if options['routes']:
+                self.import_routes(options['routes'])
+            if options['faults']:
+                self.import_faults(options['faults'])
+        finally:
+            if self.errors_file:
+                self.errors_file.close()
+
+    def import_routes(self, path):
+        with open(path, 'rb') as stream:
+            try:
+                features = iter_geojson_features(stream)
+                self.run('routes', path, map(feature_row, features), self.insert_route_batches)
+            except ValueError as exc:
+                raise CommandError(f'{path}: {exc}')
+
+    def import_faults(self, path):
+        with open(path, newline='', encoding='utf-8') as stream:
+            try:
+                rows = iter_fault_rows(stream)
+                self.run('faults', path, rows, self.insert_fault_batches)
+            except ValueError as exc:
+                raise CommandError(f'{path}: {exc}')
+
+    def insert_route_batches(self, batches, report):
+        # Routes already in the database are skipped, so re-running an import is safe
+        for size, prepared in self.prepared_batches(batches):
+            insert_prepared(prepared, report, skip_existing=True)
+            yield size
+
+    def insert_fault_batches(self, batches, report):
+        for batch in batches:
+            ingest_fault_batch(batch, report)
+            yield len(batch)
+
+    def prepared_batches(self, batches):
+        """Yield ``(rows, prepared routes)`` per batch, preparing the next batch in the pool while one is inserted."""
+        workers = self.options['workers']
+        if not workers:
+            for batch in batches:
+                yield len(batch), prepare_rows(batch)
+            return
+        # Workers only validate and encode, they never touch the database
+        with ProcessPoolExecutor(workers, initializer=django.setup) as executor:
+            pending = None
+            for batch in batches:
+                size = -(-len(batch) // workers)
+                futures = [executor.submit(prepare_rows, batch[i:i + size]) for i in range(0, len(batch), size)]
+                if pending:
+                    yield pending[0], [item for future in pending[1] for item in future.result()]
+                pending = (len(batch), futures)
+            if pending:
+                yield pending[0], [item for future in pending[1] for item in future.result()]
+
+    def checkpoint_path(self, path):
+        directory = self.options['checkpoint_dir'] or os.path.dirname(os.path.abspath(path))
+        return os.path.join(directory, f'{os.path.basename(path)}.checkpoint.json')
+
+    def load_checkpoint(self, path, checkpoint_path):
+        stat = os.stat(path)
+        fresh = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime,
+                 'done': 0, 'created': 0, 'skipped': 0, 'failed': 0, 'completed': False}
+        if self.options['restart'] or not os.path.exists(checkpoint_path):
+            return fresh
+        with open(checkpoint_path, encoding='utf-8') as handle:
+            checkpoint = json.load(handle)
+        if (checkpoint.get('size'), checkpoint.get('mtime')) != (stat.st_size, stat.st_mtime):
+            raise CommandError(f'{path} changed since {checkpoint_path} was written, pass --restart to import it again.')
+        return checkpoint
+
+    def save_checkpoint(self, checkpoint_path, checkpoint):
+        # Written to a temporary file and renamed, so an interruption never leaves it half written
+        temporary = f'{checkpoint_path}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as handle:
+            json.dump(checkpoint, handle)
+        os.replace(temporary, checkpoint_path)
+
+    def run(self, label, path, rows, insert_batches):
+        checkpoint_path = self.checkpoint_path(path)
+        checkpoint = self.load_checkpoint(path, checkpoint_path)
+        if checkpoint['completed']:
+            self.stdout.write(f'{label}: {path} was already imported, pass --restart to import it again')
+            return
+        if checkpoint['done']:
+            self.stdout.write(f"{label}: resuming after row {checkpoint['done']}")
+
+        report = IngestReport()
+        started = last_progress = time.monotonic()
+        processed = 0
+        batches = batched(islice(rows, checkpoint['done'], None), self.options['batch_size'])
+        for size in insert_batches(batches, report):
+            processed += size
+            self.write_errors(label, report)
+            checkpoint.update(
+                done=checkpoint['done'] + size,
+                created=checkpoint['created'] + report.created,
+                skipped=checkpoint['skipped'] + report.skipped,
+                failed=checkpoint['failed'] + len(report.errors),
+            )
+            report.created = report.skipped = 0
+            report.errors = []
+            self.save_checkpoint(checkpoint_path, checkpoint)
+
+            now = time.monotonic()
+            if self.options['verbosity'] > 1 or now - last_progress >= PROGRESS_INTERVAL:
+                last_progress = now
+                self.stdout.write(self.progress(label, checkpoint, processed / max(now - started, 1e-9)))
+
+        checkpoint['completed'] = True
+        self.save_checkpoint(checkpoint_path, checkpoint)
+        rate = processed / max(time.monotonic() - started, 1e-9)
+        self.stdout.write(self.style.SUCCESS(self.progress(label, checkpoint, rate)))
+
+    def progress(self, label, checkpoint, rate):
+        return (
+            f"{label}: {checkpoint['done']} rows, {checkpoint['created']} created, "
+            f"{checkpoint['skipped']} skipped, {checkpoint['failed']} failed ({rate:.0f} rows/s)"
+        )
+
+    def write_errors(self, label, report):
+        for error in report.errors:
+            if self.errors_file:
+                self.errors_file.write(json.dumps({'input': label, **error}) + '\n')
+            elif self.options['verbosity'] > 0:
+                self.stderr.write(f"{label} row {error['line']}: {json.dumps(error['errors'])}")
+        if self.errors_file:
+            self.errors_file.flush()
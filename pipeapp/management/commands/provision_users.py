@@ -0,0 +1,46 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from pipeapp.parsers import iter_csv
+from pipeapp.provisioning import provision_users
+
+
+class Command(BaseCommand):
+    help = (
+        'Create users and profiles from a CSV or JSON roster in one transaction. Zone, state, area '
+        'and unit names are resolved in bulk and created when missing; nothing is created unless '
+        'every row is valid.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('roster', help='CSV with a header row, or a JSON array of user objects')
+        parser.add_argument('--format', choices=['csv', 'json'], help='Roster format, by default taken from the file extension')
+        parser.add_argument('--workers', type=int, default=0, help='Threads hashing passwords, 0 to size the pool to the CPUs')
+
+    def handle(self, *args, **options):
+        path = options['roster']
+        roster_format = options['format'] or os.path.splitext(path)[1].lstrip('.').lower()
+        if roster_format not in ('csv', 'json'):
+            raise CommandError('Cannot tell the roster format from the file name, pass --format.')
+        if options['workers'] < 0:
+            raise CommandError('--workers cannot be negative.')
+
+        with open(path, 'rb') as stream:
+            if roster_format == 'csv':
+                report = provision_users(iter_csv(stream), workers=options['workers'] or None)
+            else:
+                try:
+                    users = json.load(stream)
+                except ValueError as exc:
+                    raise CommandError(f'{path}: invalid JSON: {exc}')
+                if not isinstance(users, list):
+                    raise CommandError(f'{path}: expected a JSON array of users.')
+                rows = ((line, data, None) for line, data in enumerate(users, 1))
+                report = provision_users(rows, workers=options['workers'] or None)
+
+        for error in report.errors:
+            self.stderr.write(f"row {error['line']} ({error['name'] or 'unnamed'}): {json.dumps(error['errors'])}")
+        if report.errors:
+            raise CommandError(f'{len(report.errors)} of {report.received} rows rejected, no users were created.')
+        self.stdout.write(self.style.SUCCESS(f'Created {report.created} users'))
@@ -0,0 +1,38 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from pipeapp.changes import COUNTER_ID
+from pipeapp.models import ChangeCounter, Tombstone
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete tombstones of routes and faults removed more than --days ago. Clients whose sync '
+        'cursor predates the newest pruned tombstone are asked to reload.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=getattr(settings, 'PIPEAPP_TOMBSTONE_RETENTION_DAYS', 90),
+            help='Keep tombstones younger than this many days',
+        )
+
+    def handle(self, *args, **options):
+        if options['days'] < 0:
+            raise CommandError('--days cannot be negative.')
+        expired = Tombstone.objects.filter(removed_at__lt=timezone.now() - timedelta(days=options['days']))
+        with transaction.atomic():
+            newest = expired.aggregate(newest=Max('change_seq'))['newest']
+            if newest is None:
+                self.stdout.write('No tombstones to prune')
+                return
+            ChangeCounter.objects.get_or_create(pk=COUNTER_ID)
+            ChangeCounter.objects.filter(pk=COUNTER_ID).update(pruned_through=Greatest('pruned_through', newest))
+            # Everything up to the newest expired number goes, so no cursor sees a partial set
+            deleted, _ = Tombstone.objects.filter(change_seq__lte=newest).delete()
+        self.stdout.write(self.style.SUCCESS(f'Pruned {deleted} tombstones through change {newest}'))
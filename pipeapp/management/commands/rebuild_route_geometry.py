@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from pipeapp.changes import record_changes
+from pipeapp.models import PipelineRoute, PipelineRouteSimplification
+from pipeapp.versions import bump_versions
+
+class Command(BaseCommand):
+    help = 'Recompute the data derived from route geometry, e.g. after changing PIPEAPP_ROUTE_TOLERANCES'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help='Routes rebuilt per transaction')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        route_ids = list(PipelineRoute.objects.order_by('id').values_list('id', flat=True))
+
+        for start in range(0, len(route_ids), batch_size):
+            batch_ids = route_ids[start:start + batch_size]
+            with transaction.atomic():
+                routes = list(PipelineRoute.objects.filter(id__in=batch_ids))
+                for route in routes:
+                    route.refresh_geometry_fields()
+                PipelineRoute.objects.bulk_update(routes, PipelineRoute.GEOMETRY_FIELDS)
+                # bulk_update skips the signals, so listings and syncs are told here
+                record_changes(route_ids=batch_ids)
+                bump_versions(state_ids={route.state_id for route in routes})
+                PipelineRouteSimplification.objects.filter(pipeline_route_id__in=batch_ids).delete()
+                PipelineRouteSimplification.objects.bulk_create(
+                    [level for route in routes for level in route.build_simplifications()]
+                )
+            self.stdout.write(f'Rebuilt {min(start + batch_size, len(route_ids))}/{len(route_ids)} routes')
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt derived geometry for {len(route_ids)} pipeline routes'))
@@ -0,0 +1,68 @@
+# Generated by Django 5.1 on 2026-10-18 08:49
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def backfill_fault_summary(apps, schema_editor):
+    PipelineRoute = apps.get_model("pipeapp", "PipelineRoute")
+    PipelineFault = apps.get_model("pipeapp", "PipelineFault")
+
+    rows = PipelineFault.objects.values("pipeline_route_id").annotate(
+        normal=Count("id", filter=Q(status="normal")),
+        warning=Count("id", filter=Q(status="warning")),
+        critical=Count("id", filter=Q(status="critical")),
+    )
+    for row in rows:
+        if row["critical"]:
+            status = "critical"
+        elif row["warning"]:
+            status = "warning"
+        else:
+            status = "normal"
+        PipelineRoute.objects.filter(pk=row["pipeline_route_id"]).update(
+            status=status,
+            normal_fault_count=row["normal"],
+            warning_fault_count=row["warning"],
+            critical_fault_count=row["critical"],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pipeapp", "0007_pipelinefault_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="pipelineroute",
+            name="critical_fault_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="pipelineroute",
+            name="normal_fault_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="pipelineroute",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("normal", "Normal"),
+                    ("warning", "Warning"),
+                    ("critical", "Critical"),
+                ],
+                db_index=True,
+                default="normal",
+                max_length=10,
+            ),
+        ),
+        migrations.AddField(
+            model_name="pipelineroute",
+            name="warning_fault_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_fault_summary, migrations.RunPython.noop),
+    ]
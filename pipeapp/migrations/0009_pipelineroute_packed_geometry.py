@@ -0,0 +1,137 @@
+# Generated by Django 5.1 on 2026-10-18 08:53
+
+import sys
+import zlib
+from array import array
+from itertools import accumulate
+
+from django.db import migrations, models
+
+# A frozen copy of the version 1 codec in pipeapp.geometry, so later changes
+# to the codec don't change what this migration writes
+GEOMETRY_VERSION = 1
+COORDINATE_SCALE = 10_000_000
+EMPTY_GEOMETRY = bytes([GEOMETRY_VERSION])
+
+
+def legacy_points(coordinates):
+    """The points of a stored route, None when they can't be read."""
+    if coordinates is None:
+        return []
+    # Routes were first stored as {"start": {..}, "end": {..}}
+    if isinstance(coordinates, dict) and set(coordinates) == {"start", "end"}:
+        coordinates = [coordinates["start"], coordinates["end"]]
+    if not isinstance(coordinates, (list, tuple)):
+        return None
+    points = []
+    for point in coordinates:
+        try:
+            latitude = float(point["latitude"])
+            longitude = float(point["longitude"])
+        except (TypeError, KeyError, ValueError):
+            return None
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            return None
+        points.append((latitude, longitude))
+    return points
+
+
+def pack_int64(values):
+    packed = array("q", values)
+    if sys.byteorder != "little":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_int64(data):
+    values = array("q")
+    values.frombytes(data)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+def encode_points(points):
+    deltas = []
+    previous_lat = previous_lon = 0
+    for latitude, longitude in points:
+        lat, lon = round(latitude * COORDINATE_SCALE), round(longitude * COORDINATE_SCALE)
+        deltas.extend((lat - previous_lat, lon - previous_lon))
+        previous_lat, previous_lon = lat, lon
+    if not deltas:
+        return EMPTY_GEOMETRY
+    return EMPTY_GEOMETRY + zlib.compress(pack_int64(deltas))
+
+
+def decode_points(data):
+    data = bytes(data or b"")
+    if len(data) <= 1:
+        return []
+    deltas = unpack_int64(zlib.decompress(data[1:]))
+    return [
+        {"latitude": lat / COORDINATE_SCALE, "longitude": lon / COORDINATE_SCALE}
+        for lat, lon in zip(accumulate(deltas[0::2]), accumulate(deltas[1::2]))
+    ]
+
+
+def pack_coordinates(apps, schema_editor):
+    PipelineRoute = apps.get_model("pipeapp", "PipelineRoute")
+    routes = PipelineRoute.objects.only("id", "coordinates").order_by("id")
+    batch, unreadable = [], []
+    for route in routes.iterator(chunk_size=500):
+        points = legacy_points(route.coordinates)
+        if points is None:
+            unreadable.append(route.pk)
+            continue
+        route.geometry = encode_points(points)
+        batch.append(route)
+        if len(batch) >= 500:
+            PipelineRoute.objects.bulk_update(batch, ["geometry"])
+            batch = []
+    if batch:
+        PipelineRoute.objects.bulk_update(batch, ["geometry"])
+    if unreadable:
+        # The coordinates column is dropped next, so nothing unreadable may be lost with it
+        raise RuntimeError(
+            f"Routes with unreadable coordinates: {', '.join(map(str, unreadable))}. "
+            f"Fix or delete them, then migrate again."
+        )
+
+
+def unpack_coordinates(apps, schema_editor):
+    PipelineRoute = apps.get_model("pipeapp", "PipelineRoute")
+    routes = PipelineRoute.objects.only("id", "geometry").order_by("id")
+    batch = []
+    for route in routes.iterator(chunk_size=500):
+        route.coordinates = decode_points(route.geometry)
+        batch.append(route)
+        if len(batch) >= 500:
+            PipelineRoute.objects.bulk_update(batch, ["coordinates"])
+            batch = []
+    if batch:
+        PipelineRoute.objects.bulk_update(batch, ["coordinates"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pipeapp", "0008_pipelineroute_fault_summary"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="pipelineroute",
+            name="geometry",
+            field=models.BinaryField(default=b"\x01"),
+        ),
+        migrations.AlterField(
+            model_name="pipelineroute",
+            name="coordinates",
+            field=models.JSONField(null=True),
+        ),
+        migrations.RunPython(pack_coordinates, unpack_coordinates),
+        migrations.RemoveField(
+            model_name="pipelineroute",
+            name="coordinates",
+        ),
+    ]
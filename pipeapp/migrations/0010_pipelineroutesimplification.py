@@ -0,0 +1,141 @@
+# Generated by Django 5.1 on 2026-10-18 08:54
+
+import sys
+import zlib
+from array import array
+from itertools import accumulate
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# A frozen copy of the version 1 codec in pipeapp.geometry, so later changes
+# to the codec don't change what this migration writes
+COORDINATE_SCALE = 10_000_000
+
+
+def decode_fixed(data):
+    data = bytes(data or b"")
+    if len(data) <= 1:
+        return [], []
+    deltas = array("q")
+    deltas.frombytes(zlib.decompress(data[1:]))
+    if sys.byteorder != "little":
+        deltas.byteswap()
+    return list(accumulate(deltas[0::2])), list(accumulate(deltas[1::2]))
+
+
+def encode_fixed(lats, lons):
+    deltas = []
+    previous_lat = previous_lon = 0
+    for lat, lon in zip(lats, lons):
+        deltas.extend((lat - previous_lat, lon - previous_lon))
+        previous_lat, previous_lon = lat, lon
+    if not deltas:
+        return b"\x01"
+    packed = array("q", deltas)
+    if sys.byteorder != "little":
+        packed.byteswap()
+    return b"\x01" + zlib.compress(packed.tobytes())
+
+
+def simplify_geometry(data, tolerance):
+    """Douglas-Peucker simplification, ``tolerance`` in degrees."""
+    lats, lons = decode_fixed(data)
+    count = len(lats)
+    if count < 3:
+        return encode_fixed(lats, lons), count
+    tolerance_sq = (tolerance * COORDINATE_SCALE) ** 2
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        start, end = stack.pop()
+        ax, ay = lons[start], lats[start]
+        dx, dy = lons[end] - ax, lats[end] - ay
+        segment_sq = dx * dx + dy * dy
+        farthest, farthest_sq = None, tolerance_sq
+        for i in range(start + 1, end):
+            px, py = lons[i] - ax, lats[i] - ay
+            if segment_sq:
+                t = max(0.0, min(1.0, (px * dx + py * dy) / segment_sq))
+                px -= t * dx
+                py -= t * dy
+            distance_sq = px * px + py * py
+            if distance_sq > farthest_sq:
+                farthest, farthest_sq = i, distance_sq
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((start, farthest))
+            stack.append((farthest, end))
+    lats = [lat for lat, kept in zip(lats, keep) if kept]
+    lons = [lon for lon, kept in zip(lons, keep) if kept]
+    return encode_fixed(lats, lons), len(lats)
+
+
+# PIPEAPP_ROUTE_TOLERANCES as it was; rebuild_route_geometry builds other levels
+ROUTE_TOLERANCES = [0.00001, 0.0001, 0.001, 0.01]
+
+
+def build_simplifications(apps, schema_editor):
+    PipelineRoute = apps.get_model("pipeapp", "PipelineRoute")
+    PipelineRouteSimplification = apps.get_model(
+        "pipeapp", "PipelineRouteSimplification"
+    )
+    routes = PipelineRoute.objects.only("id", "geometry").order_by("id")
+    for route in routes.iterator(chunk_size=200):
+        levels = []
+        for tolerance in ROUTE_TOLERANCES:
+            geometry, point_count = simplify_geometry(route.geometry, tolerance)
+            levels.append(
+                PipelineRouteSimplification(
+                    pipeline_route_id=route.pk,
+                    tolerance=tolerance,
+                    geometry=geometry,
+                    point_count=point_count,
+                )
+            )
+        PipelineRouteSimplification.objects.bulk_create(levels)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pipeapp", "0009_pipelineroute_packed_geometry"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PipelineRouteSimplification",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("tolerance", models.FloatField()),
+                ("geometry", models.BinaryField()),
+                ("point_count", models.PositiveIntegerField()),
+                (
+                    "pipeline_route",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="simplifications",
+                        to="pipeapp.pipelineroute",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("pipeline_route", "tolerance"),
+                        name="unique_route_tolerance",
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(build_simplifications, migrations.RunPython.noop),
+    ]
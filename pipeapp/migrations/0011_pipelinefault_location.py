@@ -0,0 +1,56 @@
+# Generated by Django 5.1 on 2026-10-18 08:56
+
+from django.db import migrations, models
+
+
+# A frozen copy of pipeapp.geometry.point_location
+def point_location(point):
+    try:
+        latitude = float(point["latitude"])
+        longitude = float(point["longitude"])
+    except (TypeError, KeyError, ValueError):
+        return None, None
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None, None
+    return latitude, longitude
+
+
+def fill_fault_location(apps, schema_editor):
+    PipelineFault = apps.get_model("pipeapp", "PipelineFault")
+    faults = PipelineFault.objects.only("id", "fault_coordinates").order_by("id")
+    batch = []
+    for fault in faults.iterator(chunk_size=1000):
+        fault.latitude, fault.longitude = point_location(fault.fault_coordinates)
+        batch.append(fault)
+        if len(batch) >= 1000:
+            PipelineFault.objects.bulk_update(batch, ["latitude", "longitude"])
+            batch = []
+    if batch:
+        PipelineFault.objects.bulk_update(batch, ["latitude", "longitude"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pipeapp", "0010_pipelineroutesimplification"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="pipelinefault",
+            name="latitude",
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="pipelinefault",
+            name="longitude",
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="pipelinefault",
+            index=models.Index(
+                fields=["latitude", "longitude"], name="pipeapp_fault_location_idx"
+            ),
+        ),
+        migrations.RunPython(fill_fault_location, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,102 @@
+# Generated by Django 5.1 on 2026-10-18 08:58
+
+import sys
+import zlib
+from array import array
+from itertools import accumulate
+
+from django.db import migrations, models
+
+# A frozen copy of the version 1 codec in pipeapp.geometry, so later changes
+# to the codec don't change what this migration writes
+COORDINATE_SCALE = 10_000_000
+
+
+def decode_fixed(data):
+    data = bytes(data or b"")
+    if len(data) <= 1:
+        return [], []
+    deltas = array("q")
+    deltas.frombytes(zlib.decompress(data[1:]))
+    if sys.byteorder != "little":
+        deltas.byteswap()
+    return list(accumulate(deltas[0::2])), list(accumulate(deltas[1::2]))
+
+
+def geometry_bounds(data):
+    lats, lons = decode_fixed(data)
+    if not lats:
+        return None, None, None, None
+    return (
+        min(lats) / COORDINATE_SCALE,
+        max(lats) / COORDINATE_SCALE,
+        min(lons) / COORDINATE_SCALE,
+        max(lons) / COORDINATE_SCALE,
+    )
+
+
+BOUND_FIELDS = ["min_latitude", "max_latitude", "min_longitude", "max_longitude"]
+
+
+def fill_route_bounds(apps, schema_editor):
+    PipelineRoute = apps.get_model("pipeapp", "PipelineRoute")
+    routes = PipelineRoute.objects.only("id", "geometry").order_by("id")
+    batch = []
+    for route in routes.iterator(chunk_size=500):
+        (
+            route.min_latitude,
+            route.max_latitude,
+            route.min_longitude,
+            route.max_longitude,
+        ) = geometry_bounds(route.geometry)
+        batch.append(route)
+        if len(batch) >= 500:
+            PipelineRoute.objects.bulk_update(batch, BOUND_FIELDS)
+            batch = []
+    if batch:
+        PipelineRoute.objects.bulk_update(batch, BOUND_FIELDS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pipeapp", "0011_pipelinefault_location"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="pipelineroute",
+            name="max_latitude",
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="pipelineroute",
+            name="max_longitude",
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="pipelineroute",
+            name="min_latitude",
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="pipelineroute",
+            name="min_longitude",
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="pipelineroute",
+            index=models.Index(
+                fields=["min_latitude", "max_latitude"],
+                name="pipeapp_route_lat_bounds_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="pipelineroute",
+            index=models.Index(
+                fields=["min_longitude", "max_longitude"],
+                name="pipeapp_route_lon_bounds_idx",
+            ),
+        ),
+        migrations.RunPython(fill_route_bounds, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,92 @@
+# Generated by Django 5.1 on 2026-10-18 09:03
+
+import sys
+import zlib
+from array import array
+from itertools import accumulate
+
+import numpy as np
+from django.db import migrations, models
+
+# A frozen copy of the version 1 codec in pipeapp.geometry, so later changes
+# to the codec don't change what this migration writes
+COORDINATE_SCALE = 10_000_000
+EARTH_RADIUS_M = 6_371_008.8
+
+
+def decode_fixed(data):
+    data = bytes(data or b"")
+    if len(data) <= 1:
+        return [], []
+    deltas = array("q")
+    deltas.frombytes(zlib.decompress(data[1:]))
+    if sys.byteorder != "little":
+        deltas.byteswap()
+    return list(accumulate(deltas[0::2])), list(accumulate(deltas[1::2]))
+
+
+def route_metrics(data):
+    """``(length_m, segment_count, cumulative)`` along the route, as pipeapp.geometry had it."""
+    lats, lons = decode_fixed(data)
+    if not lats:
+        return 0.0, 0, b""
+    lats = np.radians(np.asarray(lats, dtype=float) / COORDINATE_SCALE)
+    lons = np.radians(np.asarray(lons, dtype=float) / COORDINATE_SCALE)
+    dlat = np.diff(lats)
+    dlon = np.diff(lons)
+    a = (
+        np.sin(dlat / 2) ** 2
+        + np.cos(lats[:-1]) * np.cos(lats[1:]) * np.sin(dlon / 2) ** 2
+    )
+    lengths = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+    cumulative = np.concatenate(([0.0], np.cumsum(lengths)))
+    return (
+        float(cumulative[-1]),
+        len(lengths),
+        np.asarray(cumulative, dtype="<f8").tobytes(),
+    )
+
+
+METRIC_FIELDS = ["length_m", "segment_count", "cumulative_distances"]
+
+
+def fill_route_metrics(apps, schema_editor):
+    PipelineRoute = apps.get_model("pipeapp", "PipelineRoute")
+    routes = PipelineRoute.objects.only("id", "geometry").order_by("id")
+    batch = []
+    for route in routes.iterator(chunk_size=500):
+        route.length_m, route.segment_count, route.cumulative_distances = route_metrics(
+            route.geometry
+        )
+        batch.append(route)
+        if len(batch) >= 500:
+            PipelineRoute.objects.bulk_update(batch, METRIC_FIELDS)
+            batch = []
+    if batch:
+        PipelineRoute.objects.bulk_update(batch, METRIC_FIELDS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pipeapp", "0012_pipelineroute_bounds"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="pipelineroute",
+            name="cumulative_distances",
+            field=models.BinaryField(default=b""),
+        ),
+        migrations.AddField(
+            model_name="pipelineroute",
+            name="length_m",
+            field=models.FloatField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="pipelineroute",
+            name="segment_count",
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.RunPython(fill_route_metrics, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.1 on 2026-10-18 09:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pipeapp", "0013_route_metrics"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="pipelinefault",
+            name="client_key",
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name="pipelinefault",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("client_key__isnull", False)),
+                fields=("pipeline_route", "client_key"),
+                name="unique_route_fault_client_key",
+            ),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.1 on 2026-10-18 09:15
+
+from django.db import migrations, models
+
+
+def fill_hierarchy_paths(apps, schema_editor):
+    # Top down, each level's paths come from the level above
+    prefixes = {}
+    for model_name, parent in [
+        ("Zone", None),
+        ("State", "zone"),
+        ("Area", "state"),
+        ("Unit", "area"),
+    ]:
+        model = apps.get_model("pipeapp", model_name)
+        parent_prefixes, prefixes, batch = prefixes, {}, []
+        for node in model.objects.order_by("id").iterator(chunk_size=500):
+            node.path = (
+                parent_prefixes[getattr(node, f"{parent}_id")] if parent else "/"
+            )
+            prefixes[node.pk] = f"{node.path}{node.pk}/"
+            batch.append(node)
+        model.objects.bulk_update(batch, ["path"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pipeapp", "0014_pipelinefault_client_key"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="area",
+            name="path",
+            field=models.CharField(
+                db_index=True, default="/", editable=False, max_length=255
+            ),
+        ),
+        migrations.AddField(
+            model_name="state",
+            name="path",
+            field=models.CharField(
+                db_index=True, default="/", editable=False, max_length=255
+            ),
+        ),
+        migrations.AddField(
+            model_name="unit",
+            name="path",
+            field=models.CharField(
+                db_index=True, default="/", editable=False, max_length=255
+            ),
+        ),
+        migrations.AddField(
+            model_name="zone",
+            name="path",
+            field=models.CharField(
+                db_index=True, default="/", editable=False, max_length=255
+            ),
+        ),
+        migrations.RunPython(fill_hierarchy_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1 on 2026-10-18 09:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pipeapp", "0015_hierarchy_path"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="state",
+            name="data_version",
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="zone",
+            name="data_version",
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,93 @@
+# Generated by Django 5.1 on 2026-10-18 09:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def create_change_counter(apps, schema_editor):
+    ChangeCounter = apps.get_model("pipeapp", "ChangeCounter")
+    ChangeCounter.objects.get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pipeapp", "0016_data_version"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ChangeCounter",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("value", models.PositiveBigIntegerField(default=0)),
+                ("pruned_through", models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="Tombstone",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[("route", "Route"), ("fault", "Fault")], max_length=5
+                    ),
+                ),
+                ("object_id", models.BigIntegerField()),
+                ("change_seq", models.PositiveBigIntegerField()),
+                ("removed_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="pipelinefault",
+            name="change_seq",
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="pipelineroute",
+            name="change_seq",
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name="pipelinefault",
+            index=models.Index(fields=["change_seq"], name="pipeapp_fault_change_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="pipelineroute",
+            index=models.Index(fields=["change_seq"], name="pipeapp_route_change_idx"),
+        ),
+        migrations.AddField(
+            model_name="tombstone",
+            name="state",
+            field=models.ForeignKey(
+                db_constraint=False,
+                on_delete=django.db.models.deletion.DO_NOTHING,
+                related_name="+",
+                to="pipeapp.state",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="tombstone",
+            index=models.Index(
+                fields=["change_seq"], name="pipeapp_tombstone_change_idx"
+            ),
+        ),
+        migrations.RunPython(create_change_counter, migrations.RunPython.noop),
+    ]
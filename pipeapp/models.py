@@ -1,8 +1,12 @@
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import AbstractUser
-from django.db.models.signals import post_save
+from django.db.models import Count, Q, Value
+from django.db.models.functions import Concat, Substr
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.contrib.auth import get_user_model
+from .geometry import EMPTY_GEOMETRY, decode_coordinates, encode_coordinates, geometry_bounds, point_location, route_metrics, simplify_geometry
 
 CustomUser = get_user_model()
 
@@ -53,63 +57,416 @@ class CustomUser(AbstractUser):
         verbose_name='user permissions'
     )
 
-class Zone(models.Model):
+class HierarchyNode(models.Model):
+    """
+    A level of the Zone > State > Area > Unit hierarchy with a materialized path.
+
+    ``path`` holds the ids of a node's ancestors from the zone down, e.g. an area
+    has ``/<zone id>/<state id>/``, so every descendant of a node, at any depth,
+    is found with one indexed ``path__startswith=node.descendant_prefix`` lookup
+    and every ancestor id can be read off the path without a query.
+    """
+    parent_field = None  # Name of the foreign key to the level above
+    counter_fields = ()  # Only ever written with F() updates, see save()
+
+    path = models.CharField(max_length=255, default='/', db_index=True, editable=False)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_path = instance.__dict__.get('path')
+        instance._loaded_parent_id = instance.__dict__.get(f'{cls.parent_field}_id') if cls.parent_field else None
+        return instance
+
+    @property
+    def descendant_prefix(self):
+        return f'{self.path}{self.pk}/'
+
+    def ancestor_id(self, model):
+        """Id of this node's ancestor at ``model``'s level, read from the path."""
+        return int(self.path.strip('/').split('/')[HIERARCHY.index(model)])
+
+    def descendants(self, model):
+        return model.objects.filter(path__startswith=self.descendant_prefix)
+
+    def refresh_path(self):
+        # Call before bulk_create/bulk_update, which bypass save(); the parent must be saved
+        self.path = getattr(self, self.parent_field).descendant_prefix if self.parent_field else '/'
+
+    def save(self, *args, **kwargs):
+        if self.counter_fields and not self._state.adding and kwargs.get('update_fields') is None:
+            # A full save must not write back a counter that was bumped since this node was loaded
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.counter_fields
+            ]
+        update_fields = kwargs.get('update_fields')
+        loaded_path = getattr(self, '_loaded_path', None)
+        parent_id = getattr(self, f'{self.parent_field}_id') if self.parent_field else None
+        if loaded_path is None or parent_id != getattr(self, '_loaded_parent_id', None):
+            self.refresh_path()
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'path'}
+        super().save(*args, **kwargs)
+
+        # Re-root the subtree of a node that moved to another parent
+        old_prefix = f'{loaded_path}{self.pk}/' if loaded_path is not None else None
+        if old_prefix and old_prefix != self.descendant_prefix:
+            for model in HIERARCHY[HIERARCHY.index(type(self)) + 1:]:
+                model.objects.filter(path__startswith=old_prefix).update(
+                    path=Concat(Value(self.descendant_prefix), Substr('path', len(old_prefix) + 1))
+                )
+        self._loaded_path, self._loaded_parent_id = self.path, parent_id
+
+class Zone(HierarchyNode):
+    counter_fields = ('data_version',)
+
     name = models.CharField(max_length=100, unique=True)
+    # Bumped by every write to the routes and faults of the zone's states, see pipeapp.versions
+    data_version = models.PositiveBigIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.name
 
-class State(models.Model):
+class State(HierarchyNode):
+    parent_field = 'zone'
+    counter_fields = ('data_version',)
+
     name = models.CharField(max_length=100, unique=True)
     zone = models.ForeignKey(Zone, on_delete=models.CASCADE)
+    # Bumped by every write to the state's routes and faults, see pipeapp.versions
+    data_version = models.PositiveBigIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.name
 
-class Area(models.Model):
+class Area(HierarchyNode):
+    parent_field = 'state'
+
     name = models.CharField(max_length=100, unique=True)
     state = models.ForeignKey(State, on_delete=models.CASCADE)
 
     def __str__(self):
         return self.name
 
-class Unit(models.Model):
+class Unit(HierarchyNode):
+    parent_field = 'area'
+
     name = models.CharField(max_length=100, unique=True)
     area = models.ForeignKey(Area, on_delete=models.CASCADE)
 
     def __str__(self):
         return self.name
+
+# Levels from the top, the position of an id in a path is its level here
+HIERARCHY = [Zone, State, Area, Unit]
+# Douglas-Peucker tolerances, in degrees, stored for every route (roughly 1 m to 1 km)
+ROUTE_TOLERANCES = sorted(getattr(settings, 'PIPEAPP_ROUTE_TOLERANCES', [0.00001, 0.0001, 0.001, 0.01]))
+
+def stored_tolerance(requested):
+    """The coarsest stored tolerance not exceeding ``requested``, or None for full detail."""
+    candidates = [tolerance for tolerance in ROUTE_TOLERANCES if tolerance <= requested]
+    return max(candidates) if candidates else None
+
+FAULT_STATUS_CHOICES = [
+    ('normal', 'Normal'),
+    ('warning', 'Warning'),
+    ('critical', 'Critical')
+]
+
 class PipelineRoute(models.Model):
     name = models.CharField(max_length=255, unique=True)
     state = models.ForeignKey(State, on_delete=models.CASCADE)
-    coordinates = models.JSONField()  # Stores the longitude and latitude as a list of dictionaries
+    geometry = models.BinaryField(default=EMPTY_GEOMETRY)  # Packed coordinates, see pipeapp.geometry
+
+    # Denormalized fault summary, kept in sync by the PipelineFault signals below
+    status = models.CharField(max_length=10, choices=FAULT_STATUS_CHOICES, default='normal', db_index=True)
+    normal_fault_count = models.PositiveIntegerField(default=0)
+    warning_fault_count = models.PositiveIntegerField(default=0)
+    critical_fault_count = models.PositiveIntegerField(default=0)
+
+    SUMMARY_FIELDS = ['status', 'normal_fault_count', 'warning_fault_count', 'critical_fault_count']
+
+    # Bounding box of the geometry, recomputed whenever it changes
+    min_latitude = models.FloatField(null=True, blank=True, editable=False)
+    max_latitude = models.FloatField(null=True, blank=True, editable=False)
+    min_longitude = models.FloatField(null=True, blank=True, editable=False)
+    max_longitude = models.FloatField(null=True, blank=True, editable=False)
+
+    # Geodesic length in metres, segment count and the distance along the route at each vertex
+    length_m = models.FloatField(default=0, db_index=True, editable=False)
+    segment_count = models.PositiveIntegerField(default=0, db_index=True, editable=False)
+    cumulative_distances = models.BinaryField(default=b'', editable=False)  # Packed float64 metres, see pipeapp.geometry
+
+    # Sequence number of the last change to the route or its summary, see pipeapp.changes
+    change_seq = models.PositiveBigIntegerField(default=0, editable=False)
+
+    # Columns derived from geometry, set by refresh_geometry_fields()
+    GEOMETRY_FIELDS = [
+        'min_latitude', 'max_latitude', 'min_longitude', 'max_longitude',
+        'length_m', 'segment_count', 'cumulative_distances',
+    ]
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['min_latitude', 'max_latitude'], name='pipeapp_route_lat_bounds_idx'),
+            models.Index(fields=['min_longitude', 'max_longitude'], name='pipeapp_route_lon_bounds_idx'),
+            models.Index(fields=['change_seq'], name='pipeapp_route_change_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
+    @property
+    def coordinates(self):
+        # Decoded lazily and memoized for as long as the stored geometry is unchanged
+        cached = getattr(self, '_coordinates_cache', None)
+        if cached is None or cached[0] is not self.geometry:
+            cached = (self.geometry, decode_coordinates(self.geometry))
+            self._coordinates_cache = cached
+        return cached[1]
+
+    @coordinates.setter
+    def coordinates(self, value):
+        # Longitude and latitude as a list of dictionaries, packed on assignment
+        self.geometry = encode_coordinates(value)
+        self._coordinates_cache = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored geometry so saves only recompute derived data when it changed
+        instance._loaded_geometry = instance.__dict__.get('geometry')
+        # and the state, so moving a route bumps the data version of both states
+        instance._loaded_state_id = instance.__dict__.get('state_id')
+        return instance
+
+    def geometry_changed(self):
+        loaded = getattr(self, '_loaded_geometry', None)
+        return loaded is None or bytes(loaded) != bytes(self.geometry)
+
+    def refresh_geometry_fields(self):
+        # Call before bulk_create/bulk_update, which bypass save()
+        self.min_latitude, self.max_latitude, self.min_longitude, self.max_longitude = geometry_bounds(self.geometry)
+        self.length_m, self.segment_count, self.cumulative_distances = route_metrics(self.geometry)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        geometry_changed = (update_fields is None or 'geometry' in update_fields) and self.geometry_changed()
+        if geometry_changed:
+            self.refresh_geometry_fields()
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, *self.GEOMETRY_FIELDS}
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if geometry_changed:
+            self.rebuild_simplifications(replace=not adding)
+            self._loaded_geometry = self.geometry
+
+    def build_simplifications(self):
+        simplifications = []
+        for tolerance in ROUTE_TOLERANCES:
+            geometry, point_count = simplify_geometry(self.geometry, tolerance)
+            simplifications.append(PipelineRouteSimplification(
+                pipeline_route=self, tolerance=tolerance, geometry=geometry, point_count=point_count,
+            ))
+        return simplifications
+
+    def rebuild_simplifications(self, replace=True):
+        if replace:
+            self.simplifications.all().delete()
+        PipelineRouteSimplification.objects.bulk_create(self.build_simplifications())
+
+    def geometry_for_tolerance(self, tolerance):
+        # Stored geometry simplified to ``tolerance``, or the full geometry without one
+        if tolerance is None:
+            return self.geometry
+        prefetched = getattr(self, '_prefetched_objects_cache', {}).get('simplifications')
+        if prefetched is not None:
+            level = next((item for item in prefetched if item.tolerance == tolerance), None)
+        else:
+            level = self.simplifications.filter(tolerance=tolerance).first()
+        return level.geometry if level is not None else self.geometry
+
+    @staticmethod
+    def fault_summaries(route_ids=None):
+        # Count faults per route and status in a single grouped query
+        faults = PipelineFault.objects.all()
+        if route_ids is not None:
+            faults = faults.filter(pipeline_route_id__in=route_ids)
+        rows = faults.values('pipeline_route_id').annotate(
+            normal=Count('id', filter=Q(status='normal')),
+            warning=Count('id', filter=Q(status='warning')),
+            critical=Count('id', filter=Q(status='critical')),
+        )
+        summaries = {}
+        for row in rows:
+            if row['critical']:
+                status = 'critical'
+            elif row['warning']:
+                status = 'warning'
+            else:
+                status = 'normal'
+            summaries[row['pipeline_route_id']] = {
+                'status': status,
+                'normal_fault_count': row['normal'],
+                'warning_fault_count': row['warning'],
+                'critical_fault_count': row['critical'],
+            }
+        return summaries
+
+    @staticmethod
+    def empty_fault_summary():
+        return {
+            'status': 'normal',
+            'normal_fault_count': 0,
+            'warning_fault_count': 0,
+            'critical_fault_count': 0,
+        }
+
+    def refresh_fault_summary(self):
+        # Recompute the stored status and counters from the faults table
+        summary = self.fault_summaries([self.pk]).get(self.pk, self.empty_fault_summary())
+        changed = any(getattr(self, field) != value for field, value in summary.items())
+        for field, value in summary.items():
+            setattr(self, field, value)
+        if changed:
+            PipelineRoute.objects.filter(pk=self.pk).update(**summary)
+        return changed
+
+class PipelineRouteSimplification(models.Model):
+    pipeline_route = models.ForeignKey(PipelineRoute, on_delete=models.CASCADE, related_name='simplifications')
+    tolerance = models.FloatField()  # Douglas-Peucker tolerance in degrees
+    geometry = models.BinaryField()  # Packed like PipelineRoute.geometry
+    point_count = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['pipeline_route', 'tolerance'], name='unique_route_tolerance'),
+        ]
+
+    def __str__(self):
+        return f"{self.pipeline_route_id} at {self.tolerance}"
+
 class PipelineFault(models.Model):
-    FAULT_STATUS_CHOICES = [
-        ('normal', 'Normal'),
-        ('warning', 'Warning'),
-        ('critical', 'Critical')
-    ]
-    
+    FAULT_STATUS_CHOICES = FAULT_STATUS_CHOICES
+
     pipeline_route = models.ForeignKey(PipelineRoute, on_delete=models.CASCADE, related_name='faults')
     fault_coordinates = models.JSONField()  # Stores the longitude and latitude of the fault
     description = models.TextField(blank=True, null=True)
     reported_at = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=10, choices=FAULT_STATUS_CHOICES, default='normal')
+    # Identifier chosen by the client, unique within the route; lets a client that
+    # doesn't track database ids match its faults on later writes
+    client_key = models.CharField(max_length=64, null=True, blank=True)
+
+    # Indexed copy of fault_coordinates for bounding box and radius queries
+    latitude = models.FloatField(null=True, blank=True, editable=False)
+    longitude = models.FloatField(null=True, blank=True, editable=False)
+
+    # Sequence number of the last change to the fault, see pipeapp.changes
+    change_seq = models.PositiveBigIntegerField(default=0, editable=False)
+
+    # Fields a route write may change on an existing fault
+    WRITE_FIELDS = ['fault_coordinates', 'description', 'status', 'client_key']
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['latitude', 'longitude'], name='pipeapp_fault_location_idx'),
+            models.Index(fields=['change_seq'], name='pipeapp_fault_change_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['pipeline_route', 'client_key'], condition=models.Q(client_key__isnull=False),
+                name='unique_route_fault_client_key',
+            ),
+        ]
 
     def __str__(self):
         return f"Fault in {self.pipeline_route.name} at {self.fault_coordinates}"
+
+    def refresh_location(self):
+        # Call before bulk_create/bulk_update, which bypass save()
+        self.latitude, self.longitude = point_location(self.fault_coordinates)
+
+    def save(self, *args, **kwargs):
+        self.refresh_location()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'fault_coordinates' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'latitude', 'longitude'}
+        super().save(*args, **kwargs)
     @property
     def state(self):
         return self.pipeline_route.state
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the route the fault was loaded with so a move refreshes both routes
+        instance._loaded_route_id = instance.__dict__.get('pipeline_route_id')
+        return instance
+
+class ChangeCounter(models.Model):
+    # A single row: the last change sequence number handed out, and the newest one
+    # whose tombstones may have been pruned
+    value = models.PositiveBigIntegerField(default=0)
+    pruned_through = models.PositiveBigIntegerField(default=0)
+
+class Tombstone(models.Model):
+    ROUTE = 'route'
+    FAULT = 'fault'
+    KIND_CHOICES = [(ROUTE, 'Route'), (FAULT, 'Fault')]
+
+    # A route or fault deleted, or moved out of ``state``, at ``change_seq``
+    kind = models.CharField(max_length=5, choices=KIND_CHOICES)
+    object_id = models.BigIntegerField()
+    # Kept after the state itself is deleted
+    state = models.ForeignKey(State, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    change_seq = models.PositiveBigIntegerField()
+    removed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['change_seq'], name='pipeapp_tombstone_change_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.object_id} removed at {self.change_seq}"
+
+
+def refresh_route_fault_summary(route_id):
+    route = PipelineRoute.objects.only('id', 'state_id', *PipelineRoute.SUMMARY_FIELDS).filter(pk=route_id).first()
+    if route is not None:
+        route.refresh_fault_summary()
+
+@receiver(post_save, sender=PipelineFault)
+def update_route_status_on_fault_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    refresh_route_fault_summary(instance.pipeline_route_id)
+    loaded_route_id = getattr(instance, '_loaded_route_id', None)
+    if loaded_route_id and loaded_route_id != instance.pipeline_route_id:
+        refresh_route_fault_summary(loaded_route_id)
+    instance._loaded_route_id = instance.pipeline_route_id
+
+@receiver(post_delete, sender=PipelineFault)
+def update_route_status_on_fault_delete(sender, instance, origin=None, **kwargs):
+    # Faults removed by a cascading route delete leave nothing to summarize
+    if isinstance(origin, PipelineRoute) or getattr(origin, 'model', None) is PipelineRoute:
+        return
+    refresh_route_fault_summary(instance.pipeline_route_id)
+
 @receiver(post_save, sender=CustomUser)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
         Profile.objects.create(user=instance)
 
 @receiver(post_save, sender=CustomUser)
-def save_user_profile(sender, instance, **kwargs):
+def save_user_profile(sender, instance, update_fields=None, **kwargs):
+    # A login only stamps last_login, which leaves the profile with nothing to save
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
     instance.profile.save()
@@ -0,0 +1,149 @@
+import binascii
+import hashlib
+import json
+from base64 import b64decode, b64encode
+from functools import reduce
+from operator import or_
+from urllib import parse
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class IdCursorPagination(CursorPagination):
+    """
+    Keyset pagination on the primary key.
+
+    Pages are addressed by an opaque cursor over ``id`` rather than an offset,
+    so rows inserted while a client is paging never shift or repeat results.
+    With ``?ordering=`` the cursor holds the last row's value of every
+    ordering field and its id, which always breaks ties, so rows with equal
+    values are neither skipped nor repeated across pages either.
+    A total is only returned when asked for with ``?count=1``, and is then
+    served from the cache instead of running COUNT(*) on every page.
+    """
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+    max_page_size = getattr(settings, 'PIPEAPP_MAX_PAGE_SIZE', 1000)
+    count_query_param = 'count'
+    count_cache_timeout = getattr(settings, 'PIPEAPP_COUNT_CACHE_TIMEOUT', 60)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = None
+        if request.query_params.get(self.count_query_param) in ('1', 'true', 'yes'):
+            self.count = self.get_cached_count(queryset)
+
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        if not {'id', '-id', 'pk', '-pk'} & set(self.ordering):
+            self.ordering = (*self.ordering, 'id')
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor.reverse
+
+        ordering = [flip(field) for field in self.ordering] if reverse else list(self.ordering)
+        queryset = queryset.order_by(*ordering)
+        if self.cursor is not None:
+            queryset = queryset.filter(after(ordering, self.cursor.position))
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        if reverse:
+            self.page.reverse()
+
+        # A page reached backwards always has one after it, and a page reached forwards one before it
+        has_more = len(results) > self.page_size
+        self.has_next = not reverse and has_more or reverse
+        self.has_previous = reverse and has_more or not reverse and self.cursor is not None
+        return self.page
+
+    def position(self, instance):
+        return [getattr(instance, field.lstrip('-')) for field in self.ordering]
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        position = self.position(self.page[-1]) if self.page else self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        position = self.position(self.page[0]) if self.page else self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=position))
+
+    def encode_cursor(self, cursor):
+        tokens = {'p': json.dumps(cursor.position)}
+        if cursor.reverse:
+            tokens['r'] = '1'
+        encoded = b64encode(parse.urlencode(tokens).encode('ascii')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            tokens = parse.parse_qs(b64decode(encoded.encode('ascii')).decode('ascii'), keep_blank_values=True)
+            reverse = bool(int(tokens.get('r', ['0'])[0]))
+            position = json.loads(tokens['p'][0])
+        except (TypeError, ValueError, KeyError, UnicodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        # A cursor issued for another ordering can't be continued
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return Cursor(offset=0, reverse=reverse, position=position)
+
+    def get_cached_count(self, queryset):
+        try:
+            sql, params = queryset.query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+        digest = hashlib.md5(f'{sql}|{params!r}'.encode()).hexdigest()
+        key = f'pipeapp:count:{digest}'
+        count = cache.get(key)
+        if count is None:
+            count = queryset.count()
+            cache.set(key, count, self.count_cache_timeout)
+        return count
+
+    def get_paginated_response(self, data):
+        payload = {
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        }
+        if self.count is not None:
+            payload = {'count': self.count, **payload}
+        return Response(payload)
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema['properties']['count'] = {
+            'type': 'integer',
+            'example': 123,
+            'description': f'Cached total, only present when {self.count_query_param}=1 is passed.',
+        }
+        return response_schema
+
+
+def flip(field):
+    return field[1:] if field.startswith('-') else f'-{field}'
+
+
+def after(ordering, position):
+    """Rows that come after ``position`` in ``ordering``: equal on a prefix of the fields, past it on the next."""
+    conditions = []
+    for i, field in enumerate(ordering):
+        name = field.lstrip('-')
+        equal = {other.lstrip('-'): value for other, value in zip(ordering[:i], position)}
+        past = f'{name}__lt' if field.startswith('-') else f'{name}__gt'
+        conditions.append(Q(**equal, **{past: position[i]}))
+    return reduce(or_, conditions)
@@ -0,0 +1,57 @@
+import codecs
+import csv
+import json
+
+from rest_framework.parsers import BaseParser
+
+
+class NDJSONParser(BaseParser):
+    """
+    Newline delimited JSON request bodies.
+
+    Parsing is lazy: ``request.data`` is a generator of ``(line number, object,
+    error)`` read from the request stream one line at a time, so a body of any
+    size is never held in memory at once. Lines that are not valid JSON are
+    yielded with an error message instead of failing the whole request.
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        return iter_ndjson(stream)
+
+
+def iter_ndjson(stream):
+    if stream is None:
+        return
+    for line_number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield line_number, json.loads(line), None
+        except (UnicodeDecodeError, ValueError) as exc:
+            yield line_number, None, f'Invalid JSON: {exc}'
+
+
+class CSVParser(BaseParser):
+    """
+    CSV request bodies with a header row. Like NDJSONParser, ``request.data`` is
+    a lazy generator of ``(line number, row dict, error)``.
+    """
+    media_type = 'text/csv'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', 'utf-8')
+        return iter_csv(stream, encoding)
+
+
+def iter_csv(stream, encoding='utf-8'):
+    if stream is None:
+        return
+    lines = codecs.iterdecode(stream, encoding)
+    reader = csv.DictReader(lines)
+    try:
+        for row in reader:
+            yield reader.line_num, row, None
+    except (csv.Error, UnicodeDecodeError) as exc:
+        yield reader.line_num, None, f'Invalid CSV: {exc}'
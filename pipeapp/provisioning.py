@@ -0,0 +1,161 @@
+"""
+Batch user provisioning.
+
+A roster of users (see RosterEntrySerializer) is validated in memory, then
+checked against the database with one query for its usernames and one per
+hierarchy level for the zone, state, area and unit names it uses. Passwords
+are hashed in a thread pool; PBKDF2 runs in OpenSSL with the GIL released,
+so the threads hash in parallel. The missing hierarchy nodes, the users and
+their profiles are then inserted with bulk_create in a single transaction.
+
+A roster is all or nothing: when any row is rejected the report lists every
+problem found and nothing is created.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+
+from .ingest import IngestReport
+from .models import HIERARCHY, Profile
+from .scope import invalidate_all_scopes
+from .serializers import RosterEntrySerializer
+
+User = get_user_model()
+
+# None lets the pool size itself to the machine's CPUs
+PROVISION_HASH_WORKERS = getattr(settings, 'PIPEAPP_PROVISION_HASH_WORKERS', None)
+MAX_PROVISION_ROWS = 5000
+
+# Profile field naming each hierarchy level, in HIERARCHY order
+LEVEL_FIELDS = [model._meta.model_name for model in HIERARCHY]
+
+
+def provision_users(rows, workers=None, report=None):
+    """Create users and profiles from ``(line, data, error)`` rows and return an IngestReport."""
+    report = report or IngestReport()
+    entries = []
+    for line, data, error in rows:
+        report.received += 1
+        if error:
+            report.fail(line, {'non_field_errors': [error]})
+            continue
+        if isinstance(data, dict):
+            # Empty CSV cells and JSON nulls count as missing
+            data = {key: value for key, value in data.items() if key is not None and value not in (None, '')}
+        serializer = RosterEntrySerializer(data=data)
+        if serializer.is_valid():
+            entries.append((line, serializer.validated_data))
+        else:
+            report.fail(line, serializer.errors, name=data.get('username') if isinstance(data, dict) else None)
+
+    check_usernames(entries, report)
+    nodes = resolve_hierarchy(entries, report)
+    if report.errors or not entries:
+        return report
+
+    passwords = hash_passwords([entry['password'] for _, entry in entries], workers)
+    users = [
+        User(
+            username=entry['username'], email=entry['email'], password=password,
+            first_name=entry['first_name'], last_name=entry['last_name'],
+        )
+        for (_, entry), password in zip(entries, passwords)
+    ]
+    with transaction.atomic():
+        created_nodes = nodes.create_missing()
+        User.objects.bulk_create(users)
+        Profile.objects.bulk_create([
+            Profile(user=user, role=entry['role'], location=entry['location'], **nodes.for_entry(entry))
+            for user, (_, entry) in zip(users, entries)
+        ])
+    if created_nodes:
+        # bulk_create skips the hierarchy signals that expire cached role scopes
+        invalidate_all_scopes()
+    report.created = len(users)
+    return report
+
+
+def check_usernames(entries, report):
+    usernames = {entry['username'] for _, entry in entries}
+    existing = set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+    seen = set()
+    for line, entry in entries:
+        if entry['username'] in existing or entry['username'] in seen:
+            report.fail(line, {'username': ['A user with that username already exists.']}, name=entry['username'])
+        seen.add(entry['username'])
+
+
+class HierarchyPlan:
+    """The existing and to-be-created nodes of each level, by name (names are unique per level)."""
+
+    def __init__(self):
+        self.nodes = [{} for _ in HIERARCHY]
+        self.missing = [[] for _ in HIERARCHY]
+
+    def for_entry(self, entry):
+        return {
+            field: self.nodes[level][entry[field]]
+            for level, field in enumerate(LEVEL_FIELDS)
+            if entry[field]
+        }
+
+    def create_missing(self):
+        # Top down, so every new node's parent has its primary key and path
+        created = 0
+        for model, missing in zip(HIERARCHY, self.missing):
+            for node in missing:
+                node.refresh_path()
+            model.objects.bulk_create(missing)
+            created += len(missing)
+        return created
+
+
+def resolve_hierarchy(entries, report):
+    """
+    Plan the zone, state, area and unit of every entry with one query per level.
+    A named node that doesn't exist yet is planned for creation under the node
+    the entry names one level up; a row that names a node under a different
+    parent than the one it already has, or a new node without its parent, fails.
+    """
+    plan = HierarchyPlan()
+    for level, (model, field) in enumerate(zip(HIERARCHY, LEVEL_FIELDS)):
+        names = {entry[field] for _, entry in entries if entry[field]}
+        plan.nodes[level] = {node.name: node for node in model.objects.filter(name__in=names)}
+
+    for line, entry in entries:
+        errors = {}
+        for level, (model, field) in enumerate(zip(HIERARCHY, LEVEL_FIELDS)):
+            name = entry[field]
+            if not name:
+                continue
+            parent_field = model.parent_field
+            parent = plan.nodes[level - 1].get(entry[parent_field]) if parent_field and entry[parent_field] else None
+            node = plan.nodes[level].get(name)
+            if node is None:
+                if parent_field and parent is None:
+                    errors[field] = [f"{model.__name__} '{name}' does not exist; name its {parent_field} to create it."]
+                    break
+                node = model(name=name, **({parent_field: parent} if parent_field else {}))
+                plan.nodes[level][name] = node
+                plan.missing[level].append(node)
+            elif parent is not None and not has_parent(node, parent):
+                errors[field] = [f"{model.__name__} '{name}' is not in {parent_field} '{parent.name}'."]
+                break
+        if errors:
+            report.fail(line, errors, name=entry['username'])
+    return plan
+
+
+def has_parent(node, parent):
+    if node.pk is None:
+        # Planned by an earlier row, its parent is assigned but may not be saved yet
+        return getattr(node, node.parent_field) is parent
+    return getattr(node, f'{node.parent_field}_id') == parent.pk
+
+
+def hash_passwords(passwords, workers=None):
+    with ThreadPoolExecutor(workers or PROVISION_HASH_WORKERS) as pool:
+        return list(pool.map(make_password, passwords))
@@ -0,0 +1,27 @@
+import json
+
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Newline delimited JSON, one object per line.
+
+    Selecting it on a list endpoint switches the routes viewset to its
+    streaming mode; for anything else it renders the response data as is,
+    one line per item of a list.
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        items = data if isinstance(data, list) else [data]
+        return b''.join(encode_line(item) for item in items)
+
+
+def encode_line(item):
+    return json.dumps(item, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
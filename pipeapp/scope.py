@@ -0,0 +1,163 @@
+"""
+Role scopes resolved to state ids.
+
+A user's profile role decides which part of the Zone/State/Area/Unit
+hierarchy they see. Rather than joining through the hierarchy on every
+request, the scope is resolved once to the set of state ids it covers and
+cached per user; querysets are then filtered with a plain
+``state_id IN (...)``. Saving or deleting a profile drops that user's
+entry, and any change to the hierarchy moves every entry to a new
+generation.
+
+Those invalidations only reach every worker through a cache they all
+share, named by PIPEAPP_SCOPE_CACHE_ALIAS; entries then live
+PIPEAPP_SCOPE_CACHE_TIMEOUT seconds. Without one, scopes are cached in
+the default cache for PIPEAPP_SCOPE_CACHE_LOCAL_TTL seconds only, so a
+worker that missed a change stops authorizing the old scope within a few
+seconds.
+"""
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Area, Profile, State, Unit, Zone
+
+SCOPE_CACHE_ALIAS = getattr(settings, 'PIPEAPP_SCOPE_CACHE_ALIAS', None)
+if SCOPE_CACHE_ALIAS:
+    SCOPE_CACHE_TIMEOUT = getattr(settings, 'PIPEAPP_SCOPE_CACHE_TIMEOUT', 300)
+else:
+    SCOPE_CACHE_TIMEOUT = getattr(settings, 'PIPEAPP_SCOPE_CACHE_LOCAL_TTL', 5)
+GENERATION_KEY = 'pipeapp:scope:generation'
+
+
+@dataclass(frozen=True)
+class Scope:
+    role: str
+    state_ids: frozenset = None  # None when the role sees every state
+
+    @property
+    def unrestricted(self):
+        return self.state_ids is None
+
+    def filter(self, queryset, state_lookup='state'):
+        """Restrict ``queryset``; ``state_lookup`` is its path to State, None for States themselves."""
+        if self.state_ids is None:
+            return queryset
+        if not self.state_ids:
+            return queryset.none()
+        lookup = f'{state_lookup}_id__in' if state_lookup else 'pk__in'
+        return queryset.filter(**{lookup: sorted(self.state_ids)})
+
+
+def scope_cache():
+    return caches[SCOPE_CACHE_ALIAS or DEFAULT_CACHE_ALIAS]
+
+
+def scope_cache_key(user_id, generation=None):
+    if generation is None:
+        generation = scope_cache().get(GENERATION_KEY, 0)
+    return f'pipeapp:scope:{generation}:{user_id}'
+
+
+def profile_scope(profile, zone_state_ids=()):
+    # Area and unit profiles read their state off the materialized path, zonal ones
+    # need the ids of the zone's direct children, read by the caller
+    if profile.role == Profile.NATIONAL:
+        return Scope(profile.role)
+    elif profile.role == Profile.ZONAL:
+        return Scope(profile.role, frozenset(zone_state_ids))
+    elif profile.role == Profile.STATE:
+        state_id = profile.state_id
+    elif profile.role == Profile.AREA:
+        state_id = profile.area.state_id if profile.area else None
+    elif profile.role == Profile.UNIT:
+        state_id = profile.unit.ancestor_id(State) if profile.unit else None
+    else:
+        return Scope(profile.role, frozenset())  # No data if no role matches
+    return Scope(profile.role, frozenset() if state_id is None else frozenset([state_id]))
+
+
+def zone_states(profile):
+    # A single indexed lookup of the zone's direct children
+    if profile.role != Profile.ZONAL or profile.zone_id is None:
+        return None
+    return State.objects.filter(path=f'/{profile.zone_id}/').values_list('id', flat=True)
+
+
+def compute_scope(user):
+    profile = Profile.objects.select_related('area', 'unit').get(user=user)
+    states = zone_states(profile)
+    return profile_scope(profile, () if states is None else states)
+
+
+async def acompute_scope(user):
+    profile = await Profile.objects.select_related('area', 'unit').aget(user=user)
+    states = zone_states(profile)
+    return profile_scope(profile, () if states is None else [state_id async for state_id in states])
+
+
+def cached_scope(value):
+    role, state_ids = value
+    return Scope(role, None if state_ids is None else frozenset(state_ids))
+
+
+def cache_value(scope):
+    return scope.role, None if scope.state_ids is None else sorted(scope.state_ids)
+
+
+def resolve_scope(user):
+    cache = scope_cache()
+    key = scope_cache_key(user.pk)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached_scope(cached)
+    scope = compute_scope(user)
+    cache.set(key, cache_value(scope), SCOPE_CACHE_TIMEOUT)
+    return scope
+
+
+async def aresolve_scope(user):
+    """``resolve_scope`` through the async cache and ORM, for views running on the event loop."""
+    cache = scope_cache()
+    key = scope_cache_key(user.pk, await cache.aget(GENERATION_KEY, 0))
+    cached = await cache.aget(key)
+    if cached is not None:
+        return cached_scope(cached)
+    scope = await acompute_scope(user)
+    await cache.aset(key, cache_value(scope), SCOPE_CACHE_TIMEOUT)
+    return scope
+
+
+def invalidate_user_scope(user_id):
+    scope_cache().delete(scope_cache_key(user_id))
+
+
+def invalidate_all_scopes():
+    # Entries of older generations are never read again and expire on their own
+    cache = scope_cache()
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.add(GENERATION_KEY, 0, None)
+        cache.incr(GENERATION_KEY)
+
+
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=Profile)
+def profile_changed(sender, instance, **kwargs):
+    invalidate_user_scope(instance.user_id)
+
+
+@receiver(post_save, sender=Zone)
+@receiver(post_save, sender=State)
+@receiver(post_save, sender=Area)
+@receiver(post_save, sender=Unit)
+@receiver(post_delete, sender=Zone)
+@receiver(post_delete, sender=State)
+@receiver(post_delete, sender=Area)
+@receiver(post_delete, sender=Unit)
+def hierarchy_changed(sender, **kwargs):
+    invalidate_all_scopes()
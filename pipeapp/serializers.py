@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from django.contrib.auth.password_validation import validate_password
+from django.contrib.auth.validators import UnicodeUsernameValidator
 from .models import Profile, Zone, State, Area, Unit, PipelineRoute, PipelineFault
 from rest_framework import serializers
 from django.contrib.auth import authenticate
@@ -107,10 +108,12 @@ class UserDetailSerializer(serializers.ModelSerializer):
 class LoginSerializer(serializers.Serializer):
     username = serializers.CharField()
     password = serializers.CharField(write_only=True)
+    session = serializers.BooleanField(
+        required=False, default=True, help_text='Set to false to receive only a token, without a session cookie')
 
     class Meta:
         model = CustomUser
-        fields = ['username', 'password']
+        fields = ['username', 'password', 'session']
 
     def validate(self, data):
         username = data.get('username')
@@ -124,17 +127,69 @@ class LoginSerializer(serializers.Serializer):
         data['user'] = user
         return data
 
+class RosterEntrySerializer(serializers.Serializer):
+    # One user of a provisioning roster; hierarchy names are resolved in bulk by provisioning.py
+    username = serializers.CharField(max_length=150, validators=[UnicodeUsernameValidator()])
+    email = serializers.EmailField()
+    password = serializers.CharField(write_only=True, validators=[validate_password])
+    first_name = serializers.CharField(max_length=150, required=False, allow_blank=True, default='')
+    last_name = serializers.CharField(max_length=150, required=False, allow_blank=True, default='')
+    role = serializers.ChoiceField(choices=Profile.ROLE_CHOICES, default=Profile.UNIT)
+    location = serializers.CharField(max_length=255, required=False, allow_blank=True, allow_null=True, default=None)
+    zone = serializers.CharField(max_length=100, required=False, allow_blank=True, default='')
+    state = serializers.CharField(max_length=100, required=False, allow_blank=True, default='')
+    area = serializers.CharField(max_length=100, required=False, allow_blank=True, default='')
+    unit = serializers.CharField(max_length=100, required=False, allow_blank=True, default='')
+
 
 from rest_framework import serializers
 from .models import PipelineRoute, State, PipelineFault
+from .geometry import decode_coordinates, decode_distances, encode_base64, encode_polyline, normalize_coordinates, point_location
+
+GEOMETRY_FORMATS = ('json', 'polyline', 'binary')
+
+class RouteCoordinatesField(serializers.JSONField):
+    """
+    Route coordinates as a list of {latitude, longitude} objects.
+
+    The output follows the ``geometry_format`` serializer context: 'json' (default),
+    'polyline' for a Google encoded polyline string, or 'binary' for the stored
+    packed geometry in base64 (see pipeapp.geometry). A ``tolerance`` context picks
+    one of the stored simplified geometries and ``precision`` rounds the output to
+    that many decimal places.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['source'] = '*'
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        try:
+            return {'coordinates': normalize_coordinates(super().to_internal_value(data))}
+        except ValueError as exc:
+            raise serializers.ValidationError(str(exc))
+
+    def to_representation(self, instance):
+        geometry_format = self.context.get('geometry_format', 'json')
+        tolerance = self.context.get('tolerance')
+        precision = self.context.get('precision')
+        geometry = instance.geometry_for_tolerance(tolerance)
+        if geometry_format == 'polyline':
+            return encode_polyline(geometry, precision=5 if precision is None else precision)
+        if geometry_format == 'binary':
+            return encode_base64(geometry)
+        if tolerance is None and precision is None:
+            return instance.coordinates
+        return decode_coordinates(geometry, precision=precision)
 
 class PipelineRouteSerializer(serializers.ModelSerializer):
     state = serializers.CharField()  # Accept state as a char field (name)
+    coordinates = RouteCoordinatesField()
 
     class Meta:
         model = PipelineRoute
-        fields = ['id', 'name', 'state', 'coordinates']
-        read_only_fields = ['id']
+        fields = ['id', 'name', 'state', 'coordinates', 'length_m', 'segment_count']
+        read_only_fields = ['id', 'length_m', 'segment_count']
 
     def create(self, validated_data):
         state_name = validated_data.pop('state')
@@ -159,40 +214,157 @@ class PipelineRouteSerializer(serializers.ModelSerializer):
             setattr(instance, attr, value)
         instance.save()
         return instance
+# A route row of a bulk ingestion. Names and states are checked a batch at a time
+# by pipeapp.ingest rather than per row, so there are no database validators here.
+class RouteIngestSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=255)
+    state = serializers.CharField()
+    coordinates = RouteCoordinatesField()
+
+from django.db import router, transaction
+from django.db.models.deletion import Collector
 from rest_framework import serializers
-from .models import PipelineRoute, PipelineFault, State
+from .changes import record_changes
+from .models import PipelineRoute, PipelineFault, State, Tombstone
+
+def validate_fault_coordinates(value):
+    if point_location(value) == (None, None):
+        raise serializers.ValidationError('Expected an object with numeric latitude and longitude.')
+    return value
 
 # Serializer for individual faults
 class PipelineFaultSerializer(serializers.ModelSerializer):
+    # Writable so a route write can address its existing faults, see sync_route_faults
+    id = serializers.IntegerField(required=False)
+
+    class Meta:
+        model = PipelineFault
+        fields = ['id', 'client_key', 'fault_coordinates', 'description', 'reported_at', 'status']
+
+    def validate_fault_coordinates(self, value):
+        return validate_fault_coordinates(value)
+
+    def validate_client_key(self, value):
+        return value or None
+
+def sync_route_faults(route, faults_data, existing=()):
+    """
+    Make a route's faults match ``faults_data``. Items are matched to ``existing``
+    faults by id, then by client_key; matched faults are updated only if a field
+    changed, unmatched items are inserted and faults missing from the payload are
+    deleted. Untouched faults keep their row and reported_at.
+    """
+    by_id = {fault.pk: fault for fault in existing}
+    by_key = {fault.client_key: fault for fault in existing if fault.client_key is not None}
+
+    matched, created, changed = set(), [], []
+    for index, data in enumerate(faults_data):
+        fault_id, client_key = data.get('id'), data.get('client_key')
+        if fault_id is not None:
+            fault = by_id.get(fault_id)
+            if fault is None:
+                raise serializers.ValidationError({'faults': [f'Fault {fault_id} does not belong to this route.']})
+        else:
+            fault = by_key.get(client_key) if client_key is not None else None
+        if fault is not None and fault.pk in matched:
+            raise serializers.ValidationError({'faults': [f'Fault at position {index} repeats an earlier fault.']})
+
+        if fault is None:
+            fault = PipelineFault(pipeline_route=route, **{field: data[field] for field in PipelineFault.WRITE_FIELDS if field in data})
+            fault.refresh_location()
+            created.append(fault)
+            continue
+        matched.add(fault.pk)
+        updates = {field: data[field] for field in PipelineFault.WRITE_FIELDS if field in data and getattr(fault, field) != data[field]}
+        if updates:
+            for field, value in updates.items():
+                setattr(fault, field, value)
+            fault.refresh_location()
+            changed.append(fault)
+
+    keys = [fault.client_key for fault in [*created, *(by_id[pk] for pk in matched)] if fault.client_key is not None]
+    if len(keys) != len(set(keys)):
+        raise serializers.ValidationError({'faults': ['client_key must be unique within the route.']})
+
+    removed = [pk for pk in by_id if pk not in matched]
+    with transaction.atomic():
+        if removed:
+            # The route is the origin, so the fault signals leave the summary to us
+            collector = Collector(using=router.db_for_write(PipelineFault), origin=route)
+            collector.collect(PipelineFault.objects.filter(pk__in=removed))
+            collector.delete()
+        if changed:
+            PipelineFault.objects.bulk_update(changed, [*PipelineFault.WRITE_FIELDS, 'latitude', 'longitude'])
+        if created:
+            PipelineFault.objects.bulk_create(created)
+        # bulk writes skip the fault signals, refresh the stored summary once
+        if removed or changed or created:
+            route.refresh_fault_summary()
+            record_changes(
+                route_ids=[route.pk], fault_ids=[fault.pk for fault in [*changed, *created]],
+                removed=[(Tombstone.FAULT, pk, route.state_id) for pk in removed],
+            )
+
+# A sensor reading queued by the telemetry endpoint. Validation stays in memory,
+# the routes of a whole request are checked at once by the view
+class TelemetryReadingSerializer(serializers.Serializer):
+    route = serializers.IntegerField()
+    fault_coordinates = serializers.JSONField()
+    status = serializers.ChoiceField(choices=PipelineFault.FAULT_STATUS_CHOICES, default='normal')
+    description = serializers.CharField(required=False, allow_blank=True, allow_null=True)
+    reported_at = serializers.DateTimeField(required=False)  # Time of the reading, defaults to its arrival
+
+    def validate_fault_coordinates(self, value):
+        return validate_fault_coordinates(value)
+
+# Serializer for faults addressed on their own, outside of their route
+class RouteFaultSerializer(serializers.ModelSerializer):
+    distance = serializers.SerializerMethodField()  # Metres from ?near=, when given
+    snap = serializers.BooleanField(write_only=True, required=False, default=False)  # Attach to the nearest route
+
     class Meta:
         model = PipelineFault
-        fields = ['fault_coordinates', 'description', 'reported_at', 'status']
+        fields = [
+            'id', 'pipeline_route', 'fault_coordinates', 'latitude', 'longitude',
+            'description', 'reported_at', 'status', 'distance', 'snap'
+        ]
+        read_only_fields = ['id', 'latitude', 'longitude', 'reported_at']
+        extra_kwargs = {'pipeline_route': {'required': False}}
+
+    def validate_fault_coordinates(self, value):
+        return validate_fault_coordinates(value)
+
+    def validate(self, attrs):
+        if not attrs.get('snap') and 'pipeline_route' not in attrs and self.instance is None:
+            raise serializers.ValidationError({'pipeline_route': 'This field is required unless snap is true.'})
+        return attrs
+
+    def get_distance(self, obj):
+        distance = getattr(obj, 'distance', None)  # Annotated by filter_faults_near
+        return None if distance is None else round(distance, 1)
 
 # Serializer for PipelineRoute, including faults and computed status
 class PipelineRouteAndFaultSerializer(serializers.ModelSerializer):
     state = serializers.CharField()  # Accept state as a char field (name)
     id = serializers.ReadOnlyField()
     name = serializers.CharField()  # Allow name to be provided and updated
-    coordinates = serializers.JSONField()  # Include coordinates as a JSON field
-    status = serializers.SerializerMethodField()  # Use a method field to get the overall status
+    coordinates = RouteCoordinatesField()  # Coordinates as a list of {latitude, longitude}
+    status = serializers.CharField(read_only=True)  # Worst fault status, stored on the route
     faults = PipelineFaultSerializer(many=True)  # Allow creating faults with the route
+    cumulative_distances = serializers.SerializerMethodField()  # Metres along the route at each vertex, single routes only
 
     class Meta:
         model = PipelineRoute
         fields = [
-            'id', 'name', 'state', 'coordinates', 
-            'status', 'faults'
+            'id', 'name', 'state', 'coordinates', 'length_m', 'segment_count',
+            'cumulative_distances', 'status', 'normal_fault_count', 'warning_fault_count',
+            'critical_fault_count', 'faults'
+        ]
+        read_only_fields = [
+            'id', 'length_m', 'segment_count', 'normal_fault_count', 'warning_fault_count', 'critical_fault_count'
         ]
-        read_only_fields = ['id']
-
-    def get_status(self, obj):
-        # Determine the overall status based on related faults
-        if obj.faults.filter(status='critical').exists():
-            return 'critical'
-        elif obj.faults.filter(status='warning').exists():
-            return 'warning'
-        return 'normal'
 
+    @transaction.atomic
     def create(self, validated_data):
         # Extract faults data from validated data
         faults_data = validated_data.pop('faults', [])
@@ -210,16 +382,11 @@ class PipelineRouteAndFaultSerializer(serializers.ModelSerializer):
             }
         )
 
-        # If updating, clear existing faults
-        if not created:
-            pipeline_route.faults.all().delete()
-
-        # Create new faults
-        for fault_data in faults_data:
-            PipelineFault.objects.create(pipeline_route=pipeline_route, **fault_data)
-
+        # A route posted again under the same name has its faults reconciled, not replaced
+        sync_route_faults(pipeline_route, faults_data, existing=() if created else pipeline_route.faults.all())
         return pipeline_route
 
+    @transaction.atomic
     def update(self, instance, validated_data):
         # Handle state
         state_name = validated_data.pop('state', None)
@@ -229,21 +396,31 @@ class PipelineRouteAndFaultSerializer(serializers.ModelSerializer):
             except State.DoesNotExist:
                 raise serializers.ValidationError({'state': f"State '{state_name}' does not exist."})
             instance.state = state
-        
+
+        # Faults are written separately, the reverse relation can't be assigned
+        faults_data = validated_data.pop('faults', None)
+
         # Update pipeline route attributes
         for attr, value in validated_data.items():
             setattr(instance, attr, value)
         
         instance.save()
         
-        # Update or create related faults
-        faults_data = validated_data.pop('faults', None)
+        # Insert, update and delete only the faults that differ from the payload
         if faults_data is not None:
-            # First, clear existing faults
-            instance.faults.all().delete()
-            
-            # Then, create new faults
-            for fault_data in faults_data:
-                PipelineFault.objects.create(pipeline_route=instance, **fault_data)
+            sync_route_faults(instance, faults_data, existing=instance.faults.all())
 
         return instance
+
+    def get_cumulative_distances(self, obj):
+        # Only decoded for a single route, listings and changes leave the column unread
+        if not self.context.get('include_distances'):
+            return None
+        return [round(distance, 1) for distance in decode_distances(obj.cumulative_distances).tolist()]
+
+# A route in a delta sync; its faults are synced on their own
+class RouteChangeSerializer(PipelineRouteAndFaultSerializer):
+    faults = None
+
+    class Meta(PipelineRouteAndFaultSerializer.Meta):
+        fields = [field for field in PipelineRouteAndFaultSerializer.Meta.fields if field != 'faults']
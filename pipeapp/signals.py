@@ -0,0 +1,8 @@
+from django.dispatch import Signal
+
+# Sent with ``instances`` after routes are written with bulk_create, which skips
+# post_save. Receivers run inside the writing transaction.
+routes_bulk_created = Signal()
+
+# Sent with ``instances`` after faults are written with bulk_create, likewise.
+faults_bulk_created = Signal()
@@ -0,0 +1,240 @@
+"""
+Nearest-route lookup for fault reports.
+
+Every route segment is registered in the cells of a uniform lat/lon grid
+that its bounding box touches. A query walks rings of cells outwards from
+the point, measures the distance to the candidate segments in a local
+equirectangular projection, and stops once no unvisited cell can hold
+anything closer.
+
+The index lives in process memory and follows the change sequence of
+pipeapp.changes, which every process writes to the database: before each
+lookup it reads the counter, and when another write has committed since it
+last looked, it re-reads the routes stamped since then and drops those
+tombstoned, whichever process wrote them. It only rebuilds from scratch
+when the tombstones it needs have been pruned.
+
+A lookup searches at most PIPEAPP_SNAP_MAX_DISTANCE metres by default, and
+never further than MAX_RADIUS.
+"""
+import math
+import threading
+from collections import defaultdict
+from dataclasses import dataclass
+
+import numpy as np
+from django.conf import settings
+
+from .changes import change_horizon
+from .filters import MAX_RADIUS
+from .geometry import COORDINATE_SCALE, EARTH_RADIUS_M, decode_fixed, haversine
+from .models import PipelineRoute, Tombstone
+
+SNAP_MAX_DISTANCE = getattr(settings, 'PIPEAPP_SNAP_MAX_DISTANCE', 1000)
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180
+
+
+@dataclass
+class SnapResult:
+    route_id: int
+    state_id: int
+    segment: int  # Index of the segment's first vertex
+    fraction: float  # Position along the segment, 0 at its first vertex
+    latitude: float  # Closest point on the route
+    longitude: float
+    distance: float  # Metres from the query point to the closest point
+
+
+class RouteSnapIndex:
+
+    def __init__(self, cell_size=None):
+        self.cell_size = cell_size or getattr(settings, 'PIPEAPP_SNAP_CELL_SIZE', 0.01)
+        self.lock = threading.RLock()
+        self.version = None  # Last change number applied, None until built
+        self.cells = defaultdict(set)
+        self.routes = {}
+        self.extent = None  # (min_row, max_row, min_col, max_col) of every cell ever filled
+
+    def cell(self, latitude, longitude):
+        return math.floor(latitude / self.cell_size), math.floor(longitude / self.cell_size)
+
+    def segment_cells(self, lat_a, lon_a, lat_b, lon_b):
+        row_a, col_a = self.cell(min(lat_a, lat_b), min(lon_a, lon_b))
+        row_b, col_b = self.cell(max(lat_a, lat_b), max(lon_a, lon_b))
+        return [(row, col) for row in range(row_a, row_b + 1) for col in range(col_a, col_b + 1)]
+
+    def _add(self, route_id, state_id, geometry):
+        lats, lons = decode_fixed(geometry)
+        lats = np.asarray(lats, dtype=float) / COORDINATE_SCALE
+        lons = np.asarray(lons, dtype=float) / COORDINATE_SCALE
+        cells = set()
+        if len(lats) == 1:
+            # A single vertex is kept as a zero length segment
+            lats, lons = np.repeat(lats, 2), np.repeat(lons, 2)
+        for segment in range(len(lats) - 1):
+            for key in self.segment_cells(lats[segment], lons[segment], lats[segment + 1], lons[segment + 1]):
+                self.cells[key].add((route_id, segment))
+                cells.add(key)
+        self.routes[route_id] = (state_id, lats, lons, cells)
+        if cells:
+            rows = [key[0] for key in cells]
+            cols = [key[1] for key in cells]
+            if self.extent is None:
+                self.extent = (min(rows), max(rows), min(cols), max(cols))
+            else:
+                min_row, max_row, min_col, max_col = self.extent
+                self.extent = (min(min_row, *rows), max(max_row, *rows), min(min_col, *cols), max(max_col, *cols))
+
+    def _remove(self, route_id):
+        entry = self.routes.pop(route_id, None)
+        if entry is None:
+            return
+        for key in entry[3]:
+            members = self.cells.get(key)
+            if members:
+                members.difference_update({item for item in members if item[0] == route_id})
+                if not members:
+                    del self.cells[key]
+
+    def rebuild(self):
+        with self.lock:
+            # Read first: routes written meanwhile are applied again next time, never missed
+            version, _ = change_horizon()
+            self.cells = defaultdict(set)
+            self.routes = {}
+            self.extent = None
+            routes = PipelineRoute.objects.only('id', 'state_id', 'geometry').order_by('id')
+            for route in routes.iterator(chunk_size=500):
+                self._add(route.pk, route.state_id, route.geometry)
+            self.version = version
+
+    def catch_up(self, version):
+        """Apply the route writes and deletes stamped after ``self.version`` up to ``version``."""
+        removed = Tombstone.objects.filter(kind=Tombstone.ROUTE, change_seq__gt=self.version)
+        for route_id in removed.values_list('object_id', flat=True):
+            self._remove(route_id)
+        # Fault writes stamp their route too, re-adding it is cheap
+        routes = PipelineRoute.objects.filter(change_seq__gt=self.version).only('id', 'state_id', 'geometry')
+        for route in routes.iterator(chunk_size=500):
+            self._remove(route.pk)
+            self._add(route.pk, route.state_id, route.geometry)
+        self.version = version
+
+    def ensure_current(self):
+        current, pruned_through = change_horizon()
+        with self.lock:
+            if self.version is None or not pruned_through <= self.version <= current:
+                self.rebuild()
+            elif self.version != current:
+                self.catch_up(current)
+
+    def _closest(self, latitude, longitude, candidates):
+        # Project around the query point so distances are in metres
+        route_ids = np.fromiter((item[0] for item in candidates), dtype=np.int64, count=len(candidates))
+        segments = np.fromiter((item[1] for item in candidates), dtype=np.int64, count=len(candidates))
+        a_lat = np.empty(len(candidates))
+        a_lon = np.empty(len(candidates))
+        b_lat = np.empty(len(candidates))
+        b_lon = np.empty(len(candidates))
+        for i, (route_id, segment) in enumerate(candidates):
+            _, lats, lons, _ = self.routes[route_id]
+            a_lat[i], a_lon[i], b_lat[i], b_lon[i] = lats[segment], lons[segment], lats[segment + 1], lons[segment + 1]
+
+        x_scale = METRES_PER_DEGREE * math.cos(math.radians(latitude))
+        ax, ay = (a_lon - longitude) * x_scale, (a_lat - latitude) * METRES_PER_DEGREE
+        dx, dy = (b_lon - a_lon) * x_scale, (b_lat - a_lat) * METRES_PER_DEGREE
+        length_sq = dx * dx + dy * dy
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.where(length_sq > 0, -(ax * dx + ay * dy) / length_sq, 0.0)
+        fraction = np.clip(fraction, 0.0, 1.0)
+        distance = np.hypot(ax + fraction * dx, ay + fraction * dy)
+
+        best = int(np.argmin(distance))
+        route_id = int(route_ids[best])
+        return SnapResult(
+            route_id=route_id,
+            state_id=self.routes[route_id][0],
+            segment=int(segments[best]),
+            fraction=float(fraction[best]),
+            latitude=float(a_lat[best] + fraction[best] * (b_lat[best] - a_lat[best])),
+            longitude=float(a_lon[best] + fraction[best] * (b_lon[best] - a_lon[best])),
+            distance=float(distance[best]),
+        )
+
+    def nearest(self, latitude, longitude, max_distance=None, state_ids=None, exclude=()):
+        """
+        Closest route to a point within ``max_distance`` metres, by default
+        PIPEAPP_SNAP_MAX_DISTANCE and at most MAX_RADIUS, optionally restricted
+        to routes in ``state_ids`` and never one of ``exclude``. Returns a
+        SnapResult or None.
+        """
+        max_distance = min(max_distance or SNAP_MAX_DISTANCE, MAX_RADIUS)
+        self.ensure_current()
+        with self.lock:
+            if not self.cells:
+                return None
+            row, col = self.cell(latitude, longitude)
+            # Metres spanned by one cell in its narrowest direction near the point
+            cell_metres = self.cell_size * METRES_PER_DEGREE * max(math.cos(math.radians(min(abs(latitude) + self.cell_size, 90))), 1e-6)
+            min_row, max_row, min_col, max_col = self.extent
+            max_ring = max(abs(row - min_row), abs(row - max_row), abs(col - min_col), abs(col - max_col))
+            max_ring = min(max_ring, int(max_distance / cell_metres) + 1)
+
+            best = None
+            seen = set()
+            for ring in range(max_ring + 1):
+                candidates = []
+                for key in self._ring(row, col, ring):
+                    for item in self.cells.get(key, ()):
+                        if item in seen:
+                            continue
+                        seen.add(item)
+                        if item[0] in exclude:
+                            continue
+                        if state_ids is None or self.routes[item[0]][0] in state_ids:
+                            candidates.append(item)
+                if candidates:
+                    result = self._closest(latitude, longitude, candidates)
+                    if best is None or result.distance < best.distance:
+                        best = result
+                # Anything in a further ring is at least ``ring`` cells away
+                if best is not None and best.distance <= ring * cell_metres:
+                    break
+
+        if best is None:
+            return None
+        # Report the great circle distance rather than the projected one
+        best.distance = float(haversine(latitude, longitude, [best.latitude], [best.longitude])[0])
+        if best.distance > max_distance:
+            return None
+        return best
+
+    def nearest_route(self, latitude, longitude, max_distance=None, state_ids=None, routes=None):
+        """
+        ``nearest`` with the route's row read from ``routes``, all routes by
+        default, as ``(SnapResult, route)``, or ``(None, None)`` out of range.
+        """
+        routes = PipelineRoute.objects.all() if routes is None else routes
+        exclude = set()
+        while (result := self.nearest(latitude, longitude, max_distance, state_ids, exclude)) is not None:
+            route = routes.filter(pk=result.route_id).first()
+            if route is not None:
+                return result, route
+            # Deleted since the index last caught up, the next closest may still be in range
+            exclude.add(result.route_id)
+        return None, None
+
+    @staticmethod
+    def _ring(row, col, ring):
+        if ring == 0:
+            yield row, col
+            return
+        for offset in range(-ring, ring + 1):
+            yield row - ring, col + offset
+            yield row + ring, col + offset
+        for offset in range(-ring + 1, ring):
+            yield row + offset, col - ring
+            yield row + offset, col + ring
+
+
+snap_index = RouteSnapIndex()
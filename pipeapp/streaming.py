@@ -0,0 +1,72 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+
+from .renderers import NDJSONRenderer, encode_line
+
+STREAM_CHUNK_SIZE = getattr(settings, 'PIPEAPP_STREAM_CHUNK_SIZE', 500)
+
+
+def iter_serialized(queryset, serializer_class, context, chunk_size):
+    # iterator() with a chunk size runs the queryset's prefetches once per chunk,
+    # so only one chunk of routes and their faults is ever held in memory
+    for instance in queryset.iterator(chunk_size=chunk_size):
+        yield serializer_class(instance, context=context).data
+
+
+def ndjson_chunks(items, chunk_size):
+    buffer = []
+    for item in items:
+        buffer.append(encode_line(item))
+        if len(buffer) >= chunk_size:
+            yield b''.join(buffer)
+            buffer = []
+    if buffer:
+        yield b''.join(buffer)
+
+
+def json_array_chunks(items, chunk_size):
+    encoder = JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    yield b'['
+    buffer = []
+    first = True
+    for item in items:
+        buffer.append(('' if first else ',') + encoder.encode(item))
+        first = False
+        if len(buffer) >= chunk_size:
+            yield ''.join(buffer).encode('utf-8')
+            buffer = []
+    buffer.append(']')
+    yield ''.join(buffer).encode('utf-8')
+
+
+def streaming_list_response(queryset, serializer_class, context, ndjson=False, chunk_size=None):
+    """Serialize ``queryset`` into the response body as rows are read from the database."""
+    chunk_size = chunk_size or STREAM_CHUNK_SIZE
+    items = iter_serialized(queryset, serializer_class, context, chunk_size)
+    if ndjson:
+        response = StreamingHttpResponse(ndjson_chunks(items, chunk_size), content_type=NDJSONRenderer.media_type)
+    else:
+        response = StreamingHttpResponse(json_array_chunks(items, chunk_size), content_type='application/json')
+    # Ask reverse proxies to pass chunks through instead of buffering the whole body
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def aiter_chunks(chunks):
+    """
+    ``chunks`` pulled one at a time in a ``sync_to_async`` hop, so an ASGI
+    server sends each as it is built rather than building the whole body first.
+    """
+    chunks = iter(chunks)
+    # The hops run on the request's sync thread, where the open database cursor lives
+    while (chunk := await sync_to_async(next)(chunks, None)) is not None:
+        yield chunk
+
+
+def as_async_stream(response):
+    """Give a streaming response built by sync code an async iterator, for views running on the event loop."""
+    if getattr(response, 'streaming', False) and not response.is_async:
+        response.streaming_content = aiter_chunks(response.streaming_content)
+    return response
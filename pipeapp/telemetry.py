@@ -0,0 +1,178 @@
+"""
+Write-behind buffer for fault telemetry.
+
+Requests only append readings to a bounded in-process buffer and return.
+A background thread drains the buffer into batched inserts, either when
+PIPEAPP_TELEMETRY_BATCH_SIZE readings are waiting or every
+PIPEAPP_TELEMETRY_FLUSH_INTERVAL seconds, so a burst of sensor posts costs
+one write transaction instead of one each. When the buffer holds
+PIPEAPP_TELEMETRY_QUEUE_SIZE readings new ones are refused, and the
+endpoint answers 503 until the flusher catches up. Whatever is buffered
+is flushed when the process exits normally.
+
+A batch whose write fails with a database error, say a locked SQLite file,
+is kept and written again after a backoff doubling from the flush interval,
+up to PIPEAPP_TELEMETRY_MAX_RETRIES times. It still counts against the
+buffer's capacity meanwhile. Only then are its readings dropped and counted
+in ``dropped``, which the endpoint reports with the other counters.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connections
+
+from .ingest import create_faults
+from .models import PipelineFault, PipelineRoute
+
+logger = logging.getLogger(__name__)
+
+
+class TelemetryBuffer:
+
+    def __init__(self, capacity=None, batch_size=None, flush_interval=None):
+        self.capacity = capacity or getattr(settings, 'PIPEAPP_TELEMETRY_QUEUE_SIZE', 10000)
+        self.batch_size = batch_size or getattr(settings, 'PIPEAPP_TELEMETRY_BATCH_SIZE', 500)
+        self.flush_interval = flush_interval or getattr(settings, 'PIPEAPP_TELEMETRY_FLUSH_INTERVAL', 1.0)
+        self.max_retries = getattr(settings, 'PIPEAPP_TELEMETRY_MAX_RETRIES', 5)
+        self.background = True  # Tests turn this off and call flush() themselves
+        self.pending = []
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        self.stopping = False
+        self.written = 0
+        self.dropped = 0
+        self.failed = None  # The batch whose write failed, kept for a retry
+        self.attempts = 0
+        self.retry_at = 0.0
+
+    def offer(self, readings):
+        """
+        Queue readings, each a dict of PipelineFault fields plus an optional
+        reported_at. Either all are accepted or, when they don't fit, none.
+        """
+        with self.condition:
+            if len(self) + len(readings) > self.capacity:
+                return False
+            self.pending.extend(readings)
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify()
+        if self.background:
+            self.ensure_started()
+        return True
+
+    def __len__(self):
+        return len(self.pending) + len(self.failed or ())
+
+    def stats(self):
+        return {'pending': len(self), 'written': self.written, 'dropped': self.dropped, 'retries': self.attempts}
+
+    def ensure_started(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.condition:
+            if self.thread is None or not self.thread.is_alive():
+                self.stopping = False
+                self.thread = threading.Thread(target=self.run, name='pipeapp-telemetry', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                with self.condition:
+                    self.condition.wait_for(
+                        lambda: self.stopping or len(self.pending) >= self.batch_size, timeout=self.flush_interval
+                    )
+                    stopping = self.stopping
+                close_old_connections()
+                self.flush(force=stopping)
+                if stopping:
+                    return
+        finally:
+            connections.close_all()
+
+    def take(self):
+        with self.condition:
+            batch = self.pending[:self.batch_size]
+            del self.pending[:self.batch_size]
+            return batch
+
+    def flush(self, force=False):
+        """
+        Write everything buffered, a batch per transaction, and a failed batch
+        once its backoff is over, or right away with ``force``. Stops at the
+        first failure. Returns the number of faults written.
+        """
+        written = 0
+        with self.flush_lock:
+            if self.failed is not None:
+                if not force and time.monotonic() < self.retry_at:
+                    return 0
+                batch, self.failed = self.failed, None
+                written += self.write(batch)
+                if self.failed is not None:
+                    return written
+            while batch := self.take():
+                written += self.write(batch)
+                if self.failed is not None:
+                    break
+        return written
+
+    def write(self, batch):
+        try:
+            # Routes may have been deleted since the readings were accepted
+            route_ids = set(PipelineRoute.objects.filter(
+                pk__in={reading['pipeline_route_id'] for reading in batch}
+            ).values_list('id', flat=True))
+            faults, reported_at, missing = [], [], 0
+            for reading in batch:
+                if reading['pipeline_route_id'] not in route_ids:
+                    missing += 1
+                    continue
+                fields = dict(reading)
+                timestamp = fields.pop('reported_at', None)
+                fault = PipelineFault(**fields)
+                fault.refresh_location()
+                faults.append(fault)
+                if timestamp is not None:
+                    reported_at.append((fault, timestamp))
+            if faults:
+                create_faults(faults, reported_at)
+        except DatabaseError:
+            self.retry_later(batch)
+            return 0
+        self.dropped += missing
+        self.written += len(faults)
+        self.attempts = 0
+        return len(faults)
+
+    def retry_later(self, batch):
+        self.attempts += 1
+        if self.attempts > self.max_retries:
+            self.dropped += len(batch)
+            self.attempts = 0
+            logger.exception('Dropped %d telemetry readings after %d retries', len(batch), self.max_retries)
+            return
+        delay = min(self.flush_interval * 2 ** (self.attempts - 1), 60)
+        logger.warning('Telemetry write failed, retrying %d readings in %.1fs', len(batch), delay, exc_info=True)
+        self.failed = batch
+        self.retry_at = time.monotonic() + delay
+
+    def stop(self, timeout=10):
+        """Stop the flusher after it has written everything buffered."""
+        thread = self.thread
+        if thread is None or not thread.is_alive():
+            if len(self):
+                self.flush(force=True)
+            return
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        thread.join(timeout)
+
+
+telemetry_buffer = TelemetryBuffer()
+atexit.register(telemetry_buffer.stop)
@@ -1,3 +1,1942 @@
-from django.test import TestCase
+import asyncio
+import base64
+import contextlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import warnings
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+
+from django.core.cache import cache, caches
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import LiveServerTestCase, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path
+
+from rest_framework.authtoken.models import Token
+
+from . import benchmarks, events, filters, geometry, scope
+from .authentication import CredentialCache, basic_cache
+from .changes import COUNTER_ID, encode_cursor, next_change_seq, scope_digest
+from .events import broker
+from .models import Area, ChangeCounter, Profile, PipelineRoute, PipelineFault, ROUTE_TOLERANCES, State, Tombstone, Unit, Zone
+from .pagination import IdCursorPagination
+from .ingest import create_faults, iter_geojson_features
+from .listing_cache import cached_listing
+from .scope import aresolve_scope, resolve_scope
+from .snapping import RouteSnapIndex, snap_index
+from .telemetry import TelemetryBuffer, telemetry_buffer
+from .urls import async_read_urlpatterns
+
+
+FAST_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+# The URLs as served through ASGI, for AsyncReadTests
+urlpatterns = [
+    path('pipeapp/', include(async_read_urlpatterns)),
+    path('pipeapp/', include('pipeapp.urls')),
+]
+
+
+def seed_dataset(*args, **kwargs):
+    # Cached listings are keyed by data versions, which start over in every rolled back test
+    cache.clear()
+    return benchmarks.seed_dataset(*args, **kwargs)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class EndpointQueryBudgetTests(TestCase):
+    """Every endpoint must stay within its query budget, whatever the dataset size."""
+
+    def run_within_budgets(self, routes, prefix):
+        dataset = seed_dataset(routes, faults_per_route=3, points_per_route=5, prefix=prefix)
+        results = benchmarks.run_benchmarks(dataset)
+        for result in results:
+            with self.subTest(scenario=result['scenario'], role=result['role'], routes=routes):
+                self.assertLess(result['status_code'], 400)
+                self.assertLessEqual(result['queries'], result['query_budget'], '\n'.join(result['sql']))
+        return {(result['scenario'], result['role']): result['queries'] for result in results}
+
+    def test_small_dataset(self):
+        self.run_within_budgets(5, prefix='Small')
+
+    def test_reads_do_not_grow_with_dataset(self):
+        small = self.run_within_budgets(3, prefix='Small')
+        large = self.run_within_budgets(40, prefix='Large')
+        for scenario in ('routes.list', 'routes.retrieve'):
+            for role in benchmarks.ROLES:
+                self.assertEqual(small[(scenario, role)], large[(scenario, role)], (scenario, role))
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class ExplainPlanTests(TestCase):
+
+    def test_hot_queries_are_explained(self):
+        dataset = seed_dataset(3, faults_per_route=1, points_per_route=2)
+        plans = benchmarks.explain_plans(dataset)
+        self.assertEqual(set(plans), set(benchmarks.hot_querysets(dataset)))
+        self.assertIn('pipeline_route_id', plans['faults.prefetch'])
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class RouteFaultSummaryTests(TestCase):
+
+    def setUp(self):
+        self.dataset = seed_dataset(2, faults_per_route=0, points_per_route=2)
+        self.route, self.other = (PipelineRoute.objects.get(pk=route.pk) for route in self.dataset['routes'])
+
+    def fault(self, route=None, status='normal'):
+        route = route or self.route
+        return PipelineFault.objects.create(pipeline_route=route, fault_coordinates=route.coordinates[0], status=status)
+
+    def summary(self, route=None):
+        route = PipelineRoute.objects.get(pk=(route or self.route).pk)
+        return (route.status, route.normal_fault_count, route.warning_fault_count, route.critical_fault_count)
+
+    def test_fault_writes_keep_the_summary(self):
+        normal = self.fault()
+        critical = self.fault(status='critical')
+        self.assertEqual(self.summary(), ('critical', 1, 0, 1))
+
+        critical.status = 'warning'
+        critical.save()
+        self.assertEqual(self.summary(), ('warning', 1, 1, 0))
+
+        critical.pipeline_route = self.other
+        critical.save()
+        self.assertEqual(self.summary(), ('normal', 1, 0, 0))
+        self.assertEqual(self.summary(self.other), ('warning', 0, 1, 0))
+
+        normal.delete()
+        self.assertEqual(self.summary(), ('normal', 0, 0, 0))
+        PipelineFault.objects.filter(pipeline_route=self.other).delete()
+        self.assertEqual(self.summary(self.other), ('normal', 0, 0, 0))
+
+    def test_bulk_created_faults_refresh_the_summary(self):
+        create_faults([
+            PipelineFault(pipeline_route=route, fault_coordinates=route.coordinates[0], status=status)
+            for route, status in [(self.route, 'warning'), (self.route, 'warning'), (self.other, 'critical')]
+        ])
+        self.assertEqual(self.summary(), ('warning', 0, 2, 0))
+        self.assertEqual(self.summary(self.other), ('critical', 0, 0, 1))
+
+    def test_checker_reports_drift_and_backfill_repairs_it(self):
+        self.fault(status='critical')
+        call_command('check_route_status', stdout=io.StringIO())
+        PipelineRoute.objects.filter(pk=self.route.pk).update(status='normal', critical_fault_count=0)
+
+        output = io.StringIO()
+        with self.assertRaises(CommandError):
+            call_command('check_route_status', stdout=output)
+        self.assertIn(f'id={self.route.pk}', output.getvalue())
+        self.assertNotIn(f'id={self.other.pk}', output.getvalue())
+
+        output = io.StringIO()
+        call_command('backfill_route_status', stdout=output)
+        self.assertIn('Updated the fault summary of 1 pipeline routes', output.getvalue())
+        self.assertEqual(self.summary(), ('critical', 0, 0, 1))
+        call_command('check_route_status', stdout=io.StringIO())
+
+
+class RouteCursorPaginationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.dataset = seed_dataset(7, faults_per_route=1, points_per_route=2)
+        self.client = benchmarks.token_client(self.dataset['users'][Profile.NATIONAL])
+
+    def test_pages_cover_every_route_once_in_id_order(self):
+        seen = []
+        url = f'{benchmarks.ROUTES_URL}?page_size=3'
+        while url:
+            page = self.client.get(url).json()
+            self.assertLessEqual(len(page['results']), 3)
+            self.assertNotIn('count', page)
+            seen.extend(route['id'] for route in page['results'])
+            url = page['next']
+        self.assertEqual(seen, sorted(route.pk for route in self.dataset['routes']))
+
+    def test_inserts_do_not_shift_later_pages(self):
+        first = self.client.get(f'{benchmarks.ROUTES_URL}?page_size=3').json()
+        PipelineRoute.objects.create(name='Inserted', state=self.dataset['states'][0], coordinates=[])
+        second = self.client.get(first['next']).json()
+        self.assertGreater(second['results'][0]['id'], first['results'][-1]['id'])
+
+    def test_count_is_opt_in_and_cached(self):
+        url = f'{benchmarks.ROUTES_URL}?page_size=2&count=1'
+        self.assertEqual(self.client.get(url).json()['count'], 7)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertFalse([q for q in queries.captured_queries if 'COUNT(' in q['sql'].upper()])
+
+    def test_page_size_is_capped(self):
+        self.assertEqual(IdCursorPagination().get_page_size(type('Request', (), {
+            'query_params': {'page_size': '100000'}})()), IdCursorPagination.max_page_size)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class RouteStreamingTests(TestCase):
+
+    def setUp(self):
+        self.dataset = seed_dataset(5, faults_per_route=2, points_per_route=3)
+        self.client = benchmarks.token_client(self.dataset['users'][Profile.NATIONAL])
+
+    def test_stream_param_returns_json_array_of_every_route(self):
+        response = self.client.get(f'{benchmarks.ROUTES_URL}?stream=1')
+        self.assertTrue(response.streaming)
+        routes = json.loads(b''.join(response.streaming_content))
+        self.assertEqual([route['id'] for route in routes], [route.pk for route in self.dataset['routes']])
+        self.assertEqual(len(routes[0]['faults']), 2)
+
+    def test_ndjson_accept_header_streams_one_route_per_line(self):
+        response = self.client.get(benchmarks.ROUTES_URL, HTTP_ACCEPT='application/x-ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(json.loads(lines[0])['name'], self.dataset['routes'][0].name)
+
+    def test_stream_reads_faults_once_per_chunk(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'{benchmarks.ROUTES_URL}?stream=ndjson')
+            b''.join(response.streaming_content)
+        fault_queries = [q for q in queries.captured_queries if 'pipeapp_pipelinefault' in q['sql']]
+        self.assertEqual(len(fault_queries), 1)
+
+
+class GeometryCodecTests(SimpleTestCase):
+    points = [
+        {'latitude': 38.5, 'longitude': -120.2},
+        {'latitude': 40.7, 'longitude': -120.95},
+        {'latitude': 43.252, 'longitude': -126.453},
+    ]
+
+    def test_round_trip(self):
+        self.assertEqual(geometry.decode_coordinates(geometry.encode_coordinates(self.points)), self.points)
+        self.assertEqual(geometry.decode_coordinates(geometry.encode_coordinates([])), [])
+
+    def test_encoded_polyline_matches_reference(self):
+        self.assertEqual(geometry.encode_polyline(geometry.encode_coordinates(self.points)), '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+
+    def test_rejects_malformed_coordinates(self):
+        for value in ({'latitude': 1}, [{'latitude': 'x', 'longitude': 1}], [{'latitude': 91, 'longitude': 0}]):
+            with self.assertRaises(ValueError):
+                geometry.encode_coordinates(value)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class RouteGeometryFormatTests(TestCase):
+
+    def setUp(self):
+        self.dataset = seed_dataset(1, faults_per_route=0, points_per_route=4)
+        self.client = benchmarks.token_client(self.dataset['users'][Profile.NATIONAL])
+        self.route = self.dataset['routes'][0]
+        self.url = f'{benchmarks.ROUTES_URL}{self.route.pk}/'
+
+    def test_json_shape_is_the_default(self):
+        self.assertEqual(self.client.get(self.url).json()['coordinates'], self.route.coordinates)
+
+    def test_encoded_formats_on_request(self):
+        polyline = self.client.get(f'{self.url}?geometry=polyline').json()['coordinates']
+        self.assertEqual(polyline, geometry.encode_polyline(self.route.geometry))
+        packed = self.client.get(f'{self.url}?geometry=binary').json()['coordinates']
+        self.assertEqual(geometry.decode_coordinates(base64.b64decode(packed)), self.route.coordinates)
+        self.assertEqual(self.client.get(f'{self.url}?geometry=wkt').status_code, 400)
+
+    def test_invalid_coordinates_are_rejected(self):
+        payload = benchmarks.route_payload(self.dataset['states'][0].name)
+        payload['coordinates'] = [{'lat': 1}]
+        response = self.client.post(benchmarks.ROUTES_URL, payload, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('coordinates', response.json())
+
+
+    def test_start_end_object_is_a_two_point_route(self):
+        start, end = {'latitude': 6.5244, 'longitude': 3.3792}, {'latitude': 6.8996, 'longitude': 3.2584}
+        payload = benchmarks.route_payload(self.dataset['states'][0].name)
+        payload['coordinates'] = {'start': start, 'end': end}
+        response = self.client.post(benchmarks.ROUTES_URL, payload, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(response.json()['coordinates'], [start, end])
+
+
+class PackedGeometryMigrationTests(TransactionTestCase):
+    """0009 packs the coordinates the routes were stored with before it."""
+
+    before = [('pipeapp', '0008_pipelineroute_fault_summary')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def test_legacy_start_end_rows_are_packed(self):
+        latest = MigrationExecutor(connection).loader.graph.leaf_nodes('pipeapp')
+        apps = self.migrate(self.before)
+        self.addCleanup(self.migrate, latest)
+        zone = apps.get_model('pipeapp', 'Zone').objects.create(name='South West')
+        state = apps.get_model('pipeapp', 'State').objects.create(name='Lagos', zone=zone)
+        LegacyRoute = apps.get_model('pipeapp', 'PipelineRoute')
+        legacy = LegacyRoute.objects.create(name='Legacy', state=state, coordinates={
+            'start': {'latitude': 6.5244, 'longitude': 3.3792}, 'end': {'latitude': 6.8996, 'longitude': 3.2584},
+        })
+        unreadable = LegacyRoute.objects.create(name='Unreadable', state=state, coordinates={'from': 'Lagos'})
+
+        # Unreadable rows stop the migration before their coordinates are dropped
+        with self.assertRaisesMessage(RuntimeError, f'unreadable coordinates: {unreadable.pk}.'):
+            self.migrate(latest)
+        self.assertEqual(LegacyRoute.objects.get(pk=unreadable.pk).coordinates, {'from': 'Lagos'})
+        LegacyRoute.objects.filter(pk=unreadable.pk).update(coordinates=[])
+
+        self.migrate(latest)
+        route = PipelineRoute.objects.get(pk=legacy.pk)
+        self.assertEqual(route.coordinates, [
+            {'latitude': 6.5244, 'longitude': 3.3792}, {'latitude': 6.8996, 'longitude': 3.2584},
+        ])
+        self.assertEqual((route.segment_count, route.min_latitude, route.max_longitude), (1, 6.5244, 3.3792))
+        self.assertEqual(PipelineRoute.objects.get(pk=unreadable.pk).coordinates, [])
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class RouteLevelOfDetailTests(TestCase):
+
+    def setUp(self):
+        self.dataset = seed_dataset(3, faults_per_route=0, points_per_route=2)
+        self.client = benchmarks.token_client(self.dataset['users'][Profile.NATIONAL])
+        # A gently wiggling line: most vertices vanish at coarse tolerances
+        wiggle = [
+            {'latitude': 6.0 + i * 0.0001, 'longitude': 3.0 + (0.00002 if i % 2 else 0)}
+            for i in range(500)
+        ]
+        self.route = PipelineRoute.objects.create(name='Wiggle', state=self.dataset['states'][0], coordinates=wiggle)
+
+    def test_levels_are_stored_and_recomputed_on_change(self):
+        levels = dict(self.route.simplifications.values_list('tolerance', 'point_count'))
+        self.assertEqual(sorted(levels), ROUTE_TOLERANCES)
+        self.assertEqual(levels[min(ROUTE_TOLERANCES)], 500)
+        self.assertEqual(levels[max(ROUTE_TOLERANCES)], 2)
+
+        self.route.coordinates = self.route.coordinates[:10]
+        self.route.save()
+        self.assertEqual(self.route.simplifications.get(tolerance=min(ROUTE_TOLERANCES)).point_count, 10)
+
+    def test_zoom_returns_simplified_coordinates(self):
+        url = f'{benchmarks.ROUTES_URL}{self.route.pk}/'
+        self.assertEqual(len(self.client.get(url).json()['coordinates']), 500)
+        self.assertEqual(len(self.client.get(f'{url}?zoom=5').json()['coordinates']), 2)
+        self.assertEqual(len(self.client.get(f'{url}?tolerance=0.000001').json()['coordinates']), 500)
+        self.assertEqual(self.client.get(f'{url}?zoom=big').status_code, 400)
+
+    def test_list_at_zoom_never_reads_full_geometry(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'{benchmarks.ROUTES_URL}?zoom=5')
+        self.assertEqual(response.status_code, 200)
+        route_queries = [q['sql'] for q in queries.captured_queries if 'FROM "pipeapp_pipelineroute"' in q['sql']]
+        self.assertTrue(route_queries)
+        self.assertFalse([sql for sql in route_queries if '"pipeapp_pipelineroute"."geometry"' in sql])
+        # One extra prefetch for the simplification level
+        self.assertLessEqual(len(queries), benchmarks.QUERY_BUDGETS['routes.list'] + 1)
+
+    def test_precision_quantizes_coordinates(self):
+        point = self.client.get(f'{benchmarks.ROUTES_URL}{self.route.pk}/?precision=3').json()['coordinates'][1]
+        self.assertEqual(point, {'latitude': 6.0, 'longitude': 3.0})
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class FaultSpatialQueryTests(TestCase):
+
+    def setUp(self):
+        self.dataset = seed_dataset(2, faults_per_route=0, points_per_route=2)
+        self.route = self.dataset['routes'][0]
+        self.client = benchmarks.token_client(self.dataset['users'][Profile.NATIONAL])
+        # Roughly 0 m, 1.1 km, 5.5 km and 111 km north of (6.0, 3.0)
+        self.faults = [
+            PipelineFault.objects.create(
+                pipeline_route=self.route,
+                fault_coordinates={'latitude': 6.0 + offset, 'longitude': 3.0},
+            )
+            for offset in (0.0, 0.01, 0.05, 1.0)
+        ]
+
+    def ids(self, response):
+        self.assertEqual(response.status_code, 200, response.content)
+        return [fault['id'] for fault in response.json()['results']]
+
+    def test_location_columns_follow_fault_coordinates(self):
+        fault = self.faults[1]
+        self.assertEqual((fault.latitude, fault.longitude), (6.01, 3.0))
+        fault.fault_coordinates = {'latitude': 7.5, 'longitude': 4.5}
+        fault.save(update_fields=['fault_coordinates'])
+        fault.refresh_from_db()
+        self.assertEqual((fault.latitude, fault.longitude), (7.5, 4.5))
+
+    def test_bbox(self):
+        response = self.client.get(f'{benchmarks.FAULTS_URL}?bbox=2.9,5.9,3.1,6.03')
+        self.assertEqual(self.ids(response), [fault.pk for fault in self.faults[:2]])
+        self.assertEqual(self.client.get(f'{benchmarks.FAULTS_URL}?bbox=3,6,2,7').status_code, 400)
+
+    def test_near_checks_exact_distance(self):
+        response = self.client.get(f'{benchmarks.FAULTS_URL}?near=6.0,3.0&radius=5000')
+        self.assertEqual(self.ids(response), [fault.pk for fault in self.faults[:2]])
+        distances = [fault['distance'] for fault in response.json()['results']]
+        self.assertEqual(distances[0], 0.0)
+        self.assertAlmostEqual(distances[1], 1112, delta=5)
+        self.assertEqual(self.client.get(f'{benchmarks.FAULTS_URL}?near=6.0,3.0').status_code, 400)
+
+    def test_near_filters_in_the_database(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'{benchmarks.FAULTS_URL}?near=6.0,3.0&radius=5000')
+        self.assertEqual(len(self.ids(response)), 2)
+        # Distances are computed by the query itself, no id list is sent back
+        self.assertFalse([query for query in queries if '"pipeapp_pipelinefault"."id" IN' in query['sql']])
+        too_far = self.client.get(f'{benchmarks.FAULTS_URL}?near=6.0,3.0&radius=500000')
+        self.assertEqual(too_far.status_code, 400)
+
+    def test_faults_are_scoped_by_role(self):
+        other_state_route = self.dataset['routes'][1]
+        PipelineFault.objects.create(pipeline_route=other_state_route, fault_coordinates={'latitude': 6.0, 'longitude': 3.0})
+        client = benchmarks.token_client(self.dataset['users'][Profile.STATE])
+        response = client.get(f'{benchmarks.FAULTS_URL}?near=6.0,3.0&radius=100')
+        self.assertEqual(self.ids(response), [self.faults[0].pk])
+        denied = client.post(benchmarks.FAULTS_URL, {
+            'pipeline_route': other_state_route.pk,
+            'fault_coordinates': {'latitude': 6.0, 'longitude': 3.0},
+        }, format='json')
+        self.assertEqual(denied.status_code, 400)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class RouteViewportTests(TestCase):
+
+    def setUp(self):
+        self.dataset = seed_dataset(0)
+        state = self.dataset['states'][0]
+        self.lagos = PipelineRoute.objects.create(name='Lagos', state=state, coordinates=[
+            {'latitude': 6.4, 'longitude': 3.3}, {'latitude': 6.6, 'longitude': 3.5}])
+        self.kano = PipelineRoute.objects.create(name='Kano', state=state, coordinates=[
+            {'latitude': 12.0, 'longitude': 8.5}, {'latitude': 12.1, 'longitude': 8.6}])
+        # Passes through the viewport without a vertex inside it
+        self.crossing = PipelineRoute.objects.create(name='Crossing', state=self.dataset['states'][1], coordinates=[
+            {'latitude': 6.0, 'longitude': 3.4}, {'latitude': 7.0, 'longitude': 3.4}])
+
+    def names(self, client, bbox):
+        response = client.get(f'{benchmarks.ROUTES_URL}?bbox={bbox}')
+        self.assertEqual(response.status_code, 200, response.content)
+        return {route['name'] for route in response.json()['results']}
+
+    def test_bounds_follow_geometry(self):
+        self.assertEqual(
+            (self.lagos.min_latitude, self.lagos.max_latitude, self.lagos.min_longitude, self.lagos.max_longitude),
+            (6.4, 6.6, 3.3, 3.5),
+        )
+        self.lagos.coordinates = [{'latitude': 1.0, 'longitude': 2.0}]
+        self.lagos.save()
+        self.lagos.refresh_from_db()
+        self.assertEqual((self.lagos.min_latitude, self.lagos.max_longitude), (1.0, 2.0))
+
+    def test_bbox_returns_intersecting_routes(self):
+        client = benchmarks.token_client(self.dataset['users'][Profile.NATIONAL])
+        self.assertEqual(self.names(client, '3.35,6.45,3.45,6.55'), {'Lagos', 'Crossing'})
+        self.assertEqual(self.names(client, '8,11,9,13'), {'Kano'})
+        self.assertEqual(self.names(client, '-10,-10,-9,-9'), set())
+
+    def test_bbox_combines_with_role_scope(self):
+        client = benchmarks.token_client(self.dataset['users'][Profile.STATE])
+        self.assertEqual(self.names(client, '3.35,6.45,3.45,6.55'), {'Lagos'})
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class RouteSnappingTests(TestCase):
+
+    def setUp(self):
+        # Route 0 runs (6.000, 3.000) -> (6.004, 3.004), route 1 starts at (6.010, 3.010)
+        self.dataset = seed_dataset(2, faults_per_route=0, points_per_route=5)
+        self.routes = self.dataset['routes']
+        snap_index.rebuild()
+        self.client = benchmarks.token_client(self.dataset['users'][Profile.NATIONAL])
+
+    def test_nearest_segment_and_projection(self):
+        result = snap_index.nearest(6.0028, 3.0022)
+        self.assertEqual((result.route_id, result.segment), (self.routes[0].pk, 2))
+        self.assertAlmostEqual(result.latitude, 6.0025, places=4)
+        self.assertAlmostEqual(result.fraction, 0.5, delta=0.01)
+        self.assertAlmostEqual(result.distance, 47, delta=2)
+        self.assertEqual(snap_index.nearest(6.0105, 3.0105).route_id, self.routes[1].pk)
+
+    def test_max_distance_and_state_filter(self):
+        self.assertIsNone(snap_index.nearest(6.5, 3.5, max_distance=1000))
+        result = snap_index.nearest(6.0, 3.0, max_distance=5000, state_ids={self.routes[1].state_id})
+        self.assertEqual(result.route_id, self.routes[1].pk)
+
+    def test_matches_brute_force(self):
+        index = RouteSnapIndex(cell_size=0.002)
+        index.rebuild()
+        for latitude, longitude in [(6.0, 3.02), (5.99, 3.0), (6.007, 3.006), (6.2, 2.9)]:
+            result = index.nearest(latitude, longitude, max_distance=filters.MAX_RADIUS)
+            expected = min(
+                (geometry.haversine(latitude, longitude, [point['latitude']], [point['longitude']])[0], route.pk)
+                for route in self.routes for point in route.coordinates
+            )
+            self.assertEqual(result.route_id, expected[1])
+            self.assertLessEqual(result.distance, expected[0] + 1)
+
+    def test_index_follows_committed_writes(self):
+        route = self.routes[0]
+        with self.captureOnCommitCallbacks(execute=True):
+            route.coordinates = [{'latitude': 7.0, 'longitude': 4.0}, {'latitude': 7.001, 'longitude': 4.0}]
+            route.save()
+        self.assertEqual(snap_index.nearest(7.0005, 4.0).route_id, route.pk)
+        self.assertNotEqual(snap_index.nearest(6.0, 3.0, max_distance=5000).route_id, route.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            route.delete()
+        snap_index.nearest(6.0, 3.0)
+        self.assertNotIn(route.pk, snap_index.routes)
+
+    def test_writes_from_other_processes_are_applied_incrementally(self):
+        # Another worker's index, built before the writes
+        other = RouteSnapIndex()
+        other.rebuild()
+        moved, deleted = self.routes
+        with self.captureOnCommitCallbacks(execute=True):
+            moved.coordinates = [{'latitude': 7.0, 'longitude': 4.0}, {'latitude': 7.001, 'longitude': 4.0}]
+            moved.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            deleted.delete()
+        with mock.patch.object(other, 'rebuild', side_effect=AssertionError('rebuilt')):
+            self.assertEqual(other.nearest(7.0005, 4.0).route_id, moved.pk)
+        self.assertEqual(set(other.routes), {moved.pk})
+
+    def test_search_radius_is_bounded(self):
+        # About 24 km from the routes, beyond PIPEAPP_SNAP_MAX_DISTANCE
+        self.assertIsNone(snap_index.nearest(6.2, 2.9))
+        self.assertEqual(self.client.get(f'{benchmarks.ROUTES_URL}snap/?point=6.2,2.9').status_code, 404)
+        self.assertIsNotNone(snap_index.nearest(6.2, 2.9, max_distance=filters.MAX_RADIUS))
+        self.assertIsNone(snap_index.nearest(7.0, 3.0, max_distance=10 ** 9))
+
+    def test_snap_endpoint(self):
+        response = self.client.get(f'{benchmarks.ROUTES_URL}snap/?point=6.0028,3.0022')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['route'], self.routes[0].pk)
+        self.assertEqual(response.json()['segment'], 2)
+        self.assertAlmostEqual(response.json()['chainage'], self.routes[0].length_m * 2.5 / 4, delta=1)
+        far = self.client.get(f'{benchmarks.ROUTES_URL}snap/?point=7.0,4.0&max_distance=1000')
+        self.assertEqual(far.status_code, 404)
+        self.assertEqual(self.client.get(f'{benchmarks.ROUTES_URL}snap/?point=x').status_code, 400)
+
+    def test_create_fault_with_snap(self):
+        response = self.client.post(benchmarks.FAULTS_URL, {
+            'fault_coordinates': {'latitude': 6.0105, 'longitude': 3.0105}, 'snap': True,
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(response.json()['pipeline_route'], self.routes[1].pk)
+        missing = self.client.post(benchmarks.FAULTS_URL, {
+            'fault_coordinates': {'latitude': 6.0, 'longitude': 3.0},
+        }, format='json')
+        self.assertEqual(missing.status_code, 400)
+        too_far = self.client.post(benchmarks.FAULTS_URL, {
+            'fault_coordinates': {'latitude': 8.0, 'longitude': 3.0}, 'snap': True,
+        }, format='json')
+        self.assertEqual(too_far.status_code, 400)
+
+    def test_routes_deleted_after_the_index_caught_up_are_skipped(self):
+        nearer, further = self.routes
+        with mock.patch.object(snap_index, 'ensure_current'):
+            # Deleted by another worker after this one last read the change sequence
+            nearer.delete()
+            response = self.client.get(f'{benchmarks.ROUTES_URL}snap/?point=6.0028,3.0022&max_distance=5000')
+            self.assertEqual(response.status_code, 200, response.content)
+            self.assertEqual(response.json()['route'], further.pk)
+            self.assertEqual(self.client.get(f'{benchmarks.ROUTES_URL}snap/?point=6.0028,3.0022').status_code, 404)
+            response = self.client.post(benchmarks.FAULTS_URL, {
+                'fault_coordinates': {'latitude': 6.0028, 'longitude': 3.0022}, 'snap': True,
+            }, format='json')
+            self.assertEqual(response.status_code, 400, response.content)
+
+    def test_snap_respects_role_scope(self):
+        client = benchmarks.token_client(self.dataset['users'][Profile.STATE])
+        response = client.get(f'{benchmarks.ROUTES_URL}snap/?point=6.0105,3.0105&max_distance=5000')
+        self.assertEqual(response.json()['route'], self.routes[0].pk)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class RouteMetricsTests(TestCase):
+
+    def setUp(self):
+        # Route i has i + 2 vertices 0.001 degrees apart on a diagonal
+        self.dataset = seed_dataset(0)
+        state = self.dataset['states'][0]
+        self.routes = [
+            PipelineRoute.objects.create(name=f'Metric {i}', state=state, coordinates=benchmarks.route_coordinates(i + 2))
+            for i in range(3)
+        ]
+        self.client = benchmarks.token_client(self.dataset['users'][Profile.NATIONAL])
+
+    def test_metrics_match_per_segment_haversine(self):
+        route = self.routes[2]
+        points = route.coordinates
+        expected = [0.0]
+        for a, b in zip(points, points[1:]):
+            expected.append(expected[-1] + geometry.haversine(a['latitude'], a['longitude'], [b['latitude']], [b['longitude']])[0])
+        self.assertEqual(route.segment_count, 3)
+        self.assertAlmostEqual(route.length_m, expected[-1], places=3)
+        self.assertAlmostEqual(route.length_m, 470, delta=5)
+        self.assertEqual(geometry.decode_distances(route.cumulative_distances).round(3).tolist(), [round(d, 3) for d in expected])
+        self.assertEqual(geometry.route_metrics(geometry.EMPTY_GEOMETRY), (0.0, 0, b''))
+
+    def test_metrics_follow_geometry_updates(self):
+        route = self.routes[0]
+        route.coordinates = benchmarks.route_coordinates(5)
+        route.save(update_fields=['geometry'])
+        route = PipelineRoute.objects.get(pk=route.pk)
+        self.assertEqual(route.segment_count, 4)
+        self.assertAlmostEqual(route.length_m, self.routes[2].length_m * 4 / 3, delta=1)
+
+    def test_list_ordering_and_length_filter(self):
+        response = self.client.get(f'{benchmarks.ROUTES_URL}?ordering=-length_m')
+        self.assertEqual(response.status_code, 200, response.content)
+        results = response.json()['results']
+        self.assertEqual([route['id'] for route in results], [route.pk for route in reversed(self.routes)])
+        self.assertEqual(results[0]['segment_count'], 3)
+        self.assertIsNone(results[0]['cumulative_distances'])
+
+        response = self.client.get(f'{benchmarks.ROUTES_URL}?min_length=200&max_length=400')
+        self.assertEqual([route['id'] for route in response.json()['results']], [self.routes[1].pk])
+        self.assertEqual(self.client.get(f'{benchmarks.ROUTES_URL}?min_length=5&max_length=1').status_code, 400)
+
+    def test_cursor_follows_ordering(self):
+        first = self.client.get(f'{benchmarks.ROUTES_URL}?ordering=-segment_count&page_size=2').json()
+        second = self.client.get(first['next']).json()
+        ids = [route['id'] for route in first['results'] + second['results']]
+        self.assertEqual(ids, [route.pk for route in reversed(self.routes)])
+
+    def test_tied_values_are_paged_by_id(self):
+        state = self.dataset['states'][0]
+        tied = [
+            PipelineRoute.objects.create(name=f'Tied {i}', state=state, coordinates=benchmarks.route_coordinates(3))
+            for i in range(5)
+        ]
+        # Three vertices, as long as routes[1]: six routes tie, and pages of two cut through them
+        expected = [self.routes[2].pk, *sorted(route.pk for route in [self.routes[1], *tied]), self.routes[0].pk]
+        pages, url = [], f'{benchmarks.ROUTES_URL}?ordering=-length_m&page_size=2'
+        while url:
+            page = self.client.get(url).json()
+            pages.append([route['id'] for route in page['results']])
+            url = page['next']
+        self.assertEqual(sum(pages, []), expected)
+        self.assertEqual([len(page) for page in pages], [2, 2, 2, 2])
+
+        # And back again from the last page
+        backwards, url = [], page['previous']
+        while url:
+            page = self.client.get(url).json()
+            backwards = [route['id'] for route in page['results']] + backwards
+            url = page['previous']
+        self.assertEqual(backwards, expected[:-2])
+        self.assertEqual(self.client.get(f'{benchmarks.ROUTES_URL}?cursor=bogus').status_code, 404)
+
+    def test_retrieve_includes_cumulative_distances(self):
+        response = self.client.get(f'{benchmarks.ROUTES_URL}{self.routes[1].pk}/')
+        distances = response.json()['cumulative_distances']
+        self.assertEqual(len(distances), 3)
+        self.assertEqual(distances[0], 0.0)
+        self.assertAlmostEqual(distances[-1], response.json()['length_m'], delta=0.1)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class RouteIngestionTests(TestCase):
+    url = f'{benchmarks.ROUTES_URL}ingest/'
+
+    def setUp(self):
+        self.dataset = seed_dataset(0)
+        self.states = self.dataset['states']
+        self.client = benchmarks.token_client(self.dataset['users'][Profile.NATIONAL])
+
+    def row(self, i, state=None):
+        return {'name': f'Ingest {i}', 'state': state or self.states[i % 2].name, 'coordinates': benchmarks.route_coordinates(3)}
+
+    def post_ndjson(self, lines, client=None, query=''):
+        body = ''.join(line if isinstance(line, str) else json.dumps(line) + '\n' for line in lines)
+        return (client or self.client).post(f'{self.url}{query}', body, content_type='application/x-ndjson')
+
+    def test_ndjson_rows_are_bulk_inserted(self):
+        response = self.post_ndjson([self.row(i) for i in range(25)], query='?batch_size=10')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(response.json(), {'received': 25, 'created': 25, 'failed': 0, 'errors': []})
+        route = PipelineRoute.objects.get(name='Ingest 3')
+        self.assertEqual(route.state, self.states[1])
+        self.assertEqual(route.segment_count, 2)
+        self.assertIsNotNone(route.min_latitude)
+        self.assertEqual(route.simplifications.count(), len(ROUTE_TOLERANCES))
+
+    def test_queries_are_constant_per_batch(self):
+        self.post_ndjson([self.row(99)])  # Resolves and caches the caller's scope
+        with CaptureQueriesContext(connection) as small:
+            self.post_ndjson([self.row(i) for i in range(5)])
+        with CaptureQueriesContext(connection) as large:
+            self.post_ndjson([self.row(i) for i in range(100, 150)])
+        self.assertEqual(len(small), len(large))
+
+    def test_errors_are_reported_per_row(self):
+        PipelineRoute.objects.create(name='Ingest 0', state=self.states[0], coordinates=[])
+        response = self.post_ndjson([
+            self.row(0),
+            '{not json\n',
+            self.row(2, state='Atlantis'),
+            {'name': 'Ingest 3', 'state': self.states[0].name, 'coordinates': [{'latitude': 200, 'longitude': 0}]},
+            '\n',
+            self.row(5),
+            self.row(5),
+        ])
+        self.assertEqual(response.status_code, 207, response.content)
+        report = response.json()
+        self.assertEqual((report['received'], report['created'], report['failed']), (6, 1, 5))
+        self.assertEqual([error['line'] for error in report['errors']], [2, 4, 1, 3, 7])
+        self.assertIn('state', report['errors'][3]['errors'])
+        self.assertTrue(PipelineRoute.objects.filter(name='Ingest 5').exists())
+
+    def test_json_array_and_scope(self):
+        client = benchmarks.token_client(self.dataset['users'][Profile.STATE])
+        response = client.post(self.url, [self.row(0, self.states[0].name), self.row(1, self.states[1].name)], format='json')
+        self.assertEqual(response.status_code, 207, response.content)
+        self.assertEqual(response.json()['errors'][0]['line'], 2)
+        self.assertEqual(self.client.post(self.url, {'name': 'x'}, format='json').status_code, 400)
+        self.assertEqual(self.post_ndjson([], query='?batch_size=0').status_code, 400)
+
+    def test_snap_index_sees_ingested_routes(self):
+        snap_index.rebuild()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post_ndjson([self.row(0)])
+        self.assertEqual(snap_index.nearest(6.0, 3.0).route_id, PipelineRoute.objects.get(name='Ingest 0').pk)
+
+
+class ImportNetworkCommandTests(TestCase):
+
+    def setUp(self):
+        self.dataset = seed_dataset(0)
+        self.state = self.dataset['states'][0]
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w', encoding='utf-8') as handle:
+            handle.write(content)
+        return path
+
+    def geojson(self, count, state=None, name='network.geojson'):
+        features = [{
+            'type': 'Feature',
+            'properties': {'name': f'Network {i}', 'state': state or self.state.name},
+            'geometry': {'type': 'LineString', 'coordinates': [[3.0 + i * 0.01, 6.0], [3.0 + i * 0.01, 6.005], [3.001 + i * 0.01, 6.01]]},
+        } for i in range(count)]
+        # Pretty printed with a crs member first, features are not one per line
+        return self.write(name, json.dumps({
+            'type': 'FeatureCollection', 'crs': {'type': 'name', 'properties': {'name': 'EPSG:4326'}}, 'features': features,
+        }, indent=2))
+
+    def call(self, *args):
+        output = io.StringIO()
+        call_command('import_network', *args, stdout=output, stderr=io.StringIO())
+        return output.getvalue()
+
+    def test_geojson_reader_handles_small_reads(self):
+        with open(self.geojson(3), 'rb') as stream:
+            features = list(iter_geojson_features(stream, read_size=7))
+        self.assertEqual([index for index, _ in features], [0, 1, 2])
+        self.assertEqual(features[2][1]['properties']['name'], 'Network 2')
+
+    def test_import_routes_and_faults(self):
+        routes = self.geojson(7)
+        faults = self.write('faults.csv', (
+            'route,latitude,longitude,status,description,reported_at\n'
+            'Network 1,6.001,3.01,critical,Leak,2019-05-01T10:00:00Z\n'
+            'Network 1,6.002,3.01,warning,,\n'
+            'Missing,6.0,3.0,normal,,\n'
+            'Network 2,north,3.0,normal,,\n'
+        ))
+        output = self.call('--routes', routes, '--faults', faults, '--batch-size', '3')
+        self.assertIn('routes: 7 rows, 7 created', output)
+        self.assertIn('faults: 4 rows, 2 created, 0 skipped, 2 failed', output)
+
+        route = PipelineRoute.objects.get(name='Network 1')
+        self.assertEqual(route.coordinates[0], {'latitude': 6.0, 'longitude': 3.01})
+        self.assertEqual(route.segment_count, 2)
+        self.assertEqual(route.simplifications.count(), len(ROUTE_TOLERANCES))
+        self.assertEqual((route.status, route.critical_fault_count, route.warning_fault_count), ('critical', 1, 1))
+        self.assertEqual(route.faults.get(status='critical').reported_at.year, 2019)
+
+        self.assertIn('already imported', self.call('--routes', routes))
+        self.assertIn('7 skipped', self.call('--routes', routes, '--restart'))
+        self.assertEqual(PipelineRoute.objects.filter(name__startswith='Network').count(), 7)
+
+    def test_resume_from_checkpoint(self):
+        routes = self.geojson(5)
+        stat = os.stat(routes)
+        with open(f'{routes}.checkpoint.json', 'w', encoding='utf-8') as handle:
+            json.dump({'size': stat.st_size, 'mtime': stat.st_mtime, 'done': 2, 'created': 2,
+                       'skipped': 0, 'failed': 0, 'completed': False}, handle)
+        output = self.call('--routes', routes, '--batch-size', '2')
+        self.assertIn('resuming after row 2', output)
+        self.assertIn('routes: 5 rows, 5 created', output)
+        self.assertEqual(
+            sorted(PipelineRoute.objects.filter(name__startswith='Network').values_list('name', flat=True)),
+            ['Network 2', 'Network 3', 'Network 4'],
+        )
+
+    def test_parallel_preparation_and_errors_file(self):
+        routes = self.geojson(6)
+        PipelineRoute.objects.create(name='Network 0', state=self.state, coordinates=[])
+        errors = os.path.join(self.directory.name, 'errors.ndjson')
+        self.call('--routes', self.geojson(6, state='Atlantis', name='atlantis.geojson'), '--workers', '2', '--batch-size', '4', '--errors', errors, '--restart')
+        with open(errors, encoding='utf-8') as handle:
+            rejected = [json.loads(line) for line in handle]
+        self.assertEqual(sorted(error['line'] for error in rejected), [2, 3, 4, 5, 6])
+
+        output = self.call('--routes', routes, '--workers', '2', '--batch-size', '4', '--restart')
+        self.assertIn('5 created, 1 skipped', output)
+
+    def test_rejects_non_feature_collections(self):
+        with self.assertRaises(CommandError):
+            self.call('--routes', self.write('bad.geojson', '{"type": "Feature"}'))
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class RouteFaultSyncTests(TestCase):
+
+    def setUp(self):
+        self.dataset = seed_dataset(1, faults_per_route=0, points_per_route=3)
+        self.route = self.dataset['routes'][0]
+        self.client = benchmarks.token_client(self.dataset['users'][Profile.NATIONAL])
+        self.url = f'{benchmarks.ROUTES_URL}{self.route.pk}/'
+        self.faults = [
+            PipelineFault.objects.create(
+                pipeline_route=self.route, fault_coordinates={'latitude': 6.0, 'longitude': 3.0 + i * 0.001},
+                client_key=f'key-{i}', description=f'Fault {i}',
+            )
+            for i in range(3)
+        ]
+
+    def put(self, faults):
+        payload = {'name': self.route.name, 'state': self.route.state.name, 'coordinates': self.route.coordinates, 'faults': faults}
+        response = self.client.put(self.url, payload, format='json')
+        return response
+
+    def snapshot(self):
+        return {fault.pk: (fault.status, fault.reported_at) for fault in self.route.faults.all()}
+
+    def test_unchanged_faults_are_not_written(self):
+        before = self.snapshot()
+        faults = [{'id': fault.pk, 'fault_coordinates': fault.fault_coordinates} for fault in self.faults]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.put(faults)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.snapshot(), before)
+        self.assertFalse([query for query in queries if 'pipeapp_pipelinefault' in query['sql'] and
+                          query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))])
+
+    def test_diff_by_id_and_client_key(self):
+        original = self.faults[0].reported_at
+        response = self.put([
+            {'id': self.faults[0].pk, 'fault_coordinates': {'latitude': 6.0, 'longitude': 3.0}, 'status': 'critical'},
+            {'client_key': 'key-1', 'fault_coordinates': {'latitude': 6.5, 'longitude': 3.5}},
+            {'client_key': 'key-9', 'fault_coordinates': {'latitude': 6.0, 'longitude': 3.0}, 'status': 'warning'},
+        ])
+        self.assertEqual(response.status_code, 200, response.content)
+        body = response.json()
+        self.assertEqual((body['status'], body['critical_fault_count'], body['warning_fault_count']), ('critical', 1, 1))
+
+        first = PipelineFault.objects.get(pk=self.faults[0].pk)
+        self.assertEqual((first.status, first.reported_at, first.description), ('critical', original, 'Fault 0'))
+        moved = PipelineFault.objects.get(pk=self.faults[1].pk)
+        self.assertEqual((moved.latitude, moved.longitude), (6.5, 3.5))
+        self.assertFalse(PipelineFault.objects.filter(pk=self.faults[2].pk).exists())
+        self.assertEqual(self.route.faults.get(client_key='key-9').status, 'warning')
+
+    def test_repost_by_name_matches_client_keys(self):
+        payload = {
+            'name': self.route.name, 'state': self.route.state.name, 'coordinates': self.route.coordinates,
+            'faults': [{'client_key': 'key-2', 'fault_coordinates': {'latitude': 6.0, 'longitude': 3.002}}],
+        }
+        response = self.client.post(benchmarks.ROUTES_URL, payload, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(list(self.route.faults.values_list('pk', flat=True)), [self.faults[2].pk])
+
+    def test_rejects_foreign_and_repeated_faults(self):
+        other = PipelineRoute.objects.create(name='Other', state=self.route.state, coordinates=[])
+        foreign = PipelineFault.objects.create(pipeline_route=other, fault_coordinates={'latitude': 6.0, 'longitude': 3.0})
+        point = {'latitude': 6.0, 'longitude': 3.0}
+        self.assertEqual(self.put([{'id': foreign.pk, 'fault_coordinates': point}]).status_code, 400)
+        repeated = [{'id': self.faults[0].pk, 'fault_coordinates': point}, {'client_key': 'key-0', 'fault_coordinates': point}]
+        self.assertEqual(self.put(repeated).status_code, 400)
+        clash = [{'id': self.faults[0].pk, 'fault_coordinates': point, 'client_key': 'key-1'}, {'id': self.faults[1].pk, 'fault_coordinates': point}]
+        self.assertEqual(self.put(clash).status_code, 400)
+        self.assertEqual(self.route.faults.count(), 3)
+
+    def test_write_queries_do_not_grow_with_faults(self):
+        def faults(count, prefix):
+            return [{'client_key': f'{prefix}-{i}', 'fault_coordinates': {'latitude': 6.0, 'longitude': 3.0}} for i in range(count)]
+        # Every write deletes the previous faults and inserts a new set
+        self.put(faults(2, 'a'))
+        with CaptureQueriesContext(connection) as small:
+            self.put(faults(2, 'b'))
+        self.put(faults(20, 'a'))
+        with CaptureQueriesContext(connection) as large:
+            self.put(faults(20, 'b'))
+        self.assertEqual(len(small), len(large))
+        self.assertEqual(self.route.faults.count(), 20)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class FaultTelemetryTests(TestCase):
+    url = f'{benchmarks.FAULTS_URL}telemetry/'
+
+    def setUp(self):
+        self.dataset = seed_dataset(2, faults_per_route=0, points_per_route=2)
+        self.route, self.other_route = self.dataset['routes']
+        self.client = benchmarks.token_client(self.dataset['users'][Profile.NATIONAL])
+        # Flush by hand instead of from the background thread
+        telemetry_buffer.background = False
+        self.addCleanup(setattr, telemetry_buffer, 'background', True)
+        self.addCleanup(telemetry_buffer.pending.clear)
+
+    def reading(self, route=None, **extra):
+        return {'route': (route or self.route).pk, 'fault_coordinates': {'latitude': 6.0, 'longitude': 3.0}, **extra}
+
+    def test_readings_are_queued_then_written_in_one_batch(self):
+        response = self.client.post(self.url, [
+            self.reading(status='critical', reported_at='2024-01-02T03:04:05Z'),
+            self.reading(status='warning'),
+        ], format='json')
+        self.assertEqual(response.status_code, 202, response.content)
+        self.assertEqual(response.json(), {'accepted': 2})
+        self.assertFalse(self.route.faults.exists())
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(telemetry_buffer.flush(), 2)
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('INSERT')]), 1)
+        route = PipelineRoute.objects.get(pk=self.route.pk)
+        self.assertEqual((route.status, route.critical_fault_count, route.warning_fault_count), ('critical', 1, 1))
+        self.assertEqual(route.faults.get(status='critical').reported_at.year, 2024)
+        self.assertEqual(route.faults.get(status='warning').latitude, 6.0)
+
+    def test_ndjson_and_validation(self):
+        body = json.dumps(self.reading()) + '\n' + json.dumps(self.reading(self.other_route)) + '\n'
+        response = self.client.post(self.url, body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 202, response.content)
+        self.assertEqual(len(telemetry_buffer), 2)
+        bad = [self.reading(fault_coordinates={'latitude': 'x'}), self.reading(status='melting')]
+        self.assertEqual(self.client.post(self.url, bad, format='json').status_code, 400)
+
+        client = benchmarks.token_client(self.dataset['users'][Profile.STATE])
+        response = client.post(self.url, self.reading(self.other_route), format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(telemetry_buffer), 2)
+
+    def test_full_buffer_applies_backpressure(self):
+        capacity = telemetry_buffer.capacity
+        telemetry_buffer.capacity = 3
+        self.addCleanup(setattr, telemetry_buffer, 'capacity', capacity)
+        self.assertEqual(self.client.post(self.url, [self.reading()] * 2, format='json').status_code, 202)
+        response = self.client.post(self.url, [self.reading()] * 2, format='json')
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(len(telemetry_buffer), 2)
+        telemetry_buffer.flush()
+        self.assertEqual(self.client.post(self.url, [self.reading()] * 2, format='json').status_code, 202)
+
+    def test_readings_for_deleted_routes_are_dropped(self):
+        buffer = TelemetryBuffer(capacity=10, batch_size=10, flush_interval=1)
+        buffer.background = False
+        buffer.offer([{'pipeline_route_id': self.route.pk, 'fault_coordinates': {'latitude': 6.0, 'longitude': 3.0}}])
+        self.route.delete()
+        self.assertEqual((buffer.flush(), buffer.dropped), (0, 1))
+
+    def test_failed_writes_are_kept_and_retried(self):
+        buffer = TelemetryBuffer(capacity=3, batch_size=10, flush_interval=60)
+        buffer.background = False
+        readings = [{'pipeline_route_id': self.route.pk, 'fault_coordinates': {'latitude': 6.0, 'longitude': 3.0}}] * 2
+        buffer.offer(readings)
+        with mock.patch('pipeapp.telemetry.create_faults', side_effect=OperationalError('database is locked')):
+            with self.assertLogs('pipeapp.telemetry', 'WARNING'):
+                self.assertEqual(buffer.flush(), 0)
+        self.assertEqual((len(buffer), buffer.dropped, buffer.attempts), (2, 0, 1))
+        # Still held against the capacity, and not retried before the backoff is over
+        self.assertFalse(buffer.offer(readings))
+        self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(buffer.flush(force=True), 2)
+        self.assertEqual(self.route.faults.count(), 2)
+        self.assertEqual(buffer.stats(), {'pending': 0, 'written': 2, 'dropped': 0, 'retries': 0})
+
+    def test_readings_are_dropped_after_the_last_retry(self):
+        buffer = TelemetryBuffer(capacity=10, batch_size=10, flush_interval=60)
+        buffer.background = False
+        buffer.max_retries = 2
+        buffer.offer([{'pipeline_route_id': self.route.pk, 'fault_coordinates': {'latitude': 6.0, 'longitude': 3.0}}])
+        with mock.patch('pipeapp.telemetry.create_faults', side_effect=OperationalError('database is locked')):
+            with self.assertLogs('pipeapp.telemetry', 'WARNING') as logs:
+                for _ in range(3):
+                    buffer.flush(force=True)
+        self.assertEqual((len(buffer), buffer.dropped), (0, 1))
+        self.assertIn('Dropped 1 telemetry readings', logs.output[-1])
+        self.assertEqual(self.client.get(self.url).json()['dropped'], telemetry_buffer.dropped)
+
+
+class FaultTelemetryFlusherTests(TransactionTestCase):
+
+    def test_background_flush_by_size_time_and_stop(self):
+        dataset = seed_dataset(1, faults_per_route=0, points_per_route=2)
+        route = dataset['routes'][0]
+        reading = {'pipeline_route_id': route.pk, 'fault_coordinates': {'latitude': 6.0, 'longitude': 3.0}}
+        buffer = TelemetryBuffer(capacity=100, batch_size=5, flush_interval=0.05)
+        try:
+            self.assertTrue(buffer.offer([reading] * 12))
+            for _ in range(100):
+                if buffer.written == 12:
+                    break
+                buffer.thread.join(0.05)
+            self.assertEqual(buffer.written, 12)
+            self.assertEqual(PipelineFault.objects.count(), 12)
+            self.assertTrue(buffer.offer([reading] * 3))
+        finally:
+            buffer.stop()
+        self.assertFalse(buffer.thread.is_alive())
+        self.assertEqual(PipelineFault.objects.count(), 15)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class RoleScopeCacheTests(TestCase):
+
+    def setUp(self):
+        self.dataset = seed_dataset(12, faults_per_route=0, points_per_route=2)
+        self.users = self.dataset['users']
+
+    def route_ids(self, user):
+        response = benchmarks.token_client(user).get(benchmarks.ROUTES_URL)
+        self.assertEqual(response.status_code, 200, response.content)
+        return {route['id'] for route in response.json()['results']}
+
+    def test_scopes_match_the_hierarchy(self):
+        profile = self.users[Profile.ZONAL].profile
+        expected = {
+            Profile.NATIONAL: PipelineRoute.objects.all(),
+            Profile.ZONAL: PipelineRoute.objects.filter(state__zone=profile.zone),
+            Profile.STATE: PipelineRoute.objects.filter(state=profile.state),
+            Profile.AREA: PipelineRoute.objects.filter(state__area=profile.area),
+            Profile.UNIT: PipelineRoute.objects.filter(state__area__unit=profile.unit),
+        }
+        for role, routes in expected.items():
+            with self.subTest(role=role):
+                self.assertEqual(self.route_ids(self.users[role]), set(routes.values_list('id', flat=True)))
+        self.assertTrue(resolve_scope(self.users[Profile.NATIONAL]).unrestricted)
+
+    def test_cached_scope_skips_profile_and_hierarchy_queries(self):
+        user = self.users[Profile.ZONAL]
+        self.route_ids(user)
+        with CaptureQueriesContext(connection) as queries:
+            self.route_ids(user)
+        sql = ' '.join(query['sql'] for query in queries)
+        self.assertNotIn('pipeapp_profile', sql)
+        self.assertNotIn('pipeapp_zone', sql)
+        # The repeat is served from the listing cache, keyed by the versions of the scope's states
+        self.assertIn('"pipeapp_state"."id" IN', sql)
+
+    def test_profile_change_invalidates_scope(self):
+        user = self.users[Profile.STATE]
+        before = self.route_ids(user)
+        profile = user.profile
+        profile.state = self.dataset['states'][1]
+        profile.save()
+        after = self.route_ids(user)
+        self.assertNotEqual(before, after)
+        self.assertEqual(after, set(PipelineRoute.objects.filter(state=profile.state).values_list('id', flat=True)))
+
+    def test_hierarchy_change_invalidates_scope(self):
+        user = self.users[Profile.ZONAL]
+        before = self.route_ids(user)
+        moved = State.objects.exclude(zone=user.profile.zone).first()
+        moved.zone = user.profile.zone
+        moved.save()
+        self.assertEqual(self.route_ids(user) - before, set(moved.pipelineroute_set.values_list('id', flat=True)))
+        Zone.objects.create(name='Empty Zone')
+        self.assertEqual(len(self.route_ids(user)), len(before) + moved.pipelineroute_set.count())
+
+    def test_unshared_scope_cache_expires_within_seconds(self):
+        user = self.users[Profile.STATE]
+        old_state, new_state = user.profile.state, self.dataset['states'][1]
+        self.assertLessEqual(scope.SCOPE_CACHE_TIMEOUT, 5)
+        self.assertEqual(resolve_scope(user).state_ids, {old_state.pk})
+        # As if another worker saved the profile: no signal reaches this process
+        Profile.objects.filter(user=user).update(state=new_state)
+        self.assertEqual(resolve_scope(user).state_ids, {old_state.pk})
+        with mock.patch('time.time', return_value=time.time() + scope.SCOPE_CACHE_TIMEOUT + 1):
+            self.assertEqual(resolve_scope(user).state_ids, {new_state.pk})
+
+    @override_settings(CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'scope-default'},
+        'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'scope-shared'},
+    })
+    def test_scopes_live_in_the_configured_shared_cache(self):
+        user = self.users[Profile.ZONAL]
+        with mock.patch.object(scope, 'SCOPE_CACHE_ALIAS', 'shared'):
+            resolve_scope(user)
+            key = scope.scope_cache_key(user.pk)
+            self.assertIsNotNone(caches['shared'].get(key))
+            self.assertIsNone(caches['default'].get(key))
+            user.profile.save()
+            self.assertIsNone(caches['shared'].get(key))
+
+
+class HierarchyPathTests(TestCase):
+
+    def setUp(self):
+        self.zone = Zone.objects.create(name='Path Zone')
+        self.other_zone = Zone.objects.create(name='Other Path Zone')
+        self.state = State.objects.create(name='Path State', zone=self.zone)
+        self.area = Area.objects.create(name='Path Area', state=self.state)
+        self.unit = Unit.objects.create(name='Path Unit', area=self.area)
+
+    def test_paths_are_set_on_create(self):
+        self.assertEqual(self.zone.path, '/')
+        self.assertEqual(self.unit.path, f'/{self.zone.pk}/{self.state.pk}/{self.area.pk}/')
+        unit = Unit.objects.get(pk=self.unit.pk)
+        self.assertEqual((unit.ancestor_id(Zone), unit.ancestor_id(State), unit.ancestor_id(Area)),
+                         (self.zone.pk, self.state.pk, self.area.pk))
+
+    def test_descendants_at_any_depth(self):
+        other = State.objects.create(name='Path Sibling', zone=self.other_zone)
+        Unit.objects.create(name='Elsewhere', area=Area.objects.create(name='Elsewhere', state=other))
+        with CaptureQueriesContext(connection) as queries:
+            units = list(self.zone.descendants(Unit))
+        self.assertEqual(units, [self.unit])
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('JOIN', queries[0]['sql'])
+        self.assertEqual(list(self.state.descendants(Area)), [self.area])
+
+    def test_moving_a_node_reroots_its_subtree(self):
+        state = State.objects.get(pk=self.state.pk)
+        state.zone = self.other_zone
+        state.save()
+        self.assertEqual(Unit.objects.get(pk=self.unit.pk).path, f'/{self.other_zone.pk}/{self.state.pk}/{self.area.pk}/')
+        self.assertEqual(Area.objects.get(pk=self.area.pk).ancestor_id(Zone), self.other_zone.pk)
+        self.assertFalse(self.zone.descendants(Unit).exists())
+
+        # Saving without a move leaves the path alone and reads nothing
+        unit = Unit.objects.get(pk=self.unit.pk)
+        with CaptureQueriesContext(connection) as queries:
+            unit.name = 'Renamed Unit'
+            unit.save(update_fields=['name'])
+        self.assertEqual(len(queries), 1)
+
+
+class TokenCacheTests(TestCase):
+
+    def setUp(self):
+        self.dataset = seed_dataset(2, faults_per_route=0, points_per_route=2)
+        self.user = self.dataset['users'][Profile.NATIONAL]
+        self.client = benchmarks.token_client(self.user)
+
+    def get_routes(self):
+        return self.client.get(benchmarks.ROUTES_URL)
+
+    def test_repeat_requests_skip_the_token_lookup(self):
+        self.assertEqual(self.get_routes().status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.get_routes().status_code, 200)
+        sql = ' '.join(query['sql'] for query in queries)
+        self.assertNotIn('authtoken_token', sql)
+        self.assertNotIn('"auth_user"', sql)
+
+    def test_logout_revokes_the_token(self):
+        self.assertEqual(self.get_routes().status_code, 200)
+        self.assertEqual(self.client.post('/pipeapp/logout/').status_code, 200)
+        self.assertFalse(Token.objects.filter(user=self.user).exists())
+        self.assertEqual(self.get_routes().status_code, 401)
+        # Logging out again with the revoked token is harmless
+        self.assertEqual(self.client.post('/pipeapp/logout/').status_code, 200)
+
+    def test_deactivation_and_token_deletion_revoke(self):
+        self.assertEqual(self.get_routes().status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.get_routes().status_code, 401)
+
+        self.user.is_active = True
+        self.user.save()
+        self.assertEqual(self.get_routes().status_code, 200)
+        Token.objects.filter(user=self.user).delete()
+        self.assertEqual(self.get_routes().status_code, 401)
+
+    def test_lru_is_bounded_and_shared_cache_serves_other_workers(self):
+        token = Token.objects.get(user=self.user)
+        lru = CredentialCache(size=2, ttl=60)
+        for key in ('a', 'b', token.key):
+            lru.set(key, token, token.user_id)
+        self.assertEqual(list(lru.entries), ['b', token.key])
+        self.assertEqual(lru.get(token.key).user, self.user)
+
+        cache.clear()
+        worker, other_worker = CredentialCache(alias='default'), CredentialCache(alias='default')
+        worker.set(token.key, token, token.user_id)
+        self.assertEqual(other_worker.get(token.key).user_id, self.user.pk)
+        worker.invalidate(token.key)
+        self.assertIsNone(CredentialCache(alias='default').get(token.key))
+
+        # Saving the user from any worker drops what the others put in the shared cache
+        worker.set(token.key, token, token.user_id)
+        CredentialCache(alias='default').invalidate_user(self.user.pk)
+        self.assertIsNone(CredentialCache(alias='default').get(token.key))
+
+    def test_local_copies_expire_within_seconds(self):
+        token = Token.objects.get(user=self.user)
+        for alias in (None, 'default'):
+            with self.subTest(alias=alias):
+                worker = CredentialCache(alias=alias)
+                self.assertLessEqual(worker.local_ttl, 5)
+                worker.set(token.key, token, token.user_id)
+                cache.clear()  # As if another worker revoked the token
+                with mock.patch('time.monotonic', return_value=time.monotonic() + worker.local_ttl + 1):
+                    self.assertIsNone(worker.get(token.key))
+
+    def test_logout_signs_out_every_device(self):
+        other_device = benchmarks.token_client(self.user)
+        self.assertEqual(other_device.get(benchmarks.ROUTES_URL).status_code, 200)
+        self.assertEqual(self.client.post('/pipeapp/logout/').status_code, 200)
+        self.assertEqual(other_device.get(benchmarks.ROUTES_URL).status_code, 401)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class BasicAuthCacheTests(TestCase):
+
+    def setUp(self):
+        self.dataset = seed_dataset(2, faults_per_route=0, points_per_route=2)
+        self.user = self.dataset['users'][Profile.NATIONAL]
+        basic_cache.clear()
+
+    def get_routes(self, password=benchmarks.BENCHMARK_PASSWORD):
+        credentials = base64.b64encode(f'{self.user.username}:{password}'.encode()).decode()
+        return self.client.get(benchmarks.ROUTES_URL, HTTP_AUTHORIZATION=f'Basic {credentials}')
+
+    def test_repeat_requests_skip_the_password_check(self):
+        self.assertEqual(self.get_routes().status_code, 200)
+        self.assertEqual(len(basic_cache.entries), 1)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.get_routes().status_code, 200)
+        self.assertNotIn('"auth_user"', ' '.join(query['sql'] for query in queries))
+        # Neither the password nor the username is kept in the key
+        key = next(iter(basic_cache.entries))
+        self.assertNotIn(benchmarks.BENCHMARK_PASSWORD, key)
+        self.assertNotIn(self.user.username, key)
+
+    def test_wrong_passwords_are_not_cached(self):
+        self.assertEqual(self.get_routes(password='wrong').status_code, 401)
+        self.assertEqual(self.get_routes(password='wrong').status_code, 401)
+        self.assertFalse(basic_cache.entries)
+
+    def test_password_change_invalidates(self):
+        self.assertEqual(self.get_routes().status_code, 200)
+        self.user.set_password('changed-password')
+        self.user.save(update_fields=['password'])
+        self.assertEqual(self.get_routes().status_code, 401)
+        self.assertEqual(self.get_routes(password='changed-password').status_code, 200)
+
+    def test_user_deletion_invalidates(self):
+        self.assertEqual(self.get_routes().status_code, 200)
+        self.user.delete()
+        self.assertFalse(basic_cache.entries)
+        self.assertEqual(self.get_routes().status_code, 401)
+
+    def test_other_workers_see_a_password_change_within_seconds(self):
+        self.assertLessEqual(basic_cache.local_ttl, 5)
+        self.assertEqual(self.get_routes().status_code, 200)
+        # As if another worker changed the password: no signal reaches this process
+        type(self.user).objects.filter(pk=self.user.pk).update(password='!')
+        self.assertEqual(self.get_routes().status_code, 200)
+        with mock.patch('time.monotonic', return_value=time.monotonic() + basic_cache.local_ttl + 1):
+            self.assertEqual(self.get_routes().status_code, 401)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class LoginTests(TestCase):
+
+    def setUp(self):
+        self.dataset = seed_dataset(2, faults_per_route=0, points_per_route=2)
+        self.user = self.dataset['users'][Profile.UNIT]
+
+    def login(self, **extra):
+        return self.client.post('/pipeapp/login/', {
+            'username': self.user.username, 'password': benchmarks.BENCHMARK_PASSWORD, **extra,
+        }, content_type='application/json')
+
+    def test_token_only_login_skips_the_session(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.login(session=False)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertNotIn('sessionid', response.cookies)
+        statements = [query['sql'] for query in queries if not benchmarks.TRANSACTION_CONTROL.match(query['sql'])]
+        self.assertNotIn('django_session', ' '.join(statements))
+        # Hierarchy names come from the joined profile query
+        self.assertFalse([sql for sql in statements if sql.startswith('SELECT "pipeapp_zone"')])
+        self.assertLessEqual(len(statements), benchmarks.QUERY_BUDGETS['auth.login_token'])
+        self.assertEqual(response.json()['user']['profile']['unit'], self.user.profile.unit.name)
+        self.user.refresh_from_db()
+        self.assertIsNotNone(self.user.last_login)
+
+        client = benchmarks.APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Token {response.json()['token']}")
+        self.assertEqual(client.get(benchmarks.ROUTES_URL).status_code, 200)
+
+    def test_session_login_is_the_default(self):
+        response = self.login()
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertIn('sessionid', response.cookies)
+        self.assertEqual(self.login(password='wrong').status_code, 400)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class UserProvisioningTests(TestCase):
+    URL = '/pipeapp/users/provision/'
+
+    def setUp(self):
+        self.dataset = seed_dataset(2, faults_per_route=0, points_per_route=2)
+        self.admin = self.dataset['users'][Profile.NATIONAL]
+        self.admin.is_staff = True
+        self.admin.save()
+        self.state = self.dataset['states'][0]
+
+    def roster(self, count, prefix='field'):
+        return [{
+            'username': f'{prefix}-{i}', 'email': f'{prefix}-{i}@example.com', 'password': 'Field-Pa55word!',
+            'role': Profile.UNIT, 'zone': self.state.zone.name, 'state': self.state.name,
+            'area': f'{prefix} Area {i % 3}', 'unit': f'{prefix} Unit {i}',
+        } for i in range(count)]
+
+    def provision(self, roster):
+        return benchmarks.token_client(self.admin).post(self.URL, roster, format='json')
+
+    def test_roster_is_created_with_constant_queries(self):
+        self.provision([])  # Authenticates once, so both measured requests hit the token cache
+        counts = []
+        for size, prefix in ((3, 'small'), (30, 'large')):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.provision(self.roster(size, prefix))
+            self.assertEqual(response.status_code, 201, response.content)
+            self.assertEqual(response.json()['created'], size)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+        profile = Profile.objects.select_related('state', 'area', 'unit').get(user__username='large-4')
+        self.assertEqual((profile.state, profile.area.name, profile.unit.name), (self.state, 'large Area 1', 'large Unit 4'))
+        self.assertEqual(profile.unit.ancestor_id(Zone), self.state.zone_id)
+        self.assertEqual(self.client.post('/pipeapp/login/', {
+            'username': 'large-4', 'password': 'Field-Pa55word!', 'session': False,
+        }, content_type='application/json').status_code, 200)
+
+    def test_any_invalid_row_rejects_the_roster(self):
+        other_zone = self.dataset['zones'][1]
+        roster = self.roster(4)
+        roster[1]['username'] = self.admin.username
+        roster[2]['zone'] = other_zone.name  # The state is in another zone
+        del roster[3]['state']  # A new area needs its state
+        roster[3]['area'] = 'Lonely Area'
+        response = self.provision(roster)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error['line'] for error in response.json()['errors']], [2, 3, 4])
+        self.assertFalse(Profile.objects.filter(user__username__startswith='field-').exists())
+        self.assertFalse(Area.objects.filter(name__startswith='field Area').exists())
+
+    def test_requires_staff_and_accepts_csv(self):
+        user = self.dataset['users'][Profile.STATE]
+        self.assertEqual(benchmarks.token_client(user).post(self.URL, [], format='json').status_code, 403)
+
+        body = 'username,email,password,role,state\ncsv-1,csv-1@example.com,Field-Pa55word!,State,%s\n' % self.state.name
+        response = benchmarks.token_client(self.admin).post(self.URL, body, content_type='text/csv')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(Profile.objects.get(user__username='csv-1').state, self.state)
+
+    def test_command_reads_a_csv_roster(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'roster.csv')
+            with open(path, 'w', encoding='utf-8') as handle:
+                handle.write('username,email,password,zone,state\n')
+                handle.write(f'cmd-1,cmd-1@example.com,Field-Pa55word!,{self.state.zone.name},New State\n')
+                handle.write('cmd-2,not-an-email,Field-Pa55word!,,\n')
+            with self.assertRaises(CommandError):
+                call_command('provision_users', path, stderr=io.StringIO())
+            self.assertFalse(State.objects.filter(name='New State').exists())
+
+            with open(path, 'w', encoding='utf-8') as handle:
+                handle.write('username,email,password,zone,state\n')
+                handle.write(f'cmd-1,cmd-1@example.com,Field-Pa55word!,{self.state.zone.name},New State\n')
+            output = io.StringIO()
+            call_command('provision_users', path, '--workers', '2', stdout=output)
+        self.assertIn('Created 1 users', output.getvalue())
+        self.assertEqual(State.objects.get(name='New State').path, f'/{self.state.zone_id}/')
+
+
+class ListingETagTests(TestCase):
+
+    def setUp(self):
+        self.dataset = seed_dataset(12, faults_per_route=1, points_per_route=2)
+        self.user = self.dataset['users'][Profile.ZONAL]
+        self.client = benchmarks.token_client(self.user)
+        self.zone = self.user.profile.zone
+
+    def poll(self, etag=None, url=benchmarks.ROUTES_URL):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get(url, **headers)
+
+    def test_unchanged_scope_answers_304_without_reading_routes(self):
+        etag = self.poll()['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            response = self.poll(etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        sql = ' '.join(query['sql'] for query in queries)
+        self.assertNotIn('pipeapp_pipelineroute', sql)
+        self.assertNotIn('pipeapp_pipelinefault', sql)
+        self.assertNotEqual(self.poll(url=f'{benchmarks.ROUTES_URL}?ordering=-id')['ETag'], etag)
+
+    def test_writes_inside_the_scope_change_the_etag(self):
+        route = PipelineRoute.objects.filter(state__zone=self.zone).first()
+        outside = PipelineRoute.objects.exclude(state__zone=self.zone).first()
+        etag = self.poll()['ETag']
+
+        outside.faults.first().delete()
+        self.assertEqual(self.poll(etag).status_code, 304)
+
+        PipelineFault.objects.create(pipeline_route=route, fault_coordinates=route.coordinates[0], status='critical')
+        response = self.poll(etag)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        route.name = 'Renamed Route'
+        route.save()
+        self.assertEqual(self.poll(etag).status_code, 200)
+
+    def test_maintenance_commands_change_the_etag(self):
+        route = PipelineRoute.objects.filter(state__zone=self.zone).first()
+        etag = self.poll()['ETag']
+        # Drift written behind the signals' back, as after a crash or a raw SQL fix
+        PipelineRoute.objects.filter(pk=route.pk).update(status='normal', critical_fault_count=5)
+        call_command('backfill_route_status', stdout=io.StringIO())
+        response = self.poll(etag)
+        self.assertEqual(response.status_code, 200)
+
+        etag = response['ETag']
+        call_command('rebuild_route_geometry', stdout=io.StringIO())
+        self.assertEqual(self.poll(etag).status_code, 200)
+
+    def test_full_saves_keep_bumped_versions(self):
+        state = State.objects.get(pk=self.dataset['states'][0].pk)
+        route = state.pipelineroute_set.first()
+        route.save()
+        state.name = 'Renamed State'
+        state.save()
+        state.refresh_from_db()
+        self.assertEqual(state.data_version, 2)
+        self.assertEqual(Zone.objects.get(pk=state.zone_id).data_version, 2)
+
+
+class ListingCacheTests(TestCase):
+
+    def setUp(self):
+        self.dataset = seed_dataset(12, faults_per_route=1, points_per_route=2)
+        zonal = self.dataset['users'][Profile.ZONAL]
+        colleague = benchmarks.User.objects.create_user('zonal-colleague', password=benchmarks.BENCHMARK_PASSWORD)
+        Profile.objects.create(user=colleague, role=Profile.ZONAL, zone=zonal.profile.zone)
+        self.clients = [benchmarks.token_client(zonal), benchmarks.token_client(colleague)]
+        self.zone = zonal.profile.zone
+
+    def test_users_sharing_a_scope_share_the_rendered_listing(self):
+        first = self.clients[0].get(benchmarks.ROUTES_URL)
+        self.assertEqual(first['X-Listing-Cache'], 'miss')
+        with CaptureQueriesContext(connection) as queries:
+            second = self.clients[1].get(benchmarks.ROUTES_URL)
+        self.assertEqual(second['X-Listing-Cache'], 'hit')
+        self.assertEqual(second.content, first.content)
+        self.assertNotIn('pipeapp_pipelineroute', ' '.join(query['sql'] for query in queries))
+        self.assertEqual(second.json()['results'][0]['id'], first.json()['results'][0]['id'])
+
+        route = PipelineRoute.objects.filter(state__zone=self.zone).first()
+        route.faults.first().delete()
+        third = self.clients[1].get(benchmarks.ROUTES_URL)
+        self.assertEqual(third['X-Listing-Cache'], 'miss')
+        self.assertNotEqual(third.content, first.content)
+
+    def test_only_one_caller_builds_a_missing_entry(self):
+        built = []
+
+        def build():
+            built.append(1)
+            return b'listing'
+
+        caches['default'].add('pipeapp:listing:stampede:lock', True, 5)  # Another worker is building it
+        threading.Timer(0.1, caches['default'].set, ['pipeapp:listing:stampede', b'built elsewhere']).start()
+        self.assertEqual(cached_listing('stampede', build, lock_timeout=5), (b'built elsewhere', True))
+        self.assertEqual(built, [])
+
+        # A lock holder that never finishes only delays the others
+        caches['default'].add('pipeapp:listing:stalled:lock', True, 5)
+        self.assertEqual(cached_listing('stalled', build, lock_timeout=0.2), (b'listing', False))
+        self.assertEqual(built, [1])
+
+
+class FaultEventTests(TestCase):
+
+    def setUp(self):
+        self.dataset = seed_dataset(12, faults_per_route=1, points_per_route=2)
+        self.zonal = self.dataset['users'][Profile.ZONAL]
+        self.zone = self.zonal.profile.zone
+        self.route = PipelineRoute.objects.filter(state__zone=self.zone).first()
+        self.outside = PipelineRoute.objects.exclude(state__zone=self.zone).first()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        # Poll by hand instead of from the background thread
+        broker.background, broker.version = False, None
+        self.addCleanup(setattr, broker, 'background', True)
+        self.addCleanup(setattr, broker, 'version', None)
+
+    def subscribe(self, user, last_event_id=None):
+        user_scope = resolve_scope(user)
+
+        async def subscribe():
+            return broker.subscribe(user_scope)
+
+        subscription = self.loop.run_until_complete(subscribe())
+        self.addCleanup(broker.unsubscribe, subscription)
+        return subscription, broker.replay(subscription, last_event_id)
+
+    def received(self, subscription):
+        batches = []
+        while (batch := self.loop.run_until_complete(subscription.get(0.05))) is not None:
+            batches.append(batch)
+        return batches
+
+    def events(self, batches):
+        return [event for _, events in batches for event in events]
+
+    def commit(self):
+        return self.captureOnCommitCallbacks(execute=True)
+
+    def test_events_reach_subscribers_whose_scope_covers_the_route(self):
+        zonal, _ = self.subscribe(self.zonal)
+        admin, _ = self.subscribe(self.dataset['users'][Profile.NATIONAL])
+
+        with self.commit():
+            fault = PipelineFault.objects.create(
+                pipeline_route=self.route, fault_coordinates=self.route.coordinates[0], status='critical'
+            )
+        with self.commit():
+            self.outside.faults.first().delete()
+        broker.poll()
+
+        batches = self.received(zonal)
+        self.assertEqual(len(batches), 1)
+        events = {event['type']: event for event in self.events(batches)}
+        self.assertEqual(set(events), {'fault.changed', 'route.changed'})
+        self.assertEqual(events['fault.changed']['fault']['id'], fault.pk)
+        self.assertEqual(events['route.changed']['route'], self.route.pk)
+        self.assertEqual(events['route.changed']['status'], 'critical')
+        self.assertIn('fault.deleted', [event['type'] for event in self.events(self.received(admin))])
+
+    def test_writes_of_other_processes_are_published(self):
+        subscription, _ = self.subscribe(self.zonal)
+        # Written without signals, as another worker's write looks from this process
+        with self.commit():
+            PipelineRoute.objects.filter(pk=self.route.pk).update(status='warning', change_seq=next_change_seq())
+        broker.poll()
+        [(seq, events)] = self.received(subscription)
+        self.assertEqual(events, [{'id': seq, 'type': 'route.changed', 'route': self.route.pk, 'status': 'warning'}])
+
+    def test_bulk_created_faults_are_published(self):
+        subscription, _ = self.subscribe(self.zonal)
+        with self.commit():
+            create_faults([
+                PipelineFault(pipeline_route=route, fault_coordinates=route.coordinates[0], status='warning')
+                for route in (self.route, self.outside)
+            ])
+        broker.poll()
+        events = self.events(self.received(subscription))
+        self.assertEqual([event['fault']['route'] for event in events if event['type'] == 'fault.changed'], [self.route.pk])
+
+    def test_a_route_moved_out_of_the_scope_is_deleted(self):
+        subscription, _ = self.subscribe(self.zonal)
+        with self.commit():
+            self.route.state = self.outside.state
+            self.route.save()
+        broker.poll()
+        self.assertEqual(
+            [(event['type'], event['route']) for event in self.events(self.received(subscription))],
+            [('route.deleted', self.route.pk)],
+        )
+
+    def test_reconnecting_replays_what_was_missed(self):
+        subscription, replay = self.subscribe(self.zonal, last_event_id=None)
+        self.assertEqual(replay, [])
+        last_event_id = encode_cursor(broker.version, subscription.scope)
+        broker.unsubscribe(subscription)
+        broker.version = None  # As the poller leaves it once nobody listens
+        with self.commit():
+            self.route.faults.first().delete()
+        with self.commit():
+            self.outside.faults.first().delete()
+
+        _, replay = self.subscribe(self.zonal, last_event_id)
+        self.assertEqual(len(replay), 1)
+        self.assertEqual({event['type'] for _, event in replay[0][1]}, {'fault.deleted', 'route.changed'})
+        # Cursors of another scope, pruned ones and nonsense ask for a reload
+        admin_cursor = encode_cursor(replay[0][0], resolve_scope(self.dataset['users'][Profile.NATIONAL]))
+        for cursor in (admin_cursor, 'garbage', encode_cursor(broker.version + 10, subscription.scope)):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.subscribe(self.zonal, cursor)[1], [events.RESYNC])
+        ChangeCounter.objects.filter(pk=1).update(pruned_through=broker.version)
+        self.assertEqual(self.subscribe(self.zonal, last_event_id)[1], [events.RESYNC])
+
+    def test_a_process_without_subscribers_makes_no_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            broker.poll()
+        self.assertEqual(queries.captured_queries, [])
+
+    def test_a_slow_subscriber_is_told_to_resync(self):
+        subscription, _ = self.subscribe(self.zonal)
+        subscription.queue = asyncio.Queue(1)
+        for seq in range(3):
+            broker.publish(seq, [(self.route.state_id, {'type': 'route.changed'})])
+        self.assertEqual(len(self.received(subscription)), 1)
+        self.assertEqual(subscription.lost, 2)
+
+    def test_changes_beyond_the_limit_ask_for_a_reload(self):
+        subscription, _ = self.subscribe(self.zonal)
+        with self.commit():
+            self.route.faults.first().delete()
+        with mock.patch.object(events, 'EVENTS_MAX_CHANGES', 1):
+            broker.poll()
+        self.assertEqual(self.received(subscription), [events.RESYNC])
+
+
+class FaultEventStreamTests(TestCase):
+
+    def setUp(self):
+        broker.background, broker.version = False, None
+        self.addCleanup(setattr, broker, 'background', True)
+        self.addCleanup(setattr, broker, 'version', None)
+
+    def test_wsgi_workers_refuse_the_stream(self):
+        # The sync test client goes through the WSGI handler, which would hold the worker forever
+        user = benchmarks.User.objects.create(username='event-wsgi')
+        token = Token.objects.create(user=user)
+        response = self.client.get('/pipeapp/events/', headers={'Authorization': f'Token {token.key}'})
+        self.assertEqual(response.status_code, 501)
+        self.assertFalse(broker)
+
+    async def test_stream_requires_a_token_header(self):
+        response = await self.async_client.get('/pipeapp/events/')
+        self.assertEqual(response.status_code, 401)
+        user = await benchmarks.User.objects.acreate(username='event-query')
+        token = await Token.objects.acreate(user=user)
+        # Tokens in URLs end up in access logs
+        response = await self.async_client.get(f'/pipeapp/events/?access_token={token.key}')
+        self.assertEqual(response.status_code, 401)
+
+    async def test_stream_sends_published_events(self):
+        user = await benchmarks.User.objects.acreate(username='event-admin')
+        await Profile.objects.acreate(user=user, role=Profile.NATIONAL)
+        token = await Token.objects.acreate(user=user)
+        response = await self.async_client.get('/pipeapp/events/', headers={'Authorization': f'Token {token.key}'})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = response.streaming_content
+        self.assertEqual(await anext(stream), b'retry: 5000\n\n')
+
+        broker.publish(7, [(1, {'id': 7, 'type': 'fault.deleted', 'fault': {'id': 3}}), (1, {'id': 7, 'type': 'route.deleted', 'route': 5})])
+        frames = (await anext(stream)).decode().split('\n\n')
+        self.assertIn('event: fault.deleted\n', frames[0])
+        self.assertNotIn('id: ', frames[0])
+        # Only the last event of a change carries the cursor to resume from
+        self.assertIn('"route": 5', frames[1])
+        self.assertIn(f'id: 7-{scope_digest(await aresolve_scope(user))}', frames[1])
+        await stream.aclose()
+        # The server cancels the stream when the client disconnects, which unsubscribes it
+        for subscription in list(broker.unrestricted):
+            broker.unsubscribe(subscription)
+
+
+    async def open_stream(self, user):
+        token = await Token.objects.acreate(user=user)
+        response = await self.async_client.get('/pipeapp/events/', headers={'Authorization': f'Token {token.key}'})
+        stream = response.streaming_content
+        self.assertEqual(await anext(stream), b'retry: 5000\n\n')
+        return token, stream
+
+    async def test_revoking_the_token_closes_an_open_stream(self):
+        user = await benchmarks.User.objects.acreate(username='event-revoked')
+        await Profile.objects.acreate(user=user, role=Profile.NATIONAL)
+        with mock.patch.object(events, 'EVENTS_KEEPALIVE', 0.05):
+            token, stream = await self.open_stream(user)
+            self.assertEqual(await anext(stream), b': keepalive\n\n')
+            await token.adelete()
+            self.assertIn(b'event: revoked\n', await anext(stream))
+            with self.assertRaises(StopAsyncIteration):
+                await anext(stream)
+        self.assertFalse(broker)
+
+    async def test_an_open_stream_follows_a_scope_change(self):
+        user = await benchmarks.User.objects.acreate(username='event-moved')
+        profile = await Profile.objects.acreate(user=user, role=Profile.NATIONAL)
+        state = await State.objects.acreate(name='Event State', zone=await Zone.objects.acreate(name='Event Zone'))
+        with mock.patch.object(events, 'EVENTS_KEEPALIVE', 0.05):
+            _, stream = await self.open_stream(user)
+            self.assertEqual(len(broker.unrestricted), 1)
+            profile.role, profile.state = Profile.STATE, state
+            await profile.asave()
+            self.assertIn(b'event: resync\n', await anext(stream))
+            self.assertFalse(broker.unrestricted)
+            [subscription] = broker.by_state[state.pk]
+            await stream.aclose()
+        broker.unsubscribe(subscription)
+
+
+@override_settings(ROOT_URLCONF='pipeapp.tests')
+class AsyncReadTests(TestCase):
+
+    def setUp(self):
+        self.dataset = seed_dataset(12, faults_per_route=2, points_per_route=3)
+        self.user = self.dataset['users'][Profile.ZONAL]
+        self.token = Token.objects.create(user=self.user)
+        self.headers = {'Authorization': f'Token {self.token.key}'}
+        self.route = PipelineRoute.objects.filter(state__zone=self.user.profile.zone).first()
+        self.outside = PipelineRoute.objects.exclude(state__zone=self.user.profile.zone).first()
+
+    def sync_get(self, url):
+        cache.clear()
+        with override_settings(ROOT_URLCONF='pipeline.urls'):
+            response = self.client.get(url, HTTP_AUTHORIZATION=self.headers['Authorization'])
+            return response.getvalue(), response.get('ETag')
+
+    async def test_reads_match_the_viewsets(self):
+        urls = [
+            benchmarks.ROUTES_URL,
+            f'{benchmarks.ROUTES_URL}?ordering=-length_m&page_size=5&zoom=8',
+            f'{benchmarks.ROUTES_URL}?stream=1',
+            f'{benchmarks.ROUTES_URL}{self.route.pk}/',
+            f'{benchmarks.FAULTS_URL}?near={self.route.coordinates[0]["latitude"]},{self.route.coordinates[0]["longitude"]}&radius=50000',
+        ]
+        for url in urls:
+            await cache.aclear()
+            response = await self.async_client.get(url, headers=self.headers)
+            self.assertEqual(response.status_code, 200, url)
+            if response.streaming:
+                content = b''.join([chunk async for chunk in response.streaming_content])
+            else:
+                content = response.content
+            self.assertEqual((content, response.get('ETag')), await sync_to_async(self.sync_get)(url), url)
+
+    async def test_streams_are_sent_chunk_by_chunk(self):
+        with warnings.catch_warnings():
+            # Django warns when it has to drain a sync iterator before sending anything
+            warnings.simplefilter('error')
+            for url in (f'{benchmarks.ROUTES_URL}?stream=1', f'{benchmarks.ROUTES_URL}?stream=ndjson'):
+                with self.subTest(url=url), mock.patch('pipeapp.streaming.STREAM_CHUNK_SIZE', 2):
+                    response = await self.async_client.get(url, headers=self.headers)
+                    self.assertTrue(response.is_async)
+                    chunks = [chunk async for chunk in response]
+                    self.assertGreater(len(chunks), 2)
+
+    def test_unchanged_listing_is_answered_without_building_it(self):
+        get = async_to_sync(self.async_client.get)
+        etag = get(benchmarks.ROUTES_URL, headers=self.headers)['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            response = get(benchmarks.ROUTES_URL, headers={**self.headers, 'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertNotIn('pipeapp_pipelineroute', ' '.join(query['sql'] for query in queries))
+        self.assertEqual(get(benchmarks.ROUTES_URL, headers=self.headers)['X-Listing-Cache'], 'hit')
+
+    async def test_scope_and_credentials_are_enforced(self):
+        response = await self.async_client.get(f'{benchmarks.ROUTES_URL}{self.outside.pk}/', headers=self.headers)
+        self.assertEqual(response.status_code, 404)
+        response = await self.async_client.get(benchmarks.ROUTES_URL)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response['WWW-Authenticate'], 'Token')
+        response = await self.async_client.get(benchmarks.FAULTS_URL, headers={'Authorization': 'Token invalid'})
+        self.assertEqual(response.status_code, 401)
+
+    async def test_writes_reach_the_viewsets(self):
+        response = await self.async_client.post(benchmarks.FAULTS_URL, {
+            'pipeline_route': self.route.pk,
+            'fault_coordinates': self.route.coordinates[0],
+            'status': 'warning',
+        }, content_type='application/json', headers=self.headers)
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(await PipelineFault.objects.filter(pk=response.json()['id']).aexists())
+
+    async def test_async_scope_matches_the_sync_scope(self):
+        for user in self.dataset['users'].values():
+            await cache.aclear()
+            self.assertEqual(await aresolve_scope(user), await sync_to_async(resolve_scope)(user))
+
+
+class LoadBenchmarkTests(LiveServerTestCase):
+
+    def test_reports_throughput_and_tail_latency_per_scenario(self):
+        dataset = seed_dataset(5, faults_per_route=1, points_per_route=2)
+        token = Token.objects.create(user=dataset['users'][Profile.NATIONAL])
+        output = io.StringIO()
+        call_command(
+            'benchmark_load', '--target', f'live={self.live_server_url}', '--token', token.key,
+            '--concurrency', '3', '--slow-clients', '1', '--duration', '0.5', stdout=output, stderr=io.StringIO(),
+        )
+        results = json.loads(output.getvalue())['results']['live']
+        self.assertEqual(set(results), set(benchmarks.LOAD_SCENARIOS))
+        for result in results.values():
+            self.assertEqual((result['clients'], result['errors']), (1, 0))
+            self.assertGreater(result['requests'], 0)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+
+    def test_writers_update_faults_alongside_the_reads(self):
+        dataset = seed_dataset(4, faults_per_route=1, points_per_route=2)
+        token = Token.objects.create(user=dataset['users'][Profile.NATIONAL])
+        seq = ChangeCounter.objects.get(pk=COUNTER_ID).value
+        output = io.StringIO()
+        call_command(
+            'benchmark_load', '--target', f'live={self.live_server_url}', '--token', token.key,
+            '--concurrency', '2', '--slow-clients', '1', '--writers', '2', '--duration', '0.5',
+            stdout=output, stderr=io.StringIO(),
+        )
+        result = json.loads(output.getvalue())['results']['live'][benchmarks.WRITE_SCENARIO]
+        self.assertEqual((result['clients'], result['errors']), (2, 0))
+        self.assertGreater(result['requests'], 0)
+        # The updates went through the change counter
+        self.assertEqual(PipelineFault.objects.filter(description__startswith='Load benchmark write').count(), 2)
+        self.assertGreater(ChangeCounter.objects.get(pk=COUNTER_ID).value, seq)
+
+
+class DeltaSyncTests(TestCase):
+
+    def setUp(self):
+        self.dataset = seed_dataset(12, faults_per_route=1, points_per_route=2)
+        self.user = self.dataset['users'][Profile.ZONAL]
+        self.client = benchmarks.token_client(self.user)
+        self.zone = self.user.profile.zone
+        self.route = PipelineRoute.objects.filter(state__zone=self.zone).first()
+        self.outside = PipelineRoute.objects.exclude(state__zone=self.zone).first()
+        self.url = f'{benchmarks.ROUTES_URL}changes/'
+
+    def sync(self, cursor=None, client=None):
+        response = (client or self.client).get(self.url, {'since': cursor} if cursor else {})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def commit(self):
+        # Each transaction takes its own change number, which it gives up on commit
+        return self.captureOnCommitCallbacks(execute=True)
+
+    def cursor(self):
+        body = self.sync()
+        self.assertTrue(body['reset'])
+        return body['cursor']
+
+    def test_without_changes_nothing_is_sent(self):
+        cursor = self.cursor()
+        body = self.sync(cursor)
+        self.assertEqual(body, {
+            'cursor': cursor, 'reset': False, 'routes': [], 'faults': [], 'deleted': {'routes': [], 'faults': []},
+        })
+
+    def test_fault_writes_are_sent_with_their_route(self):
+        cursor = self.cursor()
+        with self.commit():
+            fault = PipelineFault.objects.create(pipeline_route=self.route, fault_coordinates=self.route.coordinates[0], status='critical')
+            self.outside.faults.first().delete()
+        body = self.sync(cursor)
+        self.assertEqual([route['id'] for route in body['routes']], [self.route.pk])
+        self.assertEqual(body['routes'][0]['critical_fault_count'], 1)
+        self.assertNotIn('faults', body['routes'][0])
+        self.assertEqual([(item['id'], item['status']) for item in body['faults']], [(fault.pk, 'critical')])
+        self.assertEqual(body['deleted'], {'routes': [], 'faults': []})
+
+        cursor, fault_id = body['cursor'], fault.pk
+        with self.commit():
+            fault.delete()
+        body = self.sync(cursor)
+        self.assertEqual(body['deleted'], {'routes': [], 'faults': [fault_id]})
+        self.assertEqual(body['routes'][0]['critical_fault_count'], 0)
+        self.assertEqual(self.sync(body['cursor'])['routes'], [])
+
+    def test_deleted_and_moved_routes_are_tombstoned(self):
+        other_zone_state = self.outside.state
+        moved = PipelineRoute.objects.filter(state__zone=self.zone).exclude(pk=self.route.pk).first()
+        cursor = self.cursor()
+        route_id = self.route.pk
+        with self.commit():
+            self.route.delete()
+            moved.state = other_zone_state
+            moved.save()
+        body = self.sync(cursor)
+        self.assertEqual(body['deleted'], {'routes': sorted([route_id, moved.pk]), 'faults': []})
+        self.assertEqual(body['routes'], [])
+
+        national = benchmarks.token_client(self.dataset['users'][Profile.NATIONAL])
+        cursor = self.sync(cursor, client=national)['cursor']
+        with self.commit():
+            moved.state = self.route.state
+            moved.save()
+        body = self.sync(cursor, client=national)
+        # Moved within the national scope, so sent as changed rather than deleted
+        self.assertEqual([route['id'] for route in body['routes']], [moved.pk])
+        self.assertEqual(body['deleted']['routes'], [])
+        self.assertEqual([fault['id'] for fault in body['faults']], list(moved.faults.values_list('pk', flat=True)))
+
+    def test_reconciled_faults_are_synced(self):
+        national = benchmarks.token_client(self.dataset['users'][Profile.NATIONAL])
+        cursor = self.sync(client=national)['cursor']
+        previous = self.route.faults.get()
+        payload = {
+            'name': self.route.name, 'state': self.route.state.name, 'coordinates': self.route.coordinates,
+            'faults': [{'fault_coordinates': {'latitude': 6.0, 'longitude': 3.0}, 'status': 'warning'}],
+        }
+        with self.commit():
+            response = national.put(f'{benchmarks.ROUTES_URL}{self.route.pk}/', payload, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        body = self.sync(cursor, client=national)
+        self.assertEqual([route['id'] for route in body['routes']], [self.route.pk])
+        self.assertEqual([fault['status'] for fault in body['faults']], ['warning'])
+        self.assertEqual(body['deleted']['faults'], [previous.pk])
+
+    def test_foreign_stale_and_invalid_cursors(self):
+        cursor = self.cursor()
+        unit = benchmarks.token_client(self.dataset['users'][Profile.UNIT])
+        self.assertTrue(self.sync(cursor, client=unit)['reset'])
+        seq, _, digest = cursor.partition('-')
+        self.assertTrue(self.sync(f'{int(seq) + 1}-{digest}')['reset'])
+        self.assertEqual(self.client.get(self.url, {'since': 'latest'}).status_code, 400)
+
+        with self.commit():
+            self.route.faults.first().delete()
+        with self.settings(PIPEAPP_TOMBSTONE_RETENTION_DAYS=0):
+            call_command('prune_tombstones', stdout=io.StringIO())
+        self.assertFalse(Tombstone.objects.exists())
+        body = self.sync(cursor)
+        self.assertTrue(body['reset'])
+        self.assertFalse(self.sync(body['cursor'])['reset'])
+
+    def test_sync_queries_do_not_grow_with_changes(self):
+        cursor = self.cursor()
+        routes = list(PipelineRoute.objects.filter(state__zone=self.zone))
+        with self.commit():
+            routes[0].faults.first().delete()
+        with CaptureQueriesContext(connection) as small:
+            self.sync(cursor)
+        for route in routes:
+            with self.commit():
+                PipelineFault.objects.create(pipeline_route=route, fault_coordinates=route.coordinates[0])
+                route.faults.first().delete()
+        with CaptureQueriesContext(connection) as large:
+            body = self.sync(cursor)
+        self.assertEqual(len(body['routes']), len(routes))
+        self.assertEqual(len(small), len(large))
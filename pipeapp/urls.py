@@ -1,5 +1,8 @@
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
+from . import async_views
+from .events import fault_events
 from .views import (
     UserRegisterView, 
     UserLoginView, 
@@ -8,16 +11,21 @@ from .views import (
     PipelineFaultListCreateView, 
     PipelineFaultDetailView, 
     PipelineRouteAndFaultViewSet,
-    UserLogoutView
+    PipelineFaultViewSet,
+    UserLogoutView,
+    UserProvisionView,
 )
 
 # Create a router and register the viewset
 router = DefaultRouter()
 router.register(r'pipeline-routes-viewset', PipelineRouteAndFaultViewSet, basename='pipeline-route-viewset')
+router.register(r'pipeline-faults-viewset', PipelineFaultViewSet, basename='pipeline-fault-viewset')
 
 urlpatterns = [
     path('register/', UserRegisterView.as_view(), name='register'),
     path('login/', UserLoginView.as_view(), name='login'),
+    path('users/provision/', UserProvisionView.as_view(), name='provision-users'),
+    path('events/', fault_events, name='fault-events'),
     # path('pipeline-routes/', PipelineRouteListCreateView.as_view(), name='pipeline-routes-list-create'),
     # path('pipeline-routes/<int:pk>/', PipelineRouteDetailView.as_view(), name='pipeline-routes-detail'),
     # path('pipeline-faults/', PipelineFaultListCreateView.as_view(), name='pipeline-faults-list-create'),
@@ -25,3 +33,14 @@ urlpatterns = [
     path('', include(router.urls)),  # Include the router's URLs
     path('logout/', UserLogoutView.as_view(), name='logout'),
 ]
+
+# Async views for the reads of the route and fault endpoints, mounted ahead of the router
+# when serving through ASGI; writes to the same URLs still reach the viewsets
+async_read_urlpatterns = [
+    path('pipeline-routes-viewset/', async_views.routes),
+    path('pipeline-routes-viewset/<int:pk>/', async_views.route_detail),
+    path('pipeline-faults-viewset/', async_views.faults),
+]
+
+if getattr(settings, 'PIPEAPP_ASYNC_READS', False):
+    urlpatterns = async_read_urlpatterns + urlpatterns
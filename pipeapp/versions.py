@@ -0,0 +1,109 @@
+"""
+Data versions of the route listings, for ETags, conditional GETs and the
+listing cache.
+
+Every write to a route or fault bumps ``data_version`` on the route's state
+and its zone, in the same transaction as the write. A role scope's version
+is then one small read of the hierarchy tables: the zone versions for an
+unrestricted scope, the state versions otherwise. ``listing_key`` hashes
+that version with the request's URL and media type, so a matching
+If-None-Match is answered, and a cached listing found, without touching the
+route tables or the serializers; a write simply moves the scope to new keys.
+"""
+import hashlib
+
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import PipelineFault, PipelineRoute, State, Zone
+from .signals import routes_bulk_created
+
+
+def bump_versions(state_ids=(), route_ids=()):
+    """Bump the data version of the given states, of the states of the given routes, and of their zones."""
+    state_ids, route_ids = set(state_ids) - {None}, set(route_ids) - {None}
+    if route_ids:
+        state_ids.update(PipelineRoute.objects.filter(pk__in=route_ids).values_list('state_id', flat=True))
+    if not state_ids:
+        return
+    State.objects.filter(pk__in=state_ids).update(data_version=F('data_version') + 1)
+    Zone.objects.filter(state__in=state_ids).update(data_version=F('data_version') + 1)
+
+
+def version_rows(scope):
+    if scope.unrestricted:
+        nodes = Zone.objects.all()
+    else:
+        nodes = scope.filter(State.objects.all(), state_lookup=None)
+    return nodes.order_by('pk').values_list('pk', 'data_version')
+
+
+def scope_version(scope):
+    """``(id, version)`` pairs covering everything ``scope`` can list."""
+    return list(version_rows(scope))
+
+
+async def ascope_version(scope):
+    return [row async for row in version_rows(scope)]
+
+
+def listing_key(scope, request, version=None):
+    """
+    Digest of everything a route listing depends on. Users whose roles cover the
+    same states share it, whatever their role; the absolute URL is included as
+    pagination links carry the host. Async callers pass the ``scope_version``.
+    """
+    key = '|'.join([
+        'zones' if scope.unrestricted else 'states',
+        repr(scope_version(scope) if version is None else version),
+        request.build_absolute_uri(),
+        request.accepted_media_type or '',
+    ])
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+@receiver(post_save, sender=PipelineRoute)
+def route_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    bump_versions(state_ids={instance.state_id, getattr(instance, '_loaded_state_id', None)})
+    instance._loaded_state_id = instance.state_id
+
+
+@receiver(post_delete, sender=PipelineRoute)
+def route_deleted(sender, instance, **kwargs):
+    bump_versions(state_ids=[instance.state_id])
+
+
+@receiver(routes_bulk_created, sender=PipelineRoute)
+def routes_created(sender, instances, **kwargs):
+    bump_versions(state_ids={route.state_id for route in instances})
+
+
+@receiver(pre_save, sender=PipelineFault)
+def fault_saving(sender, instance, **kwargs):
+    # A fault moved to another route changes the listing of both routes' states; the route
+    # it was loaded with is read here, the summary receiver forgets it once the save is done
+    instance._version_route_ids = {instance.pipeline_route_id, getattr(instance, '_loaded_route_id', None)}
+
+
+@receiver(post_save, sender=PipelineFault)
+def fault_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        bump_versions(route_ids=instance._version_route_ids)
+
+
+@receiver(post_delete, sender=PipelineFault)
+def fault_deleted(sender, instance, origin=None, **kwargs):
+    # A cascading route delete bumps the route's state itself
+    if isinstance(origin, PipelineRoute) or getattr(origin, 'model', None) is PipelineRoute:
+        return
+    bump_versions(route_ids=[instance.pipeline_route_id])
+
+
+@receiver(post_save, sender=State)
+def state_saved(sender, instance, created=False, raw=False, **kwargs):
+    # Listings show the state's name
+    if not created and not raw:
+        bump_versions(state_ids=[instance.pk])
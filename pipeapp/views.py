@@ -1,18 +1,54 @@
+import math
+from itertools import islice
+from types import GeneratorType
+
+from django.conf import settings
+from django.http import HttpResponse
 from django.shortcuts import render
-from rest_framework import generics, status, permissions, viewsets
+from django.utils import timezone
+from django.utils.http import parse_etags, quote_etag
+from django.db.models import Prefetch
+from rest_framework import generics, status, permissions, serializers, viewsets
 from django.contrib.auth import get_user_model, authenticate, login as django_login, logout as django_logout
+from django.contrib.auth.signals import user_logged_in
+from rest_framework.exceptions import AuthenticationFailed, ValidationError
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
+from rest_framework.decorators import action
+from rest_framework.filters import OrderingFilter
+from rest_framework.parsers import JSONParser
 from rest_framework.authentication import SessionAuthentication, BasicAuthentication, TokenAuthentication
 from rest_framework.authtoken.models import Token
-from rest_framework.permissions import AllowAny
-from .models import CustomUser, PipelineRoute, Profile, PipelineFault
-from .serializers import UserSerializer, LoginSerializer, PipelineRouteAndFaultSerializer,UserDetailSerializer,  PipelineRouteSerializer, PipelineFaultSerializer
+from rest_framework.permissions import AllowAny, IsAdminUser
+from rest_framework.settings import api_settings
+from .models import CustomUser, PipelineRoute, PipelineRouteSimplification, Profile, PipelineFault, Tombstone, stored_tolerance
+from .geometry import zoom_tolerance
+from .serializers import UserSerializer, LoginSerializer, PipelineRouteAndFaultSerializer,UserDetailSerializer,  PipelineRouteSerializer, PipelineFaultSerializer, RouteChangeSerializer, RouteFaultSerializer, TelemetryReadingSerializer, GEOMETRY_FORMATS
+from .filters import (
+    filter_faults_in_bbox, filter_faults_near, filter_routes_by_length, filter_routes_in_bbox,
+    parse_bbox, parse_distance, parse_length_range, parse_near, parse_point,
+)
+from .authentication import CachingBasicAuthentication, CachingTokenAuthentication
+from .changes import change_horizon, decode_cursor, encode_cursor
+from .geometry import decode_distances, point_location
+from .ingest import INGEST_BATCH_SIZE, MAX_INGEST_BATCH_SIZE, ingest_routes
+from .listing_cache import cached_listing
+from .parsers import CSVParser, NDJSONParser
+from .provisioning import MAX_PROVISION_ROWS, provision_users
+from .scope import resolve_scope
+from .snapping import SNAP_MAX_DISTANCE, snap_index
+from .telemetry import telemetry_buffer
+from .versions import listing_key
+from .renderers import NDJSONRenderer
+from .streaming import streaming_list_response
 
 
 User = get_user_model()
 
+SYNC_MAX_CHANGES = getattr(settings, 'PIPEAPP_SYNC_MAX_CHANGES', 5000)
+
 # User registration view
 class UserRegisterView(generics.CreateAPIView):
     queryset = User.objects.all()
@@ -37,12 +73,19 @@ class UserLoginView(APIView):
         if serializer.is_valid():
             user = serializer.validated_data['user']
 
-            # Log the user in
-            django_login(request, user)
+            if serializer.validated_data['session']:
+                # Log the user in
+                django_login(request, user)
+            else:
+                # Token-only clients get no session, the login is still recorded
+                user_logged_in.send(sender=user.__class__, request=request, user=user)
 
             # Generate or retrieve a token for the user
             token, created = Token.objects.get_or_create(user=user)
 
+            # Load the profile with its zone, state, area and unit in one query
+            user.profile = Profile.objects.select_related('zone', 'state', 'area', 'unit').get(user=user)
+
             # Serialize the user data including profile
             user_data = UserDetailSerializer(user).data
 
@@ -53,6 +96,32 @@ class UserLoginView(APIView):
             }, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+# Batch user provisioning view
+class UserProvisionView(APIView):
+    authentication_classes = [CachingTokenAuthentication, CachingBasicAuthentication]
+    permission_classes = [IsAdminUser]
+    parser_classes = [JSONParser, CSVParser]
+
+    def post(self, request, *args, **kwargs):
+        """
+        Create users and their profiles from a roster, a JSON array or a CSV with
+        a header row, of username, email, password and optionally first_name,
+        last_name, role, location, zone, state, area and unit. Nothing is created
+        unless every row is valid; the response lists the rows that were rejected.
+        """
+        rows = request.data
+        if isinstance(rows, list):
+            rows = ((line, data, None) for line, data in enumerate(rows, 1))
+        elif not isinstance(rows, GeneratorType):
+            raise ValidationError({'non_field_errors': ['Expected a JSON array or CSV roster of users.']})
+        rows = list(islice(rows, MAX_PROVISION_ROWS + 1))
+        if len(rows) > MAX_PROVISION_ROWS:
+            raise ValidationError({'non_field_errors': [f'A roster may list at most {MAX_PROVISION_ROWS} users.']})
+
+        report = provision_users(rows)
+        response_status = status.HTTP_400_BAD_REQUEST if report.errors else status.HTTP_201_CREATED
+        return Response(report.as_dict(), status=response_status)
+
 # PipelineRoute views
 class PipelineRouteListCreateView(generics.ListCreateAPIView):
     queryset = PipelineRoute.objects.all()
@@ -91,34 +160,384 @@ class PipelineFaultDetailView(generics.RetrieveUpdateDestroyAPIView):
     queryset = PipelineFault.objects.all()
     serializer_class = PipelineFaultSerializer
 
-class PipelineRouteAndFaultViewSet(viewsets.ModelViewSet):
+class RoleScopeMixin:
+    """
+    Resolves the caller's role scope once per request. ``get_scope().filter``
+    restricts a queryset to the part of the hierarchy the profile role covers,
+    ``get_scope().state_ids`` is None when the scope is unrestricted.
+    """
+
+    scope = None  # Async views set it ahead of the sync code
+
+    def get_scope(self):
+        if self.scope is None:
+            self.scope = resolve_scope(self.request.user)
+        return self.scope
+
+class PipelineRouteAndFaultViewSet(RoleScopeMixin, viewsets.ModelViewSet):
     serializer_class = PipelineRouteAndFaultSerializer
-    authentication_classes = [TokenAuthentication, BasicAuthentication]  # Use TokenAuthentication for token-based auth
+    authentication_classes = [CachingTokenAuthentication, CachingBasicAuthentication]  # Cached TokenAuthentication for token-based auth
     permission_classes = [permissions.IsAuthenticated]
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, NDJSONRenderer]
+    # ?ordering=-length_m etc., applied to both pages and streams
+    filter_backends = [OrderingFilter]
+    ordering_fields = ['id', 'name', 'length_m', 'segment_count']
+    ordering = ['id']
+
+    def list(self, request, *args, **kwargs):
+        key = listing_key(self.get_scope(), request)
+        if self.listing_not_modified(request, key):
+            # Answer a poll whose data hasn't changed from the scope's version alone
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        elif self.listing_cacheable(request):
+            # Users sharing a scope are served the same rendered page until its data changes
+            content, hit = cached_listing(key, lambda: self.render_listing(request, *args, **kwargs))
+            response = self.cached_listing_response(request, content, hit)
+        else:
+            response = self.list_routes(request, *args, **kwargs)
+        return self.add_listing_headers(response, key)
+
+    def listing_not_modified(self, request, key):
+        return quote_etag(key) in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+
+    def listing_cacheable(self, request):
+        return request.accepted_renderer.format == 'json' and not request.query_params.get('stream')
+
+    def cached_listing_response(self, request, content, hit):
+        response = HttpResponse(content, content_type=request.accepted_renderer.media_type)
+        response['X-Listing-Cache'] = 'hit' if hit else 'miss'
+        return response
+
+    def add_listing_headers(self, response, key):
+        response['ETag'] = quote_etag(key)
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def render_listing(self, request, *args, **kwargs):
+        response = self.list_routes(request, *args, **kwargs)
+        return request.accepted_renderer.render(
+            response.data, request.accepted_media_type, self.get_renderer_context()
+        )
+
+    def list_routes(self, request, *args, **kwargs):
+        # ?stream=1 (JSON array) or an application/x-ndjson Accept header streams the
+        # whole scope unpaginated, reading routes from the database chunk by chunk
+        stream = request.query_params.get('stream')
+        ndjson = request.accepted_renderer.format == NDJSONRenderer.format or stream == 'ndjson'
+        if ndjson or stream in ('1', 'true', 'json'):
+            queryset = self.filter_queryset(self.get_queryset())
+            return streaming_list_response(
+                queryset, self.get_serializer_class(), self.get_serializer_context(), ndjson=ndjson
+            )
+        return super().list(request, *args, **kwargs)
+
+    def get_geometry_options(self):
+        """
+        Geometry query parameters:
+        ?geometry=json|polyline|binary picks the coordinate encoding,
+        ?zoom=<map zoom> or ?tolerance=<degrees> picks a stored simplification,
+        ?precision=<decimals> rounds the returned coordinates.
+        """
+        if hasattr(self, '_geometry_options'):
+            return self._geometry_options
+        params = self.request.query_params if self.request else {}
+
+        geometry_format = params.get('geometry', 'json')
+        if geometry_format not in GEOMETRY_FORMATS:
+            raise ValidationError({'geometry': f"Expected one of: {', '.join(GEOMETRY_FORMATS)}."})
+
+        tolerance = None
+        try:
+            if params.get('tolerance') is not None:
+                tolerance = stored_tolerance(float(params['tolerance']))
+            elif params.get('zoom') is not None:
+                zoom = int(params['zoom'])
+                if not 0 <= zoom <= 24:
+                    raise ValueError
+                tolerance = stored_tolerance(zoom_tolerance(zoom))
+        except ValueError:
+            raise ValidationError({'zoom': 'Expected an integer zoom between 0 and 24 or a numeric tolerance in degrees.'})
+
+        precision = params.get('precision')
+        if precision is not None:
+            if not precision.isdigit() or int(precision) > 7:
+                raise ValidationError({'precision': 'Expected a number of decimal places between 0 and 7.'})
+            precision = int(precision)
+
+        self._geometry_options = {
+            'geometry_format': geometry_format,
+            'tolerance': tolerance,
+            'precision': precision,
+        }
+        return self._geometry_options
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context.update(self.get_geometry_options())
+        context['include_distances'] = self.action not in ('list', 'changes')
+        return context
+
+    def get_serializer_class(self):
+        if self.action == 'changes':
+            return RouteChangeSerializer
+        return super().get_serializer_class()
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.action != 'list':
+            return queryset
+        # ?bbox=min_lon,min_lat,max_lon,max_lat keeps routes intersecting the viewport
+        bbox = self.request.query_params.get('bbox')
+        if bbox:
+            queryset = filter_routes_in_bbox(queryset, parse_bbox(bbox))
+        # ?min_length=&max_length= in metres, against the stored length
+        return filter_routes_by_length(queryset, *parse_length_range(self.request.query_params))
+
+    @swagger_auto_schema(manual_parameters=[
+        openapi.Parameter('point', openapi.IN_QUERY, 'lat,lon to snap', type=openapi.TYPE_STRING, required=True),
+        openapi.Parameter(
+            'max_distance', openapi.IN_QUERY, 'Search radius in metres, PIPEAPP_SNAP_MAX_DISTANCE by default',
+            type=openapi.TYPE_NUMBER,
+        ),
+    ])
+    @action(detail=False, methods=['get'])
+    def snap(self, request):
+        # Nearest route in scope to a GPS fix, from the in-process segment index
+        latitude, longitude = parse_point(request.query_params.get('point'), 'point')
+        max_distance = parse_distance(request.query_params.get('max_distance'), 'max_distance', required=False)
+        result, route = snap_index.nearest_route(
+            latitude, longitude, max_distance, self.get_scope().state_ids,
+            PipelineRoute.objects.only('id', 'name', 'cumulative_distances'),
+        )
+        if result is None:
+            return Response({'detail': 'No route within range.'}, status=status.HTTP_404_NOT_FOUND)
+        distances = decode_distances(route.cumulative_distances)
+        chainage = None
+        if result.segment + 1 < len(distances):
+            start, end = distances[result.segment], distances[result.segment + 1]
+            chainage = round(float(start + result.fraction * (end - start)), 1)
+        return Response({
+            'route': route.pk,
+            'name': route.name,
+            'segment': result.segment,
+            'fraction': round(result.fraction, 6),
+            'chainage': chainage,  # Metres along the route from its first vertex
+            'point': {'latitude': result.latitude, 'longitude': result.longitude},
+            'distance': round(result.distance, 1),
+        })
+
+    @swagger_auto_schema(manual_parameters=[
+        openapi.Parameter('batch_size', openapi.IN_QUERY, 'Routes inserted per transaction', type=openapi.TYPE_INTEGER),
+    ])
+    @action(detail=False, methods=['post'], parser_classes=[NDJSONParser, JSONParser])
+    def ingest(self, request):
+        """
+        Bulk load routes from an NDJSON body (one {name, state, coordinates} object
+        per line) or a JSON array. Rows are inserted in batches; the response lists
+        the rows that were rejected and why.
+        """
+        batch_size = request.query_params.get('batch_size', INGEST_BATCH_SIZE)
+        try:
+            batch_size = int(batch_size)
+            if not 0 < batch_size <= MAX_INGEST_BATCH_SIZE:
+                raise ValueError
+        except ValueError:
+            raise ValidationError({'batch_size': f'Expected an integer between 1 and {MAX_INGEST_BATCH_SIZE}.'})
+
+        rows = request.data
+        if isinstance(rows, list):
+            rows = ((line, data, None) for line, data in enumerate(rows, 1))
+        elif not isinstance(rows, GeneratorType):
+            raise ValidationError({'non_field_errors': ['Expected NDJSON or a JSON array of routes.']})
+
+        report = ingest_routes(rows, batch_size, self.get_scope().state_ids)
+        if not report.errors:
+            response_status = status.HTTP_201_CREATED
+        elif report.created:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response(report.as_dict(), status=response_status)
+
+    @swagger_auto_schema(manual_parameters=[
+        openapi.Parameter('since', openapi.IN_QUERY, 'Cursor returned by the previous sync', type=openapi.TYPE_STRING),
+    ])
+    @action(detail=False, methods=['get'])
+    def changes(self, request):
+        """
+        Routes and faults of the caller's scope changed since ``?since=<cursor>``,
+        and the ids of those deleted or moved out of it. Pass the returned cursor
+        on the next sync. Without a cursor, or when ``reset`` is true, nothing else
+        is returned: reload the listing, then sync from the returned cursor.
+        """
+        scope = self.get_scope()
+        # Read first: changes committing meanwhile are sent now and again next time, never skipped
+        current, pruned_through = change_horizon()
+        since = request.query_params.get('since')
+        if since is not None:
+            try:
+                since = decode_cursor(since, scope)
+            except ValueError:
+                raise ValidationError({'since': 'Invalid cursor.'})
+        payload = {
+            'cursor': encode_cursor(current, scope),
+            'reset': since is None or not pruned_through <= since <= current,
+            'routes': [],
+            'faults': [],
+            'deleted': {'routes': [], 'faults': []},
+        }
+        if payload['reset']:
+            return Response(payload)
+
+        limit = SYNC_MAX_CHANGES + 1
+        routes = list(self.get_queryset().filter(change_seq__gt=since).order_by('id')[:limit])
+        faults = PipelineFault.objects.filter(change_seq__gt=since).order_by('id')
+        faults = list(scope.filter(faults, state_lookup='pipeline_route__state')[:limit])
+        removed = scope.filter(Tombstone.objects.filter(change_seq__gt=since)).values_list('kind', 'object_id')
+        removed = list(removed[:limit])
+        if len(routes) + len(faults) + len(removed) > SYNC_MAX_CHANGES:
+            # Too far behind, reloading is cheaper
+            return Response({**payload, 'reset': True})
+
+        # An object deleted from one state but now in another of the scope was moved within it
+        present = {Tombstone.ROUTE: {route.pk for route in routes}, Tombstone.FAULT: {fault.pk for fault in faults}}
+        deleted = {kind: set() for kind in present}
+        for kind, object_id in removed:
+            if object_id not in present[kind]:
+                deleted[kind].add(object_id)
+        payload['routes'] = self.get_serializer(routes, many=True).data
+        payload['faults'] = RouteFaultSerializer(faults, many=True).data
+        payload['deleted'] = {'routes': sorted(deleted[Tombstone.ROUTE]), 'faults': sorted(deleted[Tombstone.FAULT])}
+        return Response(payload)
+
+    def get_queryset(self):
+        # Status is stored on the route; state and faults are loaded up front to avoid per-route queries
+        queryset = PipelineRoute.objects.select_related('state')
+        if self.action != 'changes':
+            queryset = queryset.prefetch_related('faults')  # Synced faults are sent on their own
+        if self.action in ('list', 'changes'):
+            queryset = queryset.defer('cumulative_distances')
+
+        tolerance = self.get_geometry_options()['tolerance']
+        if tolerance is not None and self.request.method == 'GET':
+            # Only the requested level of detail is read, never the full geometry
+            queryset = queryset.defer('geometry').prefetch_related(Prefetch(
+                'simplifications',
+                queryset=PipelineRouteSimplification.objects.filter(tolerance=tolerance),
+            ))
+
+        return self.get_scope().filter(queryset)
+
+class PipelineFaultViewSet(RoleScopeMixin, viewsets.ModelViewSet):
+    """
+    Faults within the caller's role scope.
+
+    ?bbox=min_lon,min_lat,max_lon,max_lat returns faults inside a bounding box;
+    ?near=lat,lon&radius=<metres> returns faults within a radius, with their distance.
+    """
+    serializer_class = RouteFaultSerializer
+    authentication_classes = [CachingTokenAuthentication, CachingBasicAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_scoped_routes(self):
+        return self.get_scope().filter(PipelineRoute.objects.all())
 
     def get_queryset(self):
-        user = self.request.user
-        profile = Profile.objects.get(user=user)
-        queryset = PipelineRoute.objects.all()
+        return self.get_scope().filter(PipelineFault.objects.all(), state_lookup='pipeline_route__state')
 
-        if profile.role == Profile.NATIONAL:
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.action != 'list':
             return queryset
-        elif profile.role == Profile.ZONAL:
-            return queryset.filter(state__zone=profile.zone)
-        elif profile.role == Profile.STATE:
-            return queryset.filter(state=profile.state)
-        elif profile.role == Profile.AREA:
-            return queryset.filter(state__area=profile.area)
-        elif profile.role == Profile.UNIT:
-            return queryset.filter(state__area__unit=profile.unit)
-        
-        return queryset.none()  # Fallback to no data if no role matches
+        params = self.request.query_params
+        if params.get('bbox'):
+            queryset = filter_faults_in_bbox(queryset, parse_bbox(params['bbox']))
+        if params.get('near'):
+            latitude, longitude, radius = parse_near(params['near'], params.get('radius'))
+            queryset = filter_faults_near(queryset, latitude, longitude, radius)
+        return queryset
+
+    @action(detail=False, methods=['get', 'post'], parser_classes=[JSONParser, NDJSONParser])
+    def telemetry(self, request):
+        """
+        Queue fault readings for a batched write: one reading object, a JSON array
+        or NDJSON. Answers 202 once queued, or 503 while the buffer is full.
+        GET reports this process's buffer: readings pending, written and dropped.
+        """
+        if request.method == 'GET':
+            return Response(telemetry_buffer.stats())
+        data = request.data
+        if isinstance(data, GeneratorType):
+            data = list(data)
+            errors = {line: [error] for line, _, error in data if error}
+            if errors:
+                raise ValidationError(errors)
+            data = [item for _, item, _ in data]
+        elif isinstance(data, dict):
+            data = [data]
+        serializer = TelemetryReadingSerializer(data=data, many=True)
+        serializer.is_valid(raise_exception=True)
+
+        route_ids = {reading['route'] for reading in serializer.validated_data}
+        visible = set(self.get_scoped_routes().filter(pk__in=route_ids).values_list('id', flat=True))
+        if route_ids - visible:
+            raise ValidationError({'route': [f'Unknown route {route_id}.' for route_id in sorted(route_ids - visible)]})
+
+        received = timezone.now()
+        readings = [{
+            'pipeline_route_id': reading['route'],
+            'fault_coordinates': reading['fault_coordinates'],
+            'status': reading['status'],
+            'description': reading.get('description'),
+            'reported_at': reading.get('reported_at', received),
+        } for reading in serializer.validated_data]
+        if not telemetry_buffer.offer(readings):
+            return Response(
+                {'detail': 'Telemetry buffer is full, retry shortly.'},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={'Retry-After': str(math.ceil(telemetry_buffer.flush_interval))},
+            )
+        return Response({'accepted': len(readings)}, status=status.HTTP_202_ACCEPTED)
+
+    def perform_create(self, serializer):
+        if not serializer.validated_data.pop('snap', False):
+            serializer.save()
+            return
+        # Attach the fault to the closest route in scope within PIPEAPP_SNAP_MAX_DISTANCE
+        latitude, longitude = point_location(serializer.validated_data['fault_coordinates'])
+        result, route = snap_index.nearest_route(latitude, longitude, SNAP_MAX_DISTANCE, self.get_scope().state_ids)
+        if result is None:
+            raise ValidationError({'snap': f'No route within {SNAP_MAX_DISTANCE:g} metres of the fault.'})
+        serializer.save(pipeline_route=route)
+
+    def perform_update(self, serializer):
+        serializer.validated_data.pop('snap', None)
+        serializer.save()
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        # Faults can only be filed against routes the caller can see
+        if self.request and not isinstance(serializer, serializers.ListSerializer):
+            serializer.fields['pipeline_route'].queryset = self.get_scoped_routes()
+        return serializer
 
 
 class UserLogoutView(APIView):
+    """
+    Ends the session and revokes the caller's API token. Login hands every
+    device of a user the same token, so this signs all of them out; each
+    gets a new token on its next login.
+    """
     authentication_classes = []
     permission_classes = [AllowAny]
 
     def post(self, request, *args, **kwargs):
+        # Revoke the API token as well as the session; deleting it drops it from the token cache
+        try:
+            credentials = CachingTokenAuthentication().authenticate(request)
+        except AuthenticationFailed:
+            credentials = None  # Already invalid, nothing to revoke
+        if credentials is not None:
+            credentials[1].delete()
         django_logout(request)
         return Response({"message": "Logout successful"}, status=status.HTTP_200_OK)
@@ -2,6 +2,13 @@
 ASGI config for pipeline project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Serve the live fault events at ``/events/`` through it: under ASGI each open
+stream is a coroutine rather than a WSGI worker thread. Streams follow the
+change sequence in the database, so they carry writes made by any worker,
+ASGI or WSGI. Route and fault reads are served by the async views of
+pipeapp.async_views (PIPEAPP_ASYNC_READS).
+
+Run it with ``gunicorn -c pipeline/gunicorn_asgi.py``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
@@ -12,5 +19,6 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pipeline.settings')
+os.environ.setdefault('PIPEAPP_ASYNC_READS', '1')
 
 application = get_asgi_application()
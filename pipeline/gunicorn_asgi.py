@@ -0,0 +1,21 @@
+"""
+Gunicorn settings for serving pipeline.asgi with uvicorn workers:
+
+    gunicorn -c pipeline/gunicorn_asgi.py
+
+Each worker is one event loop. Async reads and event streams share it, and
+synchronous code (writes, page builds) runs on its thread pool. A worker
+with open streams reads the shared change sequence for their events, so
+streams see the writes of every worker.
+"""
+import multiprocessing
+import os
+
+wsgi_app = 'pipeline.asgi:application'
+worker_class = 'uvicorn.workers.UvicornWorker'
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# Event streams stay open, so only the worker heartbeat is timed, not requests
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
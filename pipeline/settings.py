@@ -141,3 +141,65 @@ STATIC_URL = '/static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+REST_FRAMEWORK = {
+    # Keyset pagination on id; ?page_size= overrides PAGE_SIZE up to PIPEAPP_MAX_PAGE_SIZE
+    'DEFAULT_PAGINATION_CLASS': 'pipeapp.pagination.IdCursorPagination',
+    'PAGE_SIZE': 100,
+}
+
+PIPEAPP_MAX_PAGE_SIZE = 1000
+# Seconds a ?count=1 total is cached for a given scope and filter
+PIPEAPP_COUNT_CACHE_TIMEOUT = 60
+# Routes read and serialized per database round trip in ?stream=1 / NDJSON listings
+PIPEAPP_STREAM_CHUNK_SIZE = 500
+# Douglas-Peucker tolerances (degrees) precomputed for every route and served for ?zoom= / ?tolerance=
+PIPEAPP_ROUTE_TOLERANCES = [0.00001, 0.0001, 0.001, 0.01]
+# Grid cell size (degrees) of the in-process nearest-route index
+PIPEAPP_SNAP_CELL_SIZE = 0.01
+# Furthest a fault created with snap=true may be from the route it is attached to, and the
+# default ?max_distance= of the snap lookup, in metres
+PIPEAPP_SNAP_MAX_DISTANCE = 1000
+# Routes inserted per transaction by the NDJSON ingestion endpoint, unless ?batch_size= is given
+PIPEAPP_INGEST_BATCH_SIZE = 500
+# Fault telemetry write-behind buffer: readings held before new ones are refused with 503,
+# readings written per transaction, and the longest a reading waits before a flush (seconds)
+PIPEAPP_TELEMETRY_QUEUE_SIZE = 10000
+PIPEAPP_TELEMETRY_BATCH_SIZE = 500
+PIPEAPP_TELEMETRY_FLUSH_INTERVAL = 1.0
+# Times a batch whose write failed is retried, with a doubling backoff, before it is dropped
+PIPEAPP_TELEMETRY_MAX_RETRIES = 5
+# Optional cache alias shared by all workers, where a user's resolved role scope (their visible
+# state ids) stays cached PIPEAPP_SCOPE_CACHE_TIMEOUT seconds; without one it is cached per
+# process for PIPEAPP_SCOPE_CACHE_LOCAL_TTL seconds, since invalidations would not reach other workers
+PIPEAPP_SCOPE_CACHE_ALIAS = None
+PIPEAPP_SCOPE_CACHE_TIMEOUT = 300
+PIPEAPP_SCOPE_CACHE_LOCAL_TTL = 5
+
+# Validated API tokens kept in memory per process, and for how many seconds; a revoked token
+# may still be accepted by other workers until their copy expires
+PIPEAPP_TOKEN_CACHE_SIZE = 10000
+PIPEAPP_TOKEN_CACHE_LOCAL_TTL = 5
+# Optional cache alias shared by all workers, where tokens live PIPEAPP_TOKEN_CACHE_TTL seconds
+PIPEAPP_TOKEN_CACHE_ALIAS = None
+PIPEAPP_TOKEN_CACHE_TTL = 300
+# Seconds a verified Basic auth username and password skip the password hasher, in this
+# process and in PIPEAPP_TOKEN_CACHE_ALIAS
+PIPEAPP_BASIC_AUTH_CACHE_LOCAL_TTL = 5
+PIPEAPP_BASIC_AUTH_CACHE_TTL = 60
+# Threads hashing passwords during batch user provisioning; None sizes the pool to the CPUs
+PIPEAPP_PROVISION_HASH_WORKERS = None
+# Cache of rendered route listings shared by users with the same scope; use a shared alias across workers
+PIPEAPP_LISTING_CACHE_ALIAS = 'default'
+PIPEAPP_LISTING_CACHE_TIMEOUT = 300
+# Live fault events: changes buffered per subscriber before it is told to resync, seconds
+# between keepalive comments on an idle stream, and seconds between reads of the change
+# sequence by a process with subscribers
+PIPEAPP_EVENTS_QUEUE_SIZE = 100
+PIPEAPP_EVENTS_KEEPALIVE = 15
+PIPEAPP_EVENTS_POLL_INTERVAL = 1.0
+# Serve route and fault reads with the async views; pipeline.asgi sets PIPEAPP_ASYNC_READS=1
+PIPEAPP_ASYNC_READS = os.environ.get('PIPEAPP_ASYNC_READS') == '1'
+# Delta sync: changes returned at most before a client is asked to reload instead,
+# and days tombstones of deleted routes and faults are kept by prune_tombstones
+PIPEAPP_SYNC_MAX_CHANGES = 5000
+PIPEAPP_TOMBSTONE_RETENTION_DAYS = 90